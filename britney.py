@@ -180,6 +180,7 @@ does for the generation of the update excuses.
  * The excuses are written in an HTML file.
 """
 import contextlib
+import json
 import logging
 import optparse
 import os
@@ -234,6 +235,11 @@ class Britney(object):
     # ALL = {"force", "force-hint", "block-all"} | HINTS_STANDARD | registered policy hints (not covered above)
     HINTS_ALL = ('ALL')
 
+    # The phases of upgrade_testing (a checkpoint is written before each of them)
+    UPGRADE_PHASES = ('easy-hints', 'main-run', 'break-arch-runs', 'hint-hints', 'auto-hinter', 'cleanup')
+    # The phases that are cut short once MAX_MIGRATION_SECONDS have passed
+    TIME_BUDGETED_UPGRADE_PHASES = ('easy-hints', 'main-run', 'break-arch-runs', 'hint-hints', 'auto-hinter')
+
     def __init__(self):
         """Class constructor
 
@@ -321,6 +327,15 @@ class Britney(object):
 
         self.logger.info("Compiling Installability tester")
         self.pkg_universe, self._inst_tester = build_installability_tester(self.suite_info, self.options.architectures)
+        try:
+            self._inst_tester.set_choice_order(self.options.installability_choice_order)
+        except ValueError as e:  # pragma: no cover
+            self.logger.error("Invalid INSTALLABILITY_CHOICE_ORDER: %s", str(e))
+            sys.exit(1)
+        self._inst_tester.solver_budget = self.options.installability_solver_budget
+        self._inst_tester.record_explanations = self.options.installability_explanations
+        if self.options.installability_cost_sample_rate:
+            self._inst_tester.enable_cost_accounting(self.options.installability_cost_sample_rate)
         target_suite = self.suite_info.target_suite
         target_suite.inst_tester = self._inst_tester
 
@@ -328,10 +343,12 @@ class Britney(object):
         self._hint_parser = HintParser(self._migration_item_factory)
         self._migration_manager = MigrationManager(self.options, self.suite_info, self.all_binaries, self.pkg_universe,
                                                    self.constraints, self._migration_item_factory)
+        # The migrations are only needed to resume from a checkpoint
+        self._migration_manager.record_history = self._checkpoint_filename is not None
 
         if not self.options.nuninst_cache:
             self.logger.info("Building the list of non-installable packages for the full archive")
-            self._inst_tester.compute_installability()
+            self._inst_tester.compute_installability(workers=self.options.installability_workers)
             nuninst = compile_nuninst(target_suite,
                                       self.options.architectures,
                                       self.options.nobreakall_arches)
@@ -404,6 +421,8 @@ class Britney(object):
                           help="Do not compute which packages can migrate.")
         parser.add_option("", "--series", action="store", dest="series", default='testing',
                                help="set distribution series name")
+        parser.add_option("", "--resume", action="store_true", dest="resume", default=False,
+                          help="resume an interrupted run from its last checkpoint")
         (self.options, self.args) = parser.parse_args()
 
         if self.options.verbose:
@@ -480,6 +499,82 @@ class Britney(object):
         else:
             self.options.check_consistency_level = int(self.options.check_consistency_level)
 
+        if not hasattr(self.options, 'installability_workers'):
+            self.options.installability_workers = 1
+        else:
+            self.options.installability_workers = int(self.options.installability_workers)
+
+        if not hasattr(self.options, 'installability_choice_order'):
+            self.options.installability_choice_order = ''
+        self.options.installability_choice_order = self.options.installability_choice_order.split()
+
+        if getattr(self.options, 'installability_solver_budget', '') in ('', '0'):
+            self.options.installability_solver_budget = None
+        else:
+            self.options.installability_solver_budget = int(self.options.installability_solver_budget)
+
+        if getattr(self.options, 'max_migration_seconds', '') in ('', '0'):
+            self.options.max_migration_seconds = None
+        else:
+            self.options.max_migration_seconds = int(self.options.max_migration_seconds)
+
+        if getattr(self.options, 'installability_cost_sample_rate', '') == '':
+            self.options.installability_cost_sample_rate = 0
+        else:
+            self.options.installability_cost_sample_rate = int(self.options.installability_cost_sample_rate)
+
+        if getattr(self.options, 'installability_cost_report_size', '') == '':
+            self.options.installability_cost_report_size = 20
+        else:
+            self.options.installability_cost_report_size = int(self.options.installability_cost_report_size)
+
+        self.options.installability_explanations = \
+            getattr(self.options, 'installability_explanations', 'no') in ('yes', '1')
+
+        # Checkpoints (if enabled) are only useful for runs writing the
+        # results
+        self._checkpoint_filename = None
+        self._checkpoint = None
+        self._resume_phase = 0
+        # Whether the run resumes a phase that was already underway
+        # (see CHECKPOINT_INTERVAL)
+        self._resume_in_progress = False
+        self._upgrade_run_state = None
+        # State of the time budget (see _out_of_migration_time)
+        self._upgrade_phase = None
+        self._migration_deadline = None
+        self._untried_items = set()
+        self.phases_cut_short = []
+        self.options.checkpoints = getattr(self.options, 'checkpoints', 'no') in ('yes', '1')
+        if self.options.checkpoints and not hasattr(self.options, 'state_dir'):
+            raise RuntimeError("Please set STATE_DIR in the britney configuration")
+        if self.options.checkpoints and not (self.options.dry_run or self.options.actions or
+                                             self.options.hint_tester):
+            self._checkpoint_filename = os.path.join(self.options.state_dir, 'upgrade-checkpoint')
+        if self.options.resume and self._checkpoint_filename is None:  # pragma: no cover
+            self.logger.error("--resume requires CHECKPOINTS and cannot be used with --dry-run, --actions"
+                              " or --hint-tester")
+            sys.exit(1)
+
+        self.options.failed_migration_memo = \
+            getattr(self.options, 'failed_migration_memo', 'no') in ('yes', '1')
+        if self.options.failed_migration_memo and not hasattr(self.options, 'state_dir'):
+            raise RuntimeError("Please set STATE_DIR in the britney configuration")
+        if getattr(self.options, 'failed_migration_memo_expiry', '') == '':
+            self.options.failed_migration_memo_expiry = 7
+        else:
+            self.options.failed_migration_memo_expiry = int(self.options.failed_migration_memo_expiry)
+
+        if getattr(self.options, 'checkpoint_interval', '') == '':
+            self.options.checkpoint_interval = 0
+        else:
+            self.options.checkpoint_interval = int(self.options.checkpoint_interval)
+
+        if getattr(self.options, 'speculative_trial_workers', '') == '':
+            self.options.speculative_trial_workers = 0
+        else:
+            self.options.speculative_trial_workers = int(self.options.speculative_trial_workers)
+
         if not hasattr(self.options, 'adt_retry_url_mech'):
             self.options.adt_retry_url_mech = ''
 
@@ -798,6 +893,18 @@ class Britney(object):
             res.append("%s-%d" % (arch[0], n))
         return "%d+%d: %s" % (total, totalbreak, ":".join(res))
 
+    def _check_transaction_consistency(self, transaction, comment):
+        # Checking the entire target suite after every trial is too
+        # expensive for production, so (below level 4) only the packages
+        # changed by the transaction are checked.  The full check is
+        # still done at the end of every do_all (level 2).
+        target_suite = self.suite_info.target_suite
+        if self.options.check_consistency_level >= 4:
+            target_suite.check_suite_source_pkg_consistency(comment)
+        else:
+            source_names, binary_keys = transaction.changed_packages()
+            target_suite.check_changed_source_pkg_consistency(comment, source_names, binary_keys)
+
     def iter_packages(self, packages, selected, nuninst=None):
         """Iter on the list of actions and apply them one-by-one
 
@@ -812,7 +919,6 @@ class Britney(object):
         output_logger = self.output_logger
         solver = InstallabilitySolver(self.pkg_universe, self._inst_tester)
         mm = self._migration_manager
-        target_suite = self.suite_info.target_suite
 
         for y in sorted((y for y in packages), key=attrgetter('uvname')):
             try:
@@ -830,6 +936,24 @@ class Britney(object):
             nuninst_orig = self.nuninst_orig
 
         nuninst_last_accepted = nuninst_orig
+        speculative_workers = self.options.speculative_trial_workers
+        # The main run is also checkpointed every CHECKPOINT_INTERVAL
+        # accepted migrations (with the items that have yet to migrate)
+        checkpoint_interval = 0
+        if self._checkpoint_filename is not None and self._upgrade_phase == 'main-run' and \
+                mm.current_transaction is None:
+            checkpoint_interval = self.options.checkpoint_interval
+        candidates = list(packages)
+        accepted_since_checkpoint = 0
+        # The roots of the footprints (see MigrationManager.compute_footprint_roots)
+        # of the items in maybe_rescheduled_packages.  They are only
+        # retried once a migration touching their footprint has been
+        # accepted.
+        rejected_footprints = {}
+        # Items that would have been retried in the next round if not
+        # for their footprint and the number of trials avoided that way
+        not_retried = set()
+        avoided_trials = 0
 
         output_logger.info("recur: [] %s %d/0", ",".join(x.uvname for x in selected), len(packages))
         while rescheduled_packages:
@@ -839,10 +963,49 @@ class Britney(object):
 
             worklist.reverse()
 
+            # Maps components to (epoch, SpeculativeTrial), where the epoch
+            # is the number of accepted_footprints when it was tried.
+            speculation = {}
+            accepted_footprints = []
+
             while worklist:
+                if self._out_of_migration_time():
+                    untried = [item for comp in worklist for item in comp]
+                    output_logger.info("out of time: not trying %d item(s)", len(untried))
+                    self._untried_items.update(untried)
+                    maybe_rescheduled_packages.extend(untried)
+                    maybe_rescheduled_packages.extend(rescheduled_packages)
+                    rescheduled_packages = []
+                    # No more rounds, so nothing was avoided
+                    not_retried.clear()
+                    break
                 comp = worklist.pop()
                 comp_name = ' '.join(item.uvname for item in comp)
                 output_logger.info("trying: %s" % comp_name)
+                accepted_footprint = None
+                if speculative_workers:
+                    epoch, trial = self._find_speculative_trial(comp, worklist, speculation, accepted_footprints,
+                                                                nuninst_last_accepted, speculative_workers)
+                    if trial is None:
+                        # The platform cannot fork; stick to serial trials
+                        speculative_workers = 0
+                    elif not trial.accepted:
+                        # The outcome of the trial is still valid, so there
+                        # is no need to repeat it.  Accepted trials are
+                        # repeated as we need their changes.
+                        queue_sizes = (len(rescheduled_packages), len(maybe_rescheduled_packages), len(worklist))
+                        if trial.exception is not None:
+                            self._log_skipped_by_exception(comp_name, queue_sizes, trial.exception)
+                        else:
+                            nuninst_after = trial.nuninst_after(nuninst_last_accepted)
+                            self._log_skipped_by_regression(comp, comp_name, queue_sizes, nuninst_last_accepted,
+                                                            nuninst_after, trial.failed_arch, trial.explanations)
+                        self._reschedule_rejected(comp, worklist, maybe_rescheduled_packages, rejected_footprints)
+                        continue
+                    elif epoch == len(accepted_footprints):
+                        accepted_footprint = trial.footprint
+                    else:
+                        accepted_footprint = mm.compute_footprint(comp)
                 with mm.start_transaction() as transaction:
                     accepted = False
                     try:
@@ -864,54 +1027,72 @@ class Britney(object):
                                                    len(selected),
                                                    " ".join(x.uvname for x in selected[-20:]))
                             if self.options.check_consistency_level >= 3:
-                                target_suite.check_suite_source_pkg_consistency('iter_packages after commit')
+                                self._check_transaction_consistency(transaction, 'iter_packages after commit')
                             nuninst_last_accepted = nuninst_after
+                            if speculative_workers:
+                                accepted_footprints.append(accepted_footprint)
                             for cruft_item in new_cruft:
                                 _, updates, rms, _ = mm.compute_groups(cruft_item)
                                 result = (cruft_item, frozenset(updates), frozenset(rms))
                                 group_info[cruft_item] = result
                             worklist.extend([x] for x in new_cruft)
-                            rescheduled_packages.extend(maybe_rescheduled_packages)
-                            maybe_rescheduled_packages.clear()
+                            candidates.extend(new_cruft)
+                            changes = mm.compute_changes(transaction)
+                            still_rejected = []
+                            for item in maybe_rescheduled_packages:
+                                footprint_roots = rejected_footprints[item]
+                                if changes is None or footprint_roots is None or \
+                                        mm.is_footprint_affected(footprint_roots, changes):
+                                    rescheduled_packages.append(item)
+                                    del rejected_footprints[item]
+                                    not_retried.discard(item)
+                                else:
+                                    still_rejected.append(item)
+                                    not_retried.add(item)
+                            maybe_rescheduled_packages[:] = still_rejected
                         else:
+                            broken = sorted(nuninst_after[failed_arch] - nuninst_last_accepted[failed_arch])
+                            # Explanations must be collected before the rollback
+                            # (they are cached by the tester, so this is cheap)
+                            explanations = []
+                            if self.options.installability_explanations:
+                                explanations = mm.explain_uninstallable(failed_arch, broken)
                             transaction.rollback()
-                            broken = sorted(b for b in nuninst_after[failed_arch]
-                                            if b not in nuninst_last_accepted[failed_arch])
-                            compare_nuninst = None
-                            if any(item for item in comp if item.architecture != 'source'):
-                                compare_nuninst = nuninst_last_accepted
                             # NB: try_migration already reverted this for us, so just print the results and move on
-                            output_logger.info("skipped: %s (%d, %d, %d)",
-                                               comp_name,
-                                               len(rescheduled_packages),
-                                               len(maybe_rescheduled_packages),
-                                               len(worklist)
-                                               )
-                            output_logger.info("    got: %s", self.eval_nuninst(nuninst_after, compare_nuninst))
-                            output_logger.info("    * %s: %s", failed_arch, ", ".join(broken))
+                            queue_sizes = (len(rescheduled_packages), len(maybe_rescheduled_packages), len(worklist))
+                            self._log_skipped_by_regression(comp, comp_name, queue_sizes, nuninst_last_accepted,
+                                                            nuninst_after, failed_arch, explanations)
                             if self.options.check_consistency_level >= 3:
-                                target_suite.check_suite_source_pkg_consistency('iter_package after rollback (not accepted)')
+                                self._check_transaction_consistency(transaction,
+                                                                    'iter_package after rollback (not accepted)')
 
                     except MigrationConstraintException as e:
                         transaction.rollback()
-                        output_logger.info("skipped: %s (%d, %d, %d)",
-                                           comp_name,
-                                           len(rescheduled_packages),
-                                           len(maybe_rescheduled_packages),
-                                           len(worklist)
-                                           )
-                        output_logger.info("    got exception: %s"%(repr(e)))
+                        queue_sizes = (len(rescheduled_packages), len(maybe_rescheduled_packages), len(worklist))
+                        self._log_skipped_by_exception(comp_name, queue_sizes, repr(e))
                         if self.options.check_consistency_level >= 3:
-                            target_suite.check_suite_source_pkg_consistency('iter_package after rollback (MigrationConstraintException)')
+                            self._check_transaction_consistency(transaction,
+                                                                'iter_package after rollback (MigrationConstraintException)')
 
                     if not accepted:
-                        if len(comp) > 1:
-                            output_logger.info("    - splitting the component into single items and retrying them")
-                            worklist.extend([item] for item in comp)
-                        else:
-                            maybe_rescheduled_packages.append(comp[0])
+                        self._reschedule_rejected(comp, worklist, maybe_rescheduled_packages, rejected_footprints)
+
+                if accepted and checkpoint_interval:
+                    accepted_since_checkpoint += 1
+                    if accepted_since_checkpoint >= checkpoint_interval:
+                        accepted_since_checkpoint = 0
+                        done = set(selected)
+                        remaining = [x for x in candidates if x not in done]
+                        self._write_checkpoint('main-run', self._upgrade_run_state,
+                                               in_progress=(selected, remaining, nuninst_last_accepted))
+
+            # Each of these would have been tried once more in the next round
+            avoided_trials += len(not_retried)
+            not_retried.clear()
 
         output_logger.info(" finish: [%s]", ",".join(x.uvname for x in selected))
+        if avoided_trials:
+            output_logger.info("  avoid: %d retries of skipped items", avoided_trials)
         output_logger.info("endloop: %s", self.eval_nuninst(self.nuninst_orig))
         output_logger.info("    now: %s", self.eval_nuninst(nuninst_last_accepted))
         format_and_log_uninst(output_logger,
@@ -922,6 +1103,60 @@ class Britney(object):
 
         return (nuninst_last_accepted, maybe_rescheduled_packages)
 
+    def _find_speculative_trial(self, comp, worklist, speculation, accepted_footprints, nuninst_now, workers):
+        """Find (or make) a valid speculative trial of comp
+
+        If there is no valid trial of comp, comp is tried together with
+        the next components in the worklist without a trial (one per
+        worker).
+
+        :return: A (epoch, SpeculativeTrial) tuple.  The trial is None if
+        the platform does not support speculative trials.
+        """
+        entry = speculation.pop(tuple(comp), None)
+        if entry is not None and entry[1].is_valid_after(accepted_footprints[entry[0]:]):
+            return entry
+        batch = [comp]
+        for other in reversed(worklist):
+            if len(batch) >= workers:
+                break
+            if tuple(other) not in speculation:
+                batch.append(other)
+        epoch = len(accepted_footprints)
+        trials = self._migration_manager.speculate(batch, nuninst_now, workers,
+                                                   explain=self.options.installability_explanations)
+        if trials is None:
+            return (epoch, None)
+        for other, trial in zip(batch[1:], trials[1:]):
+            speculation[tuple(other)] = (epoch, trial)
+        return (epoch, trials[0])
+
+    def _log_skipped_by_regression(self, comp, comp_name, queue_sizes, nuninst_now, nuninst_after, failed_arch,
+                                   explanations):
+        output_logger = self.output_logger
+        broken = sorted(nuninst_after[failed_arch] - nuninst_now[failed_arch])
+        compare_nuninst = None
+        if any(item for item in comp if item.architecture != 'source'):
+            compare_nuninst = nuninst_now
+        output_logger.info("skipped: %s (%d, %d, %d)", comp_name, *queue_sizes)
+        output_logger.info("    got: %s", self.eval_nuninst(nuninst_after, compare_nuninst))
+        output_logger.info("    * %s: %s", failed_arch, ", ".join(broken))
+        for why in explanations:
+            output_logger.info("      - %s", why)
+
+    def _log_skipped_by_exception(self, comp_name, queue_sizes, exception):
+        output_logger = self.output_logger
+        output_logger.info("skipped: %s (%d, %d, %d)", comp_name, *queue_sizes)
+        output_logger.info("    got exception: %s" % exception)
+
+    def _reschedule_rejected(self, comp, worklist, maybe_rescheduled_packages, rejected_footprints):
+        if len(comp) > 1:
+            self.output_logger.info("    - splitting the component into single items and retrying them")
+            worklist.extend([item] for item in comp)
+        else:
+            maybe_rescheduled_packages.append(comp[0])
+            rejected_footprints[comp[0]] = self._migration_manager.compute_footprint_roots(comp)
+
     def do_all(self, hinttype=None, init=None, actions=None):
         """Testing update runner
 
@@ -949,6 +1184,13 @@ class Britney(object):
             force = hinttype == "force-hint"
             recurse = False
 
+        if self._out_of_migration_time():
+            # Nothing is tried, so self.upgrade_me stays as it is
+            untried = init or upgrade_me
+            output_logger.info("out of time: not trying %d item(s)", len(untried))
+            self._untried_items.update(untried)
+            return None
+
         # if we have a list of initial packages, check them
         if init:
             for x in init:
@@ -1080,7 +1322,7 @@ class Britney(object):
         self.logger.info("> Update complete - Verifying non-installability counters")
 
         cached_nuninst = self.nuninst_orig
-        self._inst_tester.compute_installability()
+        self._inst_tester.compute_installability(workers=self.options.installability_workers)
         computed_nuninst = compile_nuninst(self.suite_info.target_suite,
                                            self.options.architectures,
                                            self.options.nobreakall_arches)
@@ -1120,55 +1362,94 @@ class Britney(object):
 
         output_logger = self.output_logger
         self.logger.info("Starting the upgrade test")
-        output_logger.info("Generated on: %s", time.strftime("%Y.%m.%d %H:%M:%S %z", time.gmtime(time.time())))
-        output_logger.info("Arch order is: %s", ", ".join(self.options.architectures))
+        if self.options.max_migration_seconds is not None:
+            self._migration_deadline = time.monotonic() + self.options.max_migration_seconds
+        # The item lists that are carried from one phase to the next
+        run_state = {'allpackages': [], 'archpackages': {}, 'deferred': []}
+        if self.options.resume:
+            self._resume_from_checkpoint(run_state)
+        else:
+            output_logger.info("Generated on: %s", time.strftime("%Y.%m.%d %H:%M:%S %z", time.gmtime(time.time())))
+            output_logger.info("Arch order is: %s", ", ".join(self.options.architectures))
+
+        failed_migrations = {}
+        if self.options.failed_migration_memo and not self.options.actions:
+            failed_migrations = self._read_failed_migrations()
 
-        if not self.options.actions:
+        if self._start_upgrade_phase('easy-hints', run_state) and not self.options.actions:
             # process `easy' hints
             for x in self.hints['easy']:
+                if self._out_of_migration_time():
+                    break
                 self.do_hint("easy", x.user, x.packages)
 
             # process `force-hint' hints
             for x in self.hints["force-hint"]:
+                if self._out_of_migration_time():
+                    break
                 self.do_hint("force-hint", x.user, x.packages)
 
-        # run the first round of the upgrade
-        # - do separate runs for break arches
-        allpackages = []
-        normpackages = self.upgrade_me[:]
-        archpackages = {}
-        for a in self.options.break_arches:
-            archpackages[a] = [p for p in normpackages if p.architecture == a]
-            normpackages = [p for p in normpackages if p not in archpackages[a]]
-        self.upgrade_me = normpackages
-        output_logger.info("info: main run")
-        self.do_all()
-        allpackages += self.upgrade_me
-        for a in self.options.break_arches:
-            backup = self.options.break_arches
-            self.options.break_arches = " ".join(x for x in self.options.break_arches if x != a)
-            self.upgrade_me = archpackages[a]
-            output_logger.info("info: broken arch run for %s", a)
+        if self._start_upgrade_phase('main-run', run_state):
+            if self._resume_in_progress:
+                # The items were already split up before the checkpoint
+                output_logger.info("info: main run (resumed)")
+            else:
+                # run the first round of the upgrade
+                # - do separate runs for break arches
+                normpackages = self.upgrade_me[:]
+                archpackages = run_state['archpackages']
+                for a in self.options.break_arches:
+                    archpackages[a] = [p for p in normpackages if p.architecture == a]
+                    normpackages = [p for p in normpackages if p not in archpackages[a]]
+                # - items that failed in a previous run (with the same fingerprint) are
+                #   only tried once at the end
+                if failed_migrations:
+                    normpackages, run_state['deferred'] = self._defer_failed_migrations(normpackages,
+                                                                                        failed_migrations)
+                self.upgrade_me = normpackages
+                output_logger.info("info: main run")
             self.do_all()
-            allpackages += self.upgrade_me
-            self.options.break_arches = backup
-        self.upgrade_me = allpackages
+            run_state['allpackages'] += self.upgrade_me
+
+        if self._start_upgrade_phase('break-arch-runs', run_state):
+            allpackages = run_state['allpackages']
+            for a in self.options.break_arches:
+                backup = self.options.break_arches
+                self.options.break_arches = " ".join(x for x in self.options.break_arches if x != a)
+                self.upgrade_me = run_state['archpackages'][a]
+                output_logger.info("info: broken arch run for %s", a)
+                self.do_all()
+                allpackages += self.upgrade_me
+                self.options.break_arches = backup
+            deferred = run_state['deferred']
+            if deferred:
+                self.upgrade_me = deferred
+                output_logger.info("info: deferred run for %d item(s) that failed in a previous run", len(deferred))
+                self.do_all()
+                allpackages += self.upgrade_me
+            self.upgrade_me = allpackages
 
         if self.options.actions:
             self.printuninstchange()
             return
 
-        # process `hint' hints
-        hintcnt = 0
-        for x in self.hints["hint"][:50]:
-            if hintcnt > 50:
-                output_logger.info("Skipping remaining hints...")
-                break
-            if self.do_hint("hint", x.user, x.packages):
-                hintcnt += 1
+        if self._start_upgrade_phase('hint-hints', run_state):
+            # process `hint' hints
+            hintcnt = 0
+            for x in self.hints["hint"][:50]:
+                if hintcnt > 50:
+                    output_logger.info("Skipping remaining hints...")
+                    break
+                if self._out_of_migration_time():
+                    break
+                if self.do_hint("hint", x.user, x.packages):
+                    hintcnt += 1
+
+        if self._start_upgrade_phase('auto-hinter', run_state):
+            # run the auto hinter
+            self.run_auto_hinter()
 
-        # run the auto hinter
-        self.run_auto_hinter()
+        self._start_upgrade_phase('cleanup', run_state)
 
         if getattr(self.options, "remove_obsolete", "yes") == "yes":
             # obsolete source packages
@@ -1178,14 +1459,10 @@ class Britney(object):
             # local copies for performance
             target_suite = self.suite_info.target_suite
             sources_t = target_suite.sources
-            binaries_t = target_suite.binaries
             mi_factory = self._migration_item_factory
-            used = set(binaries_t[arch][binary].source
-                       for arch in binaries_t
-                       for binary in binaries_t[arch]
-                       )
+            unused = target_suite.sources_without_binaries()
             removals = [mi_factory.parse_item("-%s/%s" % (source, sources_t[source].version), auto_correct=False)
-                        for source in sources_t if source not in used
+                        for source in sources_t if source in unused
                         ]
             if removals:
                 output_logger.info("Removing obsolete source packages from the target suite (%d):", len(removals))
@@ -1203,7 +1480,9 @@ class Britney(object):
         log_and_format_old_libraries(self.output_logger, removals)
 
         self.printuninstchange()
-        if self.options.check_consistency_level >= 1:
+        # A run that was cut short is always checked, as it is meant to
+        # produce (valid) results no matter what.
+        if self.options.check_consistency_level >= 1 or self.phases_cut_short:
             target_suite = self.suite_info.target_suite
             self.assert_nuninst_is_correct()
             target_suite.check_suite_source_pkg_consistency('end')
@@ -1214,6 +1493,9 @@ class Britney(object):
 
             self._policy_engine.save_state(self)
 
+            if self.options.failed_migration_memo and not self.options.actions:
+                self._write_failed_migrations(failed_migrations)
+
             # write HeidiResult
             self.logger.info("Writing Heidi results to %s", self.options.heidi_output)
             write_heidi(self.options.heidi_output,
@@ -1224,9 +1506,223 @@ class Britney(object):
             write_heidi_delta(self.options.heidi_delta_output,
                               self.all_selected)
 
+            if self._checkpoint_filename is not None and os.path.exists(self._checkpoint_filename):
+                os.unlink(self._checkpoint_filename)
 
         self.logger.info("Test completed!")
 
+    def _start_upgrade_phase(self, phase, run_state):
+        """Write a checkpoint for the start of a phase of upgrade_testing
+
+        :param phase: The name of the phase (see UPGRADE_PHASES)
+        :param run_state: A dict with the item lists carried between phases
+        :return: False if the phase was already completed before the run
+        was resumed (and should be skipped), True otherwise.
+        """
+        phase_no = self.UPGRADE_PHASES.index(phase)
+        if phase_no < self._resume_phase:
+            return False
+        if phase_no > self._resume_phase:
+            self._resume_in_progress = False
+        self._upgrade_phase = phase
+        self._upgrade_run_state = run_state
+        # The phase still runs when out of time; its steps do nothing
+        # beyond keeping track of the items that were not tried.
+        self._out_of_migration_time()
+        # (The checkpoint of a phase that is resumed half-way through
+        # is still there)
+        if self._checkpoint_filename is not None and not self._resume_in_progress:
+            self._write_checkpoint(phase, run_state)
+        return True
+
+    def _out_of_migration_time(self):
+        """Check whether the time budget (MAX_MIGRATION_SECONDS) is exhausted
+
+        Only the TIME_BUDGETED_UPGRADE_PHASES are ever out of time; the
+        cleanup and writing the results always happen.  The phases that
+        run out of time are reported in the upgrade output and recorded
+        in phases_cut_short.
+        """
+        if self._migration_deadline is None or self._upgrade_phase not in self.TIME_BUDGETED_UPGRADE_PHASES:
+            return False
+        if time.monotonic() < self._migration_deadline:
+            return False
+        if self._upgrade_phase not in self.phases_cut_short:
+            self.phases_cut_short.append(self._upgrade_phase)
+            self.output_logger.info("info: out of time (MAX_MIGRATION_SECONDS=%d), cutting the %s phase short",
+                                    self.options.max_migration_seconds, self._upgrade_phase)
+        return True
+
+    def _write_checkpoint(self, phase, run_state, in_progress=None):
+        """Write the state needed to resume the run at the start of phase
+
+        :param in_progress: If the phase is already underway, a tuple of
+        the items it migrated so far, the items it has yet to try and
+        the current non-installability counters.  The checkpoint then
+        resumes the phase with the items it has yet to try.
+        """
+        def _items(items):
+            return [[x.name, x.is_cruft_removal] for x in items]
+
+        all_selected = self.all_selected
+        upgrade_me = self.upgrade_me
+        nuninst = self.nuninst_orig
+        if in_progress is not None:
+            selected, upgrade_me, nuninst = in_progress
+            all_selected = all_selected + selected
+        output_size = None
+        if hasattr(self.options, 'upgrade_output') and os.path.exists(self.options.upgrade_output):
+            output_size = os.path.getsize(self.options.upgrade_output)
+        checkpoint = {
+            'phase': phase,
+            'in_progress': in_progress is not None,
+            'history': [[_items(items), sorted(added), sorted(removed)] for items, added, removed in
+                        self._migration_manager.migration_history],
+            'all_selected': _items(all_selected),
+            'upgrade_me': _items(upgrade_me),
+            'allpackages': _items(run_state['allpackages']),
+            'archpackages': {a: _items(x) for a, x in run_state['archpackages'].items()},
+            'deferred': _items(run_state['deferred']),
+            'nuninst': {k: sorted(v) for k, v in nuninst.items()},
+            'broken': sorted(self._inst_tester.known_broken_packages),
+            'output_size': output_size,
+        }
+        if in_progress is not None:
+            self.logger.info("Writing checkpoint for the %s phase (%d items migrated so far) to %s", phase,
+                             len(in_progress[0]), self._checkpoint_filename)
+        else:
+            self.logger.info("Writing checkpoint for the %s phase to %s", phase, self._checkpoint_filename)
+        filename_tmp = self._checkpoint_filename + '_new'
+        with open(filename_tmp, 'w', encoding='utf-8') as fd:
+            json.dump(checkpoint, fd)
+        os.rename(filename_tmp, self._checkpoint_filename)
+
+    def _read_checkpoint(self):
+        if self._checkpoint is None:
+            try:
+                with open(self._checkpoint_filename, encoding='utf-8') as fd:
+                    self._checkpoint = json.load(fd)
+            except FileNotFoundError:  # pragma: no cover
+                self.logger.error("Cannot resume: there is no checkpoint (%s)", self._checkpoint_filename)
+                sys.exit(1)
+        return self._checkpoint
+
+    def _resume_from_checkpoint(self, run_state):
+        """Restore the state of an interrupted run from its checkpoint
+
+        The migrations committed before the checkpoint are applied to
+        the target suite again and the run continues from the phase it
+        was in (or from where it was in the main run, see
+        CHECKPOINT_INTERVAL).
+        """
+        mi_factory = self._migration_item_factory
+
+        def _items(items):
+            result = []
+            for name, is_cruft_removal in items:
+                item = mi_factory.parse_item(name, auto_correct=False)
+                if is_cruft_removal:
+                    pkg_id = BinaryPackageId(item.package, item.version, item.architecture)
+                    item = mi_factory.generate_removal_for_cruft_item(pkg_id)
+                result.append(item)
+            return result
+
+        checkpoint = self._read_checkpoint()
+        self.logger.info("Resuming from the checkpoint for the %s phase in %s", checkpoint['phase'],
+                         self._checkpoint_filename)
+        history = [(_items(items), {BinaryPackageId(*x) for x in added}, {BinaryPackageId(*x) for x in removed})
+                   for items, added, removed in checkpoint['history']]
+        self._migration_manager.replay_migrations(history)
+        self._inst_tester.mark_known_broken(BinaryPackageId(*x) for x in checkpoint['broken'])
+        self.all_selected = _items(checkpoint['all_selected'])
+        self.upgrade_me = _items(checkpoint['upgrade_me'])
+        run_state['allpackages'] = _items(checkpoint['allpackages'])
+        run_state['archpackages'] = {a: _items(x) for a, x in checkpoint['archpackages'].items()}
+        run_state['deferred'] = _items(checkpoint['deferred'])
+        self.nuninst_orig = {k: set(v) for k, v in checkpoint['nuninst'].items()}
+        self._resume_phase = self.UPGRADE_PHASES.index(checkpoint['phase'])
+        self._resume_in_progress = checkpoint['in_progress']
+
+    def _failed_migrations_filename(self):
+        return os.path.join(self.options.state_dir, 'failed-migrations')
+
+    def _read_failed_migrations(self):
+        """Read the fingerprints of items that failed to migrate in previous runs
+
+        Expired entries are ignored.
+
+        :return: A dict mapping the name of the item to a (fingerprint,
+        timestamp) tuple
+        """
+        failed_migrations = {}
+        expire_before = time.time() - self.options.failed_migration_memo_expiry * 24 * 60 * 60
+        try:
+            with open(self._failed_migrations_filename(), encoding='utf-8') as fd:
+                for line in fd:
+                    # <item> <fingerprint> <timestamp>
+                    fields = line.split()
+                    if len(fields) != 3:  # pragma: no cover
+                        continue
+                    try:
+                        timestamp = int(fields[2])
+                    except ValueError:  # pragma: no cover
+                        continue
+                    if timestamp >= expire_before:
+                        failed_migrations[fields[0]] = (fields[1], timestamp)
+        except FileNotFoundError:
+            pass
+        return failed_migrations
+
+    def _defer_failed_migrations(self, items, failed_migrations):
+        """Split items into those to try now and those to try at the end
+
+        Items are deferred if they failed in a previous run and their
+        fingerprint (see MigrationManager.compute_fingerprint) has not
+        changed since.
+        """
+        mm = self._migration_manager
+        now = []
+        deferred = []
+        for item in items:
+            entry = failed_migrations.get(item.name)
+            if entry is not None and mm.compute_fingerprint(item) == entry[0]:
+                deferred.append(item)
+            else:
+                now.append(item)
+        return now, deferred
+
+    def _write_failed_migrations(self, failed_migrations):
+        """Save the fingerprints of the items that failed to migrate
+
+        Entries of items that failed again with the same fingerprint
+        keep their timestamp, so they eventually expire.
+        """
+        mm = self._migration_manager
+        now = int(time.time())
+        filename = self._failed_migrations_filename()
+        filename_tmp = filename + '_new'
+        entries = {}
+        for item in self.upgrade_me:
+            old_entry = failed_migrations.get(item.name)
+            if item in self._untried_items:
+                # Not tried as the run was out of time; keep what we knew
+                if old_entry is not None:
+                    entries[item.name] = old_entry
+                continue
+            fingerprint = mm.compute_fingerprint(item)
+            if fingerprint is None:
+                continue
+            if old_entry is not None and old_entry[0] == fingerprint:
+                entries[item.name] = old_entry
+            else:
+                entries[item.name] = (fingerprint, now)
+        self.logger.info("Writing fingerprints of %d failed migration(s) to %s", len(entries), filename)
+        with open(filename_tmp, 'w', encoding='utf-8') as fd:
+            for name in sorted(entries):
+                fingerprint, timestamp = entries[name]
+                fd.write("%s %s %d\n" % (name, fingerprint, timestamp))
+        os.rename(filename_tmp, filename)
+
     def printuninstchange(self):
         self.logger.info("Checking for newly uninstallable packages")
         uninst = newly_uninst(self.nuninst_orig_save, self.nuninst_orig)
@@ -1416,9 +1912,18 @@ class Britney(object):
         return [ candidates, mincands ]
 
     def run_auto_hinter(self):
+        if self._out_of_migration_time():
+            return
         mi_factory = self._migration_item_factory
+        # Every hint is tried from scratch.  The items of a hint are
+        # applied as one group (with the removals of all of them, see
+        # MigrationManager._apply_multiple_items_to_target_suite), so
+        # hints with items in common cannot share the state applied
+        # for those.
         for l in self.get_auto_hinter_hints(self.upgrade_me):
             for hint in l:
+                if self._out_of_migration_time():
+                    return
                 self.do_hint("easy", "autohinter", [mi_factory.parse_item("%s/%s" % (x[0], x[1]), auto_correct=False)
                                                     for x in sorted(hint)])
 
@@ -1459,7 +1964,13 @@ class Britney(object):
                                  " as this is a dry-run.")
             elif hasattr(self.options, 'upgrade_output'):
                 upgrade_output = getattr(self.options, 'upgrade_output')
-                file_handler = logging.FileHandler(upgrade_output, mode='w', encoding='utf-8')
+                mode = 'w'
+                if self.options.resume and self._read_checkpoint()['output_size'] is not None:
+                    # Continue the output of the interrupted run from the checkpoint
+                    with open(upgrade_output, 'r+b') as fd:
+                        fd.truncate(self._read_checkpoint()['output_size'])
+                    mode = 'a'
+                file_handler = logging.FileHandler(upgrade_output, mode=mode, encoding='utf-8')
                 output_formatter = logging.Formatter('%(message)s')
                 file_handler.setFormatter(output_formatter)
                 self.output_logger.addHandler(file_handler)
@@ -1478,6 +1989,19 @@ class Britney(object):
             self.logger.info('> Stats from the installability tester')
             for stat in self._inst_tester.stats.stats():
                 self.logger.info('>   %s', stat)
+            self.logger.info('> Stats from the migration manager')
+            self.logger.info('>   compute_groups cache - hits: %d, misses: %d',
+                             self._migration_manager.groups_cache_hits,
+                             self._migration_manager.groups_cache_misses)
+            if self.options.max_migration_seconds is not None:
+                self.logger.info('> Stats from the time budget (MAX_MIGRATION_SECONDS=%d)',
+                                 self.options.max_migration_seconds)
+                self.logger.info('>   phases cut short: %s', ', '.join(self.phases_cut_short) or 'none')
+                self.logger.info('>   items not tried: %d', len(self._untried_items))
+            if self._inst_tester.cost_accounting is not None:
+                self.logger.info('> Hottest packages in the installability tester')
+                for line in self._inst_tester.cost_accounting.report(self.options.installability_cost_report_size):
+                    self.logger.info('>   %s', line)
         else:
             self.logger.info('Migration computation skipped as requested.')
         logging.shutdown()
@@ -101,6 +101,18 @@ class TargetSuite(Suite):
         self.inst_tester = None
         logger_name = ".".join((self.__class__.__module__, self.__class__.__name__))
         self._logger = logging.getLogger(logger_name)
+        # The binaries in the suite by source name and source version.
+        # It is built on first use and then kept up to date via
+        # add_binary/remove_binary (etc.), so that cruft and obsolete
+        # sources can be found by only looking at the sources that
+        # changed since the last time (the "dirty" sources).
+        self._binaries_by_source = None
+        self._dirty_sources = set()
+        self._sources_with_cruft = set()
+        self._sources_without_binaries = set()
+        # A counter per source that is bumped whenever the source or one
+        # of its binaries in the suite changes (see source_generation).
+        self._source_generations = {}
 
     def any_of_these_are_in_the_suite(self, pkg_ids):
         """Test if at least one package of a given set is in the suite
@@ -126,32 +138,157 @@ class TargetSuite(Suite):
         """
         yield from self.inst_tester.which_of_these_are_in_the_suite(pkgs)
 
-    def is_installable(self, pkg_id):
+    def is_installable(self, pkg_id, explain=False):
         """Determine whether the given package can be installed in the suite
 
         :param pkg_id: A BinaryPackageId
+        :param explain: If True, return a tuple of the result and an
+        explanation of why the package is uninstallable (or None).
         :return: True if the pkg is currently installable in the suite
         """
-        return self.inst_tester.is_installable(pkg_id)
+        return self.inst_tester.is_installable(pkg_id, explain=explain)
+
+    def is_installable_without_budget(self, pkg_id):
+        """Determine whether the given package can be installed in the suite
+
+        Unlike is_installable, this never gives up due to the solver
+        budget of the installability tester.
+
+        :param pkg_id: A BinaryPackageId
+        :return: True if the pkg is currently installable in the suite
+        """
+        return self.inst_tester.is_installable_without_budget(pkg_id)
 
     def add_binary(self, pkg_id):
         """Add a binary package to the suite
 
+        The package must already be in the binaries table of the suite.
         If the package is not known, this method will throw an
         KeyError.
 
         :param pkg_id The id of the package
         """
         self.inst_tester.add_binary(pkg_id)
+        self.index_binary(self.binaries[pkg_id.architecture][pkg_id.package_name])
 
     def remove_binary(self, pkg_id):
         """Remove a binary from the suite
 
+        The package must still be in the binaries table of the suite.
         :param pkg_id The id of the package
         If the package is not known, this method will throw an
         KeyError.
         """
         self.inst_tester.remove_binary(pkg_id)
+        self.unindex_binary(self.binaries[pkg_id.architecture][pkg_id.package_name])
+
+    def index_binary(self, pkg):
+        """Record that a binary package was added to the binaries table
+
+        Only needed when the binaries table is changed without add_binary
+        (e.g. when rolling back a transaction).
+
+        :param pkg: A BinaryPackage
+        """
+        self._bump_generation(pkg.source)
+        index = self._binaries_by_source
+        if index is None:
+            return
+        index.setdefault(pkg.source, {}).setdefault(pkg.source_version, set()).add(pkg.pkg_id)
+        self._dirty_sources.add(pkg.source)
+
+    def unindex_binary(self, pkg):
+        """Record that a binary package was removed from the binaries table
+
+        Only needed when the binaries table is changed without
+        remove_binary (e.g. when rolling back a transaction).
+
+        :param pkg: A BinaryPackage
+        """
+        self._bump_generation(pkg.source)
+        index = self._binaries_by_source
+        if index is None:
+            return
+        versions = index[pkg.source]
+        pkg_ids = versions[pkg.source_version]
+        pkg_ids.discard(pkg.pkg_id)
+        if not pkg_ids:
+            del versions[pkg.source_version]
+            if not versions:
+                del index[pkg.source]
+        self._dirty_sources.add(pkg.source)
+
+    def source_changed(self, source_name):
+        """Record that a source package was added, updated or removed
+
+        :param source_name: The name of the source package
+        """
+        self._bump_generation(source_name)
+        if self._binaries_by_source is not None:
+            self._dirty_sources.add(source_name)
+
+    def source_generation(self, source_name):
+        """The number of times a source package (or one of its binaries) changed
+
+        Rolling back a change counts as a change as well, so the same
+        generation always means the same source and binaries.
+
+        :param source_name: The name of the source package
+        :return: An int, which is 0 if the source never changed
+        """
+        return self._source_generations.get(source_name, 0)
+
+    def _bump_generation(self, source_name):
+        generations = self._source_generations
+        generations[source_name] = generations.get(source_name, 0) + 1
+
+    def _source_index(self):
+        index = self._binaries_by_source
+        if index is None:
+            index = self._binaries_by_source = {}
+            for binaries_t_a in self.binaries.values():
+                for pkg in binaries_t_a.values():
+                    index.setdefault(pkg.source, {}).setdefault(pkg.source_version, set()).add(pkg.pkg_id)
+            self._dirty_sources = set(self.sources)
+            self._dirty_sources.update(index)
+            self._sources_with_cruft = set()
+            self._sources_without_binaries = set()
+        if self._dirty_sources:
+            sources_t = self.sources
+            for source_name in self._dirty_sources:
+                versions = index.get(source_name)
+                source = sources_t.get(source_name)
+                if source is not None and not versions:
+                    self._sources_without_binaries.add(source_name)
+                else:
+                    self._sources_without_binaries.discard(source_name)
+                if versions and (source is None or len(versions) > 1 or source.version not in versions):
+                    self._sources_with_cruft.add(source_name)
+                else:
+                    self._sources_with_cruft.discard(source_name)
+            self._dirty_sources.clear()
+        return index
+
+    def cruft_binaries(self):
+        """Find the binaries not built by the current version of their source
+
+        :return: An iterable of BinaryPackageId (in no particular order)
+        """
+        index = self._source_index()
+        sources_t = self.sources
+        for source_name in self._sources_with_cruft:
+            source = sources_t.get(source_name)
+            for version, pkg_ids in index[source_name].items():
+                if source is None or version != source.version:
+                    yield from pkg_ids
+
+    def sources_without_binaries(self):
+        """Find the source packages that have no binaries in the suite
+
+        :return: A set of source package names
+        """
+        self._source_index()
+        return frozenset(self._sources_without_binaries)
 
     def check_suite_source_pkg_consistency(self, comment):
         sources_t = self.sources
@@ -180,6 +317,84 @@ class TargetSuite(Suite):
                     logger.error("inconsistency found (%s): binary %s from source %s not in binaries_t[%s]" % (
                         comment, binary, src, parch))
 
+        if self._binaries_by_source is not None:
+            index = self._source_index()
+            self._binaries_by_source = None
+            if index != self._source_index():  # pragma: no cover
+                issues_found = True
+                logger.error("inconsistency found (%s): the index of binaries by source is out of date" % comment)
+
+        if issues_found:  # pragma: no cover
+            raise AssertionError("inconsistencies found in target suite")
+
+    def check_changed_source_pkg_consistency(self, comment, source_names, binary_keys):
+        """Check the consistency of some of the packages in the suite
+
+        Like check_suite_source_pkg_consistency, but only the given
+        source packages and binaries (e.g. those changed by a
+        transaction) are checked, assuming the rest of the suite is
+        consistent.
+
+        :param comment: A description of when the check is done
+        :param source_names: The names of the source packages to check
+        :param binary_keys: The binaries to check as (name, architecture)
+        tuples (binaries no longer in the suite are ignored)
+        """
+        sources_t = self.sources
+        binaries_t = self.binaries
+        logger = self._logger
+        issues_found = False
+        index = self._binaries_by_source
+        if index is not None:
+            # Bring the sources with(out) cruft up to date
+            self._source_index()
+
+        logger.info("check_target_suite_source_pkg_consistency (changes only) %s", comment)
+
+        for pkg_name, arch in binary_keys:
+            pkg = binaries_t[arch].get(pkg_name)
+            if pkg is None:
+                continue
+            src = pkg.source
+            if src not in sources_t:  # pragma: no cover
+                issues_found = True
+                logger.error("inconsistency found (%s): src %s not in target, target has pkg %s with source %s" % (
+                    comment, src, pkg_name, src))
+            if index is None:
+                continue
+            if pkg.pkg_id not in index.get(src, {}).get(pkg.source_version, ()):  # pragma: no cover
+                issues_found = True
+                logger.error("inconsistency found (%s): binary %s is not in the index of binaries by source" % (
+                    comment, pkg.pkg_id))
+
+        for src in source_names:
+            source_data = sources_t.get(src)
+            if source_data is not None:
+                for pkg_id in source_data.binaries:
+                    binary, _, parch = pkg_id
+                    if binary not in binaries_t[parch]:  # pragma: no cover
+                        issues_found = True
+                        logger.error("inconsistency found (%s): binary %s from source %s not in binaries_t[%s]" % (
+                            comment, binary, src, parch))
+            if index is None:
+                continue
+            versions = index.get(src, {})
+            for version, pkg_ids in versions.items():
+                for pkg_id in pkg_ids:
+                    pkg = binaries_t[pkg_id.architecture].get(pkg_id.package_name)
+                    if pkg is None or (pkg.pkg_id, pkg.source, pkg.source_version) != (pkg_id, src, version):  # pragma: no cover
+                        issues_found = True
+                        logger.error("inconsistency found (%s): binary %s is indexed as built by %s %s" % (
+                            comment, pkg_id, src, version))
+            without_binaries = source_data is not None and not versions
+            with_cruft = bool(versions) and (source_data is None or len(versions) > 1 or
+                                             source_data.version not in versions)
+            if (without_binaries != (src in self._sources_without_binaries) or
+                    with_cruft != (src in self._sources_with_cruft)):  # pragma: no cover
+                issues_found = True
+                logger.error("inconsistency found (%s): the index of binaries by source is out of date for %s" % (
+                    comment, src))
+
         if issues_found:  # pragma: no cover
             raise AssertionError("inconsistencies found in target suite")
 
@@ -387,7 +387,7 @@ class ExcuseFinder(object):
                 #  on a subset of all nobreak architectures).
                 # This forgivness is only done if the package is already in testing AND it is broken
                 # in testing on this architecture already.  Anything else would be a regression
-                if target_suite.is_pkg_in_the_suite(pkg_id) and not target_suite.is_installable(pkg_id):
+                if target_suite.is_pkg_in_the_suite(pkg_id) and not target_suite.is_installable_without_budget(pkg_id):
                     # It is a regression.
                     excuse.policy_verdict = PolicyVerdict.REJECTED_PERMANENTLY
 
@@ -69,12 +69,17 @@ def _compute_depends(pkgdata, bin_prov, solvers):
     depends = []
     possible_dep_ranges = {}
     for block in apt_pkg.parse_depends(pkgdata.depends, False):
-        sat = {s.pkg_id for binaries_s_a, provides_s_a in bin_prov
-               for s in solvers(block, binaries_s_a, provides_s_a)}
-
         if len(block) != 1:
-            depends.append(sat)
+            # Keep the alternatives in the declared order (without
+            # duplicates); the installability tester can use that
+            # order when it has to pick one of them.
+            sat = {s.pkg_id: None for alternative in block
+                   for binaries_s_a, provides_s_a in bin_prov
+                   for s in solvers((alternative,), binaries_s_a, provides_s_a)}
+            depends.append(tuple(sat))
         else:
+            sat = {s.pkg_id for binaries_s_a, provides_s_a in bin_prov
+                   for s in solvers(block, binaries_s_a, provides_s_a)}
             # This dependency might be a part
             # of a version-range a la:
             #
@@ -116,6 +121,7 @@ class InstallabilityTesterBuilder(object):
         self._testing = set()
         self._internmap = {}
         self._broken = set()
+        self._alternative_positions = {}
         self._empty_set = self._intern_set(frozenset())
 
     def add_binary(self, binary, essential=False, in_testing=False,
@@ -163,12 +169,20 @@ class InstallabilityTesterBuilder(object):
         :param pkg_id: BinaryPackageID determining which package will have its relations set
         :param dependency_clauses: A list/set of OR clauses (i.e. CNF with each element in
           dependency_clauses being a disjunction).  Each OR cause (disjunction) should be a
-          set/list of BinaryPackageIDs that satisfy that relation.
+          set/list of BinaryPackageIDs that satisfy that relation.  If it is a list (or
+          tuple), it is assumed to be in the declared order.
         :param breaks: An list/set of BinaryPackageIDs that has a Breaks/Conflicts relation
             on the current package.  Can be None
         :return: No return value
         """
         if dependency_clauses is not None:
+            alternative_positions = self._alternative_positions
+            for clause in dependency_clauses:
+                if len(clause) < 2 or isinstance(clause, (set, frozenset)):
+                    continue
+                for position, alternative in enumerate(clause):
+                    if alternative_positions.get(alternative, position) >= position:
+                        alternative_positions[alternative] = position
             interned_or_clauses = self._intern_set(self._intern_set(c) for c in dependency_clauses)
             satisfiable = True
             for or_clause in interned_or_clauses:
@@ -311,7 +325,8 @@ class InstallabilityTesterBuilder(object):
         universe = BinaryPackageUniverse(relations,
                                          intern_set(self._essentials),
                                          intern_set(broken),
-                                         intern_set(eqv_set))
+                                         intern_set(eqv_set),
+                                         alternative_positions=self._alternative_positions)
 
         solver = InstallabilityTester(universe, self._testing)
 
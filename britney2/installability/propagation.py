@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+"""Bulk unit propagation used to pre-compute installability
+
+Most packages can be proven installable (or uninstallable) by unit
+propagation alone: follow all dependencies that have only a single
+candidate and see whether the result is a complete, conflict-free
+installation set.  Doing this for all packages of an architecture at
+once is a lot cheaper than doing a full installability check for each
+of them.  Only the packages where propagation is inconclusive (i.e.
+a choice has to be made) need the full check.
+
+NumPy is used when it is available; otherwise a (slower) pure Python
+implementation of the same algorithm is used.
+"""
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+
+# Number of packages propagated together by the NumPy implementation.
+# Bounds the memory usage at the price of more (but cheaper) iterations.
+BATCH_SIZE = 2048
+
+
+class UnitPropagationProblem(object):
+    """Compact (CSR) encoding of the relations of an architecture
+
+    Packages are numbered 0..n-1 and each relation is stored as a pair
+    of a "pointer" list and an "index" list, so the relations of
+    package i are index[pointer[i]:pointer[i+1]].
+
+    Only packages in the suite are considered and dependency clauses
+    already satisfied by the (pseudo-)essential set are dropped.  The
+    remaining clauses are split into "forced" dependencies (a single
+    candidate) and "choices" (two or more candidates).
+    """
+
+    def __init__(self, universe, suite_contents, pkg_ids, start, bad):
+        self.pkg_ids = pkg_ids = list(pkg_ids)
+        self.index_of = index_of = {pkg_id: i for i, pkg_id in enumerate(pkg_ids)}
+        self.forced_ptr = forced_ptr = [0]
+        self.forced_idx = forced_idx = []
+        self.conflicts_ptr = conflicts_ptr = [0]
+        self.conflicts_idx = conflicts_idx = []
+        self.choices_ptr = choices_ptr = [0]
+        self.choices_idx = choices_idx = []
+        self.alternatives_ptr = alternatives_ptr = [0]
+        self.alternatives_idx = alternatives_idx = []
+        # True if the package has a dependency without any candidates
+        self.unsatisfiable = [False] * len(pkg_ids)
+        # True if the package cannot be part of a solution (e.g. it is
+        # unsatisfiable or conflicts with the essential set).
+        self.bad = [x in bad for x in pkg_ids]
+        self.in_start = [x in start for x in pkg_ids]
+
+        for pkg_id in pkg_ids:
+            relations = universe.relations_of(pkg_id)
+            for depgroup in relations.dependencies:
+                if not start.isdisjoint(depgroup):
+                    continue
+                candidates = [index_of[x] for x in depgroup if x in index_of]
+                if len(candidates) == 1:
+                    forced_idx.append(candidates[0])
+                elif candidates:
+                    choices_idx.append(len(alternatives_ptr) - 1)
+                    alternatives_idx.extend(candidates)
+                    alternatives_ptr.append(len(alternatives_idx))
+                else:
+                    self.unsatisfiable[index_of[pkg_id]] = True
+                    self.bad[index_of[pkg_id]] = True
+            conflicts_idx.extend(index_of[x] for x in relations.negative_dependencies if x in index_of)
+            forced_ptr.append(len(forced_idx))
+            conflicts_ptr.append(len(conflicts_idx))
+            choices_ptr.append(len(choices_idx))
+
+    def __len__(self):
+        return len(self.pkg_ids)
+
+
+def propagate(problem, roots, use_numpy=None):
+    """Determine the installability of roots via unit propagation
+
+    :param problem: A UnitPropagationProblem
+    :param roots: An iterable of package indices (in problem)
+    :param use_numpy: Whether to use NumPy.  Defaults to using it if
+    it is available.
+    :return: A list with an entry per root, which is True (installable),
+    False (uninstallable) or None (a choice is needed to tell).
+    """
+    roots = list(roots)
+    if use_numpy is None:
+        use_numpy = numpy is not None
+    if use_numpy and roots:
+        verdicts = []
+        for i in range(0, len(roots), BATCH_SIZE):
+            verdicts.extend(_propagate_numpy(problem, roots[i:i + BATCH_SIZE]))
+        return verdicts
+    return [_propagate_python(problem, root) for root in roots]
+
+
+def _propagate_python(problem, root):
+    forced_ptr = problem.forced_ptr
+    forced_idx = problem.forced_idx
+    bad = problem.bad
+
+    closure = {root}
+    check = [root]
+    while check:
+        cur = check.pop()
+        if bad[cur]:
+            return False
+        for dep in forced_idx[forced_ptr[cur]:forced_ptr[cur + 1]]:
+            if dep not in closure:
+                closure.add(dep)
+                check.append(dep)
+
+    conflicts_ptr = problem.conflicts_ptr
+    conflicts_idx = problem.conflicts_idx
+    for cur in closure:
+        if not closure.isdisjoint(conflicts_idx[conflicts_ptr[cur]:conflicts_ptr[cur + 1]]):
+            return False
+
+    choices_ptr = problem.choices_ptr
+    choices_idx = problem.choices_idx
+    alternatives_ptr = problem.alternatives_ptr
+    alternatives_idx = problem.alternatives_idx
+    in_start = problem.in_start
+    for cur in closure:
+        for clause in choices_idx[choices_ptr[cur]:choices_ptr[cur + 1]]:
+            alternatives = alternatives_idx[alternatives_ptr[clause]:alternatives_ptr[clause + 1]]
+            if not any(x in closure or in_start[x] for x in alternatives):
+                return None
+    return True
+
+
+def forced_closure(problem, root):
+    """The packages root pulls in via dependencies with a single candidate
+
+    :param problem: A UnitPropagationProblem
+    :param root: A package index (in problem)
+    :return: The set of package indices (including root)
+    """
+    forced_ptr = problem.forced_ptr
+    forced_idx = problem.forced_idx
+    closure = {root}
+    check = [root]
+    while check:
+        cur = check.pop()
+        for dep in forced_idx[forced_ptr[cur]:forced_ptr[cur + 1]]:
+            if dep not in closure:
+                closure.add(dep)
+                check.append(dep)
+    return closure
+
+
+def _expand(ptr, idx, nodes):
+    """Gather idx[ptr[v]:ptr[v+1]] for all v in nodes
+
+    Returns the concatenated relations and the number of relations
+    of each node (for numpy.repeat'ing per-node data).
+    """
+    begin = ptr[nodes]
+    counts = ptr[nodes + 1] - begin
+    total = int(counts.sum())
+    if not total:
+        return idx[:0], counts
+    offsets = numpy.arange(total) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    return idx[numpy.repeat(begin, counts) + offsets], counts
+
+
+def _propagate_numpy(problem, roots):
+    arrays = getattr(problem, '_numpy_arrays', None)
+    if arrays is None:
+        arrays = tuple(numpy.asarray(getattr(problem, name), dtype=dtype) for name, dtype in (
+            ('forced_ptr', numpy.int64), ('forced_idx', numpy.int64),
+            ('conflicts_ptr', numpy.int64), ('conflicts_idx', numpy.int64),
+            ('choices_ptr', numpy.int64), ('choices_idx', numpy.int64),
+            ('alternatives_ptr', numpy.int64), ('alternatives_idx', numpy.int64),
+            ('bad', numpy.bool_), ('in_start', numpy.bool_),
+        ))
+        problem._numpy_arrays = arrays
+    (forced_ptr, forced_idx, conflicts_ptr, conflicts_idx, choices_ptr, choices_idx,
+     alternatives_ptr, alternatives_idx, bad, in_start) = arrays
+
+    # The closure of all roots is stored as one sorted array of
+    # "root number * n + package index" keys.
+    n = len(problem)
+    batch = len(roots)
+    frontier = numpy.arange(batch, dtype=numpy.int64) * n + numpy.asarray(roots, dtype=numpy.int64)
+    closure = frontier
+    while frontier.size:
+        deps, counts = _expand(forced_ptr, forced_idx, frontier % n)
+        keys = numpy.unique(numpy.repeat(frontier // n, counts) * n + deps)
+        frontier = keys[~numpy.isin(keys, closure, assume_unique=True)]
+        closure = numpy.union1d(closure, frontier)
+
+    members = closure % n
+    owners = closure // n
+    uninstallable = numpy.zeros(batch, dtype=numpy.bool_)
+    undetermined = numpy.zeros(batch, dtype=numpy.bool_)
+
+    uninstallable[owners[bad[members]]] = True
+
+    conflicts, counts = _expand(conflicts_ptr, conflicts_idx, members)
+    conflict_owners = numpy.repeat(owners, counts)
+    hits = numpy.isin(conflict_owners * n + conflicts, closure, assume_unique=False)
+    uninstallable[conflict_owners[hits]] = True
+
+    clauses, counts = _expand(choices_ptr, choices_idx, members)
+    if clauses.size:
+        clause_owners = numpy.repeat(owners, counts)
+        alternatives, counts = _expand(alternatives_ptr, alternatives_idx, clauses)
+        alternative_owners = numpy.repeat(clause_owners, counts)
+        satisfied = in_start[alternatives] | numpy.isin(alternative_owners * n + alternatives, closure)
+        # Every clause has at least two alternatives, so no segment is empty
+        clause_satisfied = numpy.logical_or.reduceat(satisfied, numpy.cumsum(counts) - counts)
+        undetermined[clause_owners[~clause_satisfied]] = True
+
+    return [False if u else (None if d else True) for u, d in zip(uninstallable.tolist(), undetermined.tolist())]
@@ -15,11 +15,77 @@
 from collections import defaultdict
 from functools import partial
 import logging
+import multiprocessing
+import time
 from itertools import chain, filterfalse
 
+from britney2.installability.propagation import UnitPropagationProblem, forced_closure, propagate
 from britney2.utils import iter_except
 
 
+# Heuristics that can be used to order choices and their alternatives
+# in resolve_choices (see InstallabilityTester.set_choice_order):
+#  * smallest-first: Resolve the choice with the fewest alternatives first
+#  * cached-first: Try alternatives known to be installable first
+#  * essential-first: Try essential packages first
+#  * declared-order: Try alternatives listed early in Depends first
+CHOICE_ORDER_HEURISTICS = ('smallest-first', 'cached-first', 'essential-first', 'declared-order')
+
+
+# Marks a missing entry of a cache in the journal of a TesterLayer
+_MISSING = object()
+
+
+def _restore_entry(cache, key, value):
+    if value is _MISSING:
+        cache.pop(key, None)
+    else:
+        cache[key] = value
+
+
+# The caches are journaled by name rather than by object, as they may
+# be replaced (see InstallabilityTester._replace)
+def _cache_update(tester, name, pkg_ids):
+    getattr(tester, name).update(pkg_ids)
+
+
+def _cache_difference_update(tester, name, pkg_ids):
+    getattr(tester, name).difference_update(pkg_ids)
+
+
+# The tester used by _compute_installability_worker.  It is set in the
+# parent process right before the workers are forked, so each worker
+# sees a (copy-on-write) snapshot of it without having to pickle it.
+_forked_tester = None
+
+
+def _compute_installability_worker(arch, pkg_ids):
+    tester = _forked_tester
+    tester._stats = InstallabilityStats()
+    if tester._cost_accounting is not None:
+        tester._cost_accounting.reset()
+    tester._compute_installability_of(pkg_ids)
+
+    def _only_arch(pkgs):
+        return frozenset(x for x in pkgs if x.architecture == arch)
+
+    def _only_arch_keys(table):
+        return {k: v for k, v in table.items() if k.architecture == arch}
+
+    return (_only_arch(tester._cache_inst),
+            _only_arch(tester._cache_broken),
+            tester._cache_ess.get(arch),
+            _only_arch(tester._cache_uninst),
+            _only_arch_keys(tester._uninst_support),
+            _only_arch_keys(tester._uninst_support_keys),
+            tester._learned_nogoods.get(arch),
+            _only_arch_keys(tester._nogood_support),
+            _only_arch_keys(tester._nogood_support_keys),
+            _only_arch_keys(tester._explanations),
+            tester._stats.__dict__,
+            tester._cost_accounting.costs if tester._cost_accounting is not None else None)
+
+
 class InstallabilityTester(object):
 
     def __init__(self, universe, suite_contents):
@@ -57,39 +123,431 @@ class InstallabilityTester(object):
         # original-awk) unless something in this sets depends strictly
         # on one of them
         self._cache_ess = {}
+        # Per "arch" set of learned (unit) nogoods; packages that we
+        # have proven to be uninstallable on their own.  They are
+        # valid for as long as the "pseudo-essential" set of the
+        # architecture and the packages in their "support" (see
+        # _learn_unit_nogood) are unchanged.
+        self._learned_nogoods = {}
+        # Maps a package id to the nogoods that it could invalidate
+        # by being added to the suite and (the other way around) a
+        # nogood to these package ids (see _add_support).  It can
+        # contain stale entries; they only cause a nogood to be
+        # forgotten too eagerly.
+        self._nogood_support = defaultdict(set)
+        self._nogood_support_keys = defaultdict(set)
+        # Cache of packages known to be uninstallable in the current
+        # suite (but which are not known to be broken).  Like the
+        # nogoods, a verdict remains valid until a package in its
+        # "support" is added to the suite (see _cache_uninstallable).
+        self._cache_uninst = set()
+        # Maps a package id to the entries in _cache_uninst that it could
+        # invalidate by being added to the suite and the other way around
+        # (like _nogood_support).  It can contain stale entries.
+        self._uninst_support = defaultdict(set)
+        self._uninst_support_keys = defaultdict(set)
+        # Heuristics for ordering choices and alternatives (in order of
+        # priority).  See set_choice_order.
+        self._choice_order = ()
+        # Maximum number of search steps (alternatives tried) per query
+        # or None for no limit.  When a query exceeds it, its verdict is
+        # "undetermined" (None).
+        self.solver_budget = None
+        # Per package cost accounting (see enable_cost_accounting)
+        self._cost_accounting = None
+        # Deepest stack of restore points in the latest search
+        self._search_depth = 0
+        # Whether to record why packages are uninstallable (see
+        # is_installable).  Recording is cheap as it only happens when
+        # a search fails.
+        self.record_explanations = False
+        # Maps a package id to an UninstallabilityExplanation.  Entries
+        # can be stale, but they are only used while the package is
+        # known to be uninstallable.
+        self._explanations = {}
+        # The reason for the latest failure in _check_loop (or the
+        # choice pruning in _search) as a (kind, pkg_id, relation) tuple
+        self._failure = None
+        # Stack of TesterLayers (see begin_layer)
+        self._layers = []
+
+    def begin_layer(self):
+        """Start a new layer of changes to the suite
+
+        All changes to the suite (and the caches) from now on can be
+        undone by rollback_layer, which restores the suite and the
+        caches exactly as they were when the layer was started.  This
+        means that a rolled back change does not cause any cache
+        invalidations.  Alternatively, commit_layer keeps the changes
+        (as part of the parent layer if there is one).
+
+        Layers can be nested.
+        """
+        # Nothing is copied; the changes to the suite and the caches
+        # are journaled instead (see _journal).
+        self._layers.append(TesterLayer())
+
+    def commit_layer(self):
+        """Keep the changes of the current layer
+
+        The changes become part of the parent layer (if any), so they
+        can still be rolled back with it.
+        """
+        layer = self._layers.pop()
+        if self._layers:
+            parent = self._layers[-1]
+            parent.suite_changes.extend(layer.suite_changes)
+            parent.support_pops.extend(layer.support_pops)
+            parent.support_removals.extend(layer.support_removals)
+            parent.supported.extend(layer.supported)
+            redundant = layer.replaced & parent.replaced
+            if redundant:
+                # The parent already restores these caches to what they
+                # were before it was started
+                parent.journal.extend(x for x in layer.journal
+                                      if x[0] is not setattr or x[1][1] not in redundant)
+            else:
+                parent.journal.extend(layer.journal)
+            parent.replaced |= layer.replaced
 
-    def compute_installability(self):
+    def rollback_layer(self):
+        """Undo all changes done in the current layer"""
+        layer = self._layers.pop()
+        suite_contents = self._suite_contents
+        # Packages known to be broken are not in _suite_contents, so
+        # include them again before undoing the changes.
+        suite_contents |= self._cache_broken
+        for added, pkg_id in reversed(layer.suite_changes):
+            if added:
+                suite_contents.discard(pkg_id)
+            else:
+                suite_contents.add(pkg_id)
+        for undo, args in reversed(layer.journal):
+            undo(*args)
+        suite_contents -= self._cache_broken
+        for support_name, pkg_id, entries in layer.support_pops:
+            getattr(self, support_name)[pkg_id].update(entries)
+        for support_name, keys_name, pkg_id, keys in layer.support_removals:
+            self._add_support(support_name, keys_name, pkg_id, keys, journal=False)
+        # Forget the support of the verdicts learned in the layer, so the
+        # support index does not keep growing with every rolled back trial.
+        for support_name, keys_name, pkg_id in layer.supported:
+            if not self._has_verdict(support_name, pkg_id):
+                self._remove_support(support_name, keys_name, pkg_id, journal=False)
+
+    def _journal(self, undo, *args):
+        # Record how to undo a change to a cache (undo(*args)), so
+        # rollback_layer can replay it
+        if self._layers:
+            self._layers[-1].journal.append((undo, args))
+
+    def _replace(self, name, value):
+        # Only the value from before the first replacement in a layer is
+        # needed to roll it back.  The later ones are created in the
+        # layer, so they are not kept alive by the journal.
+        if self._layers:
+            layer = self._layers[-1]
+            if name not in layer.replaced:
+                layer.replaced.add(name)
+                layer.journal.append((setattr, (self, name, getattr(self, name))))
+        setattr(self, name, value)
+
+    def _add_to_cache(self, name, pkg_ids):
+        cache = getattr(self, name)
+        if self._layers:
+            added = [x for x in pkg_ids if x not in cache]
+            if added:
+                cache.update(added)
+                self._journal(_cache_difference_update, self, name, added)
+        else:
+            cache.update(pkg_ids)
+
+    def _remove_from_cache(self, name, pkg_ids):
+        cache = getattr(self, name)
+        removed = [x for x in pkg_ids if x in cache]
+        if removed:
+            cache.difference_update(removed)
+            self._journal(_cache_update, self, name, removed)
+
+    def _set_cache_entry(self, name, key, value):
+        cache = getattr(self, name)
+        if self._layers:
+            self._journal(_restore_entry, cache, key, cache.get(key, _MISSING))
+        cache[key] = value
+
+    def _pop_cache_entry(self, name, key):
+        cache = getattr(self, name)
+        value = cache.pop(key, _MISSING)
+        if value is _MISSING:
+            return None
+        self._journal(_restore_entry, cache, key, value)
+        return value
+
+    def _add_nogood(self, pkg_id):
+        nogoods = self._learned_nogoods.get(pkg_id.architecture)
+        if nogoods is None:
+            nogoods = set()
+            self._set_cache_entry('_learned_nogoods', pkg_id.architecture, nogoods)
+        if pkg_id not in nogoods:
+            nogoods.add(pkg_id)
+            self._journal(nogoods.discard, pkg_id)
+
+    def _record_suite_change(self, added, pkg_id):
+        if self._layers:
+            self._layers[-1].suite_changes.append((added, pkg_id))
+
+    def _record_support_pop(self, support_name, pkg_id, entries):
+        if self._layers and entries:
+            self._layers[-1].support_pops.append((support_name, pkg_id, entries))
+
+    def _add_support(self, support_name, keys_name, pkg_id, keys, journal=True):
+        # Record that the verdict (e.g. nogood) pkg_id remains valid until
+        # one of keys is added to the suite
+        support = getattr(self, support_name)
+        for key in keys:
+            support[key].add(pkg_id)
+        getattr(self, keys_name)[pkg_id].update(keys)
+        if journal and self._layers:
+            self._layers[-1].supported.append((support_name, keys_name, pkg_id))
+
+    def _remove_support(self, support_name, keys_name, pkg_id, journal=True):
+        # Remove the entries of a verdict that is being dropped from the
+        # support index
+        keys = getattr(self, keys_name).pop(pkg_id, None)
+        if keys is None:
+            return
+        if journal and self._layers:
+            self._layers[-1].support_removals.append((support_name, keys_name, pkg_id, keys))
+        support = getattr(self, support_name)
+        for key in keys:
+            entries = support.get(key)
+            if entries is not None and pkg_id in entries:
+                entries.discard(pkg_id)
+                if not entries:
+                    del support[key]
+
+    def _has_verdict(self, support_name, pkg_id):
+        if support_name == '_nogood_support':
+            return pkg_id in self._learned_nogoods.get(pkg_id.architecture, ())
+        return pkg_id in self._cache_uninst
+
+    def compute_installability(self, workers=1):
         """Computes the installability of all the packages in the suite
 
         This method computes the installability of all packages in
         the suite and caches the result.  This has the advantage of
         making "is_installable" queries very fast for all packages
         in the suite.
+
+        :param workers: If larger than 1, the architectures are split
+        between up to this many forked worker processes and their
+        results are merged back into the caches afterwards.  This is
+        possible because no relation crosses an architecture boundary.
+        Falls back to computing everything in this process if there is
+        only one architecture or the platform cannot fork.
         """
 
+        if workers > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            pkgs_by_arch = defaultdict(list)
+            for pkg_id in self._suite_contents:
+                pkgs_by_arch[pkg_id.architecture].append(pkg_id)
+            if len(pkgs_by_arch) > 1:
+                self._compute_installability_forked(pkgs_by_arch, workers)
+                return
+        self._compute_installability_of([x for x in self._suite_contents])
+
+    def _compute_installability_forked(self, pkgs_by_arch, workers):
+        global _forked_tester
+        stats = self._stats
+        context = multiprocessing.get_context('fork')
+        _forked_tester = self
+        try:
+            with context.Pool(min(workers, len(pkgs_by_arch))) as pool:
+                results = pool.starmap(_compute_installability_worker,
+                                       pkgs_by_arch.items(),
+                                       chunksize=1)
+        finally:
+            _forked_tester = None
+
+        for arch, result in zip(pkgs_by_arch, results):
+            (installable, broken, ess, uninst, uninst_support, uninst_support_keys, nogoods, nogood_support,
+             nogood_support_keys, explanations, worker_stats, costs) = result
+            self._add_to_cache('_cache_inst', installable)
+            self._add_to_cache('_cache_broken', broken)
+            self._suite_contents -= broken
+            if ess is not None:
+                self._set_cache_entry('_cache_ess', arch, ess)
+            # Relations never cross an architecture boundary, so the
+            # support sets of the workers can simply be merged.
+            self._add_to_cache('_cache_uninst', uninst)
+            for pkg_id, supported in uninst_support.items():
+                self._uninst_support[pkg_id] |= supported
+            for pkg_id, keys in uninst_support_keys.items():
+                self._uninst_support_keys[pkg_id] |= keys
+            for nogood in nogoods or ():
+                self._add_nogood(nogood)
+            for pkg_id, supported in nogood_support.items():
+                self._nogood_support[pkg_id] |= supported
+            for pkg_id, keys in nogood_support_keys.items():
+                self._nogood_support_keys[pkg_id] |= keys
+            for pkg_id, explanation in explanations.items():
+                self._set_cache_entry('_explanations', pkg_id, explanation)
+            for counter, value in worker_stats.items():
+                setattr(stats, counter, getattr(stats, counter) + value)
+            if costs:
+                self._cost_accounting.merge(costs)
+
+    def _compute_installability_of(self, tcopy, prepass=True):
         universe = self._universe
         check_inst = self._check_inst
         cbroken = self._cache_broken
         cache_inst = self._cache_inst
         suite_contents = self._suite_contents
-        tcopy = [x for x in suite_contents]
+        deferred = []
+        # Packages proven uninstallable by the pre-pass
+        uninstallable = self._unit_propagation_prepass(tcopy) if prepass else frozenset()
         for t in filterfalse(cache_inst.__contains__, tcopy):
             if t in cbroken:
                 continue
-            res = check_inst(t)
+            res = check_inst(t) if t not in uninstallable else False
+            if res is None:
+                # Exceeded the solver budget; do a full search for these
+                # after everything else.
+                deferred.append(t)
+                continue
             if t in universe.equivalent_packages:
                 eqv = (x for x in universe.packages_equivalent_to(t) if x in suite_contents)
                 if res:
-                    cache_inst.update(eqv)
+                    self._add_to_cache('_cache_inst', eqv)
                 else:
                     eqv_set = frozenset(eqv)
                     suite_contents -= eqv_set
-                    cbroken |= eqv_set
+                    self._add_to_cache('_cache_broken', eqv_set)
+
+        if deferred:
+            self.logger.info("Computing the installability of %d package(s) without a solver budget",
+                             len(deferred))
+            solver_budget = self.solver_budget
+            self.solver_budget = None
+            try:
+                self._compute_installability_of(deferred, prepass=False)
+            finally:
+                self.solver_budget = solver_budget
+
+    def _unit_propagation_prepass(self, pkg_ids):
+        """Determine the installability of pkg_ids via unit propagation
+
+        Packages proven installable are added to the cache.  Packages
+        where propagation is inconclusive are left for _check_inst.
+
+        Returns the set of packages proven uninstallable.  These are
+        cached as broken in the cases where _check_inst would have done
+        so and in the negative cache otherwise.
+        """
+        universe = self._universe
+        suite_contents = self._suite_contents
+        cache_inst = self._cache_inst
+        stats = self._stats
+        uninstallable = set()
+        roots_by_arch = defaultdict(list)
+
+        for pkg_id in pkg_ids:
+            if pkg_id in suite_contents and pkg_id not in cache_inst and pkg_id not in universe.broken_packages:
+                roots_by_arch[pkg_id.architecture].append(pkg_id)
+
+        for arch, roots in roots_by_arch.items():
+            (start, ess_never, ess_choices) = self._get_min_pseudo_ess_set(arch)
+            if ess_choices or not start.isdisjoint(ess_never) or not start <= suite_contents:
+                # The essential set is not a solution on its own, so we
+                # cannot use it as a base.  Leave everything to _check_inst.
+                continue
+            bad = ess_never.union(self._learned_nogoods.get(arch, ()))
+            problem = UnitPropagationProblem(universe, suite_contents,
+                                             (x for x in suite_contents if x.architecture == arch),
+                                             start, bad)
+            index_of = problem.index_of
+            verdicts = propagate(problem, (index_of[x] for x in roots))
+            installable = []
+            for t, verdict in zip(roots, verdicts):
+                if verdict:
+                    installable.append(t)
+                    stats.prepass_installable += 1
+                elif verdict is not None:
+                    stats.prepass_uninstallable += 1
+                    uninstallable.add(t)
+                    if t in ess_never:
+                        stats.conflicts_essential += 1
+                    elif not problem.unsatisfiable[index_of[t]]:
+                        # The verdict only depends on the packages that t
+                        # pulls in, like the ones _search caches.
+                        pkg_ids = problem.pkg_ids
+                        visited = {pkg_ids[x] for x in forced_closure(problem, index_of[t])}
+                        self._cache_uninstallable(t, visited, start)
+                        # Explained on demand (see is_installable)
+                        self._pop_cache_entry('_explanations', t)
+                        continue
+                    self._add_to_cache('_cache_broken', (t,))
+                    suite_contents.remove(t)
+            self._add_to_cache('_cache_inst', installable)
+
+        return uninstallable
 
     @property
     def stats(self):
         return self._stats
 
+    @property
+    def cost_accounting(self):
+        """The PackageCostAccounting of this tester (or None if disabled)"""
+        return self._cost_accounting
+
+    def enable_cost_accounting(self, sample_rate=1):
+        """Enable per package accounting of the cost of installability checks
+
+        :param sample_rate: Only account every sample_rate-th check that
+        reaches the solver.  Higher values reduce the overhead (making
+        it usable for every run) at the price of precision.
+        """
+        self._cost_accounting = PackageCostAccounting(sample_rate)
+
+    def set_choice_order(self, heuristics):
+        """Configure how choices and their alternatives are ordered
+
+        When the tester has to guess, it will resolve choices and try
+        their alternatives in the order determined by these heuristics.
+        The least preferred alternative is tried last (without a restore
+        point).  Ties are broken by package id, so the order is
+        deterministic as soon as any heuristic is enabled.  Without any
+        heuristics, the (arbitrary) iteration order of the sets is used.
+
+        :param heuristics: A sequence of names from CHOICE_ORDER_HEURISTICS.
+        Earlier names take priority over later ones.
+        """
+        heuristics = tuple(heuristics)
+        unknown = [x for x in heuristics if x not in CHOICE_ORDER_HEURISTICS]
+        if unknown:
+            raise ValueError("Unknown choice order heuristic(s): %s" % ", ".join(unknown))
+        self._choice_order = heuristics
+
+    def _alternative_sort_key(self):
+        universe = self._universe
+        cache_inst = self._cache_inst
+        essential_packages = universe.essential_packages
+        alternative_position_of = universe.alternative_position_of
+        key_parts = []
+        for heuristic in self._choice_order:
+            if heuristic == 'cached-first':
+                key_parts.append(lambda p: p not in cache_inst)
+            elif heuristic == 'essential-first':
+                key_parts.append(lambda p: p not in essential_packages)
+            elif heuristic == 'declared-order':
+                key_parts.append(alternative_position_of)
+
+        def _key(p):
+            return tuple(f(p) for f in key_parts) + (p,)
+
+        return _key
+
     def any_of_these_are_in_the_suite(self, pkgs):
         """Test if at least one package of a given set is in the suite
 
@@ -114,6 +572,28 @@ class InstallabilityTester(object):
         """
         yield from (x for x in pkgs if x in self._suite_contents)
 
+    @property
+    def known_broken_packages(self):
+        """The packages of the suite that are known to be uninstallable
+
+        These are not considered to be in the suite until the next
+        time a package is added to the suite (see add_binary).
+        """
+        return frozenset(self._cache_broken)
+
+    def mark_known_broken(self, pkg_ids):
+        """Mark packages of the suite as known to be uninstallable
+
+        Restores known_broken_packages (e.g. when resuming a run), as
+        it affects which packages are considered to be in the suite.
+
+        :param pkg_ids: An iterable of package ids.  Packages that are
+        not in the suite are ignored.
+        """
+        broken = self._suite_contents.intersection(pkg_ids)
+        self._suite_contents -= broken
+        self._add_to_cache('_cache_broken', broken)
+
     def add_binary(self, pkg_id):
         """Add a binary package to the suite
 
@@ -126,21 +606,28 @@ class InstallabilityTester(object):
         if pkg_id not in self._universe:  # pragma: no cover
             raise KeyError(str(pkg_id))
 
+        if pkg_id not in self._suite_contents and pkg_id not in self._cache_broken:
+            self._record_suite_change(True, pkg_id)
+
         if pkg_id in self._universe.broken_packages:
             self._suite_contents.add(pkg_id)
         elif pkg_id not in self._suite_contents:
             self._suite_contents.add(pkg_id)
             if self._cache_inst:
                 self._stats.cache_drops += 1
-            self._cache_inst = set()
+            self._replace('_cache_inst', set())
+            self._invalidate_nogoods_supported_by((pkg_id,))
+            self._invalidate_uninst_supported_by((pkg_id,))
             if self._cache_broken:
                 # Re-add broken packages as some of them may now be installable
                 self._suite_contents |= self._cache_broken
-                self._cache_broken = set()
+                self._invalidate_nogoods_supported_by(self._cache_broken)
+                self._invalidate_uninst_supported_by(self._cache_broken)
+                self._replace('_cache_broken', set())
             if pkg_id in self._universe.essential_packages and pkg_id.architecture in self._cache_ess:
                 # Adds new essential => "pseudo-essential" set needs to be
                 # recomputed
-                del self._cache_ess[pkg_id.architecture]
+                self._drop_pseudo_ess_set(pkg_id.architecture)
 
         return True
 
@@ -155,35 +642,63 @@ class InstallabilityTester(object):
         if pkg_id not in self._universe:  # pragma: no cover
             raise KeyError(str(pkg_id))
 
-        self._cache_broken.discard(pkg_id)
+        if pkg_id in self._suite_contents or pkg_id in self._cache_broken:
+            self._record_suite_change(False, pkg_id)
+
+        self._remove_from_cache('_cache_broken', (pkg_id,))
 
         if pkg_id in self._suite_contents:
             self._suite_contents.remove(pkg_id)
             if pkg_id.architecture in self._cache_ess and pkg_id in self._cache_ess[pkg_id.architecture][0]:
                 # Removes a package from the "pseudo-essential set"
-                del self._cache_ess[pkg_id.architecture]
+                self._drop_pseudo_ess_set(pkg_id.architecture)
 
             if not self._universe.reverse_dependencies_of(pkg_id):
                 # no reverse relations - safe
                 return True
             if pkg_id not in self._universe.broken_packages and pkg_id in self._cache_inst:
                 # It is in our cache (and not guaranteed to be broken) - throw out the cache
-                self._cache_inst = set()
+                self._replace('_cache_inst', set())
                 self._stats.cache_drops += 1
 
         return True
 
-    def is_installable(self, pkg_id):
+    def is_installable_without_budget(self, pkg_id):
+        """Test if a package is installable, regardless of the solver budget
+
+        Like is_installable, except that it never gives up (so it returns
+        either True or False).
+        """
+        solver_budget = self.solver_budget
+        self.solver_budget = None
+        try:
+            return self.is_installable(pkg_id)
+        finally:
+            self.solver_budget = solver_budget
+
+    def is_installable(self, pkg_id, explain=False):
         """Test if a package is installable in this package set
 
         The package is assumed to be in the suite and only packages in
         the suite can be used to satisfy relations.
 
         :param pkg_id The id of the package
+        :param explain If True, a tuple of the result (as described
+        below) and an UninstallabilityExplanation is returned instead.
+        The explanation is None unless the result is False.  It is
+        only available if the failing search was done while
+        record_explanations was enabled.  Cached results are explained
+        without solving again.
         Returns True iff the package is installable.
+        Returns None if the installability could not be determined
+        within the solver budget (see solver_budget).
         Returns False otherwise.
         """
 
+        if explain:
+            verdict = self.is_installable(pkg_id)
+            return verdict, (self._explanation_of(pkg_id) if verdict is False else None)
+
         self._stats.is_installable_calls += 1
 
         if pkg_id not in self._universe:  # pragma: no cover
@@ -197,59 +712,97 @@ class InstallabilityTester(object):
             self._stats.cache_hits += 1
             return True
 
+        # Verdicts of the unit propagation pre-pass are cached without
+        # an explanation, so search again if one is needed.
+        if pkg_id in self._cache_uninst and (not self.record_explanations or pkg_id in self._explanations):
+            self._stats.cache_hits += 1
+            self._stats.negative_cache_hits += 1
+            return False
+
         self._stats.cache_misses += 1
         return self._check_inst(pkg_id)
 
-    def _check_inst(self, t, musts=None, never=None, choices=None):
+    def _check_inst(self, t):
+        accounting = self._cost_accounting
+        if accounting is None or not accounting.sample():
+            return self._search(t)
+
+        stats = self._stats
+        restore_points_created = stats.backtrace_restore_point_created
+        restore_points_used = stats.backtrace_restore_point_used
+        self._search_depth = 0
+        started = time.perf_counter()
+        verdict = self._search(t)
+        accounting.record(t, time.perf_counter() - started,
+                          stats.backtrace_restore_point_created - restore_points_created,
+                          stats.backtrace_restore_point_used - restore_points_used,
+                          self._search_depth)
+        return verdict
+
+    def _search(self, t):
         # See the explanation of musts, never and choices below.
         stats = self._stats
         universe = self._universe
         suite_contents = self._suite_contents
         cbroken = self._cache_broken
 
-        # Our installability verdict - start with "yes" and change if
-        # prove otherwise.
-        verdict = True
-
         # set of packages that must be installed with this package
-        if musts is None:
-            musts = set()
-        musts.add(t)
+        musts = {t}
         # set of packages we can *never* choose (e.g. due to conflicts)
-        if never is None:
-            never = set()
+        never = set()
         # set of relations were we have a choice, but where we have not
         # committed ourselves yet.  Hopefully some choices may be taken
         # for us (if one of the alternatives appear in "musts")
-        if choices is None:
-            choices = set()
+        choices = set()
 
         # The subset of musts we haven't checked yet.
         check = [t]
 
-        if len(musts) == 1:
-            # Include the essential packages in the suite as a starting point.
-            if t.architecture not in self._cache_ess:
-                # The minimal essential set cache is not present -
-                # compute it now.
-                (start, ess_never, ess_choices) = self._get_min_pseudo_ess_set(t.architecture)
-            else:
-                (start, ess_never, ess_choices) = self._cache_ess[t.architecture]
-
-            if t in ess_never:
-                # t conflicts with something in the essential set or the essential
-                # set conflicts with t - either way, t is f***ed
-                cbroken.add(t)
-                suite_contents.remove(t)
-                stats.conflicts_essential += 1
+        # Include the essential packages in the suite as a starting point.
+        if t.architecture not in self._cache_ess:
+            # The minimal essential set cache is not present -
+            # compute it now.
+            (start, ess_never, ess_choices) = self._get_min_pseudo_ess_set(t.architecture)
+        else:
+            (start, ess_never, ess_choices) = self._cache_ess[t.architecture]
+
+        if t in ess_never:
+            # t conflicts with something in the essential set or the essential
+            # set conflicts with t - either way, t is f***ed
+            self._add_to_cache('_cache_broken', (t,))
+            suite_contents.remove(t)
+            stats.conflicts_essential += 1
+            return False
+        nogoods = self._learned_nogoods.get(t.architecture)
+        if nogoods:
+            if t in nogoods:
+                stats.nogoods_used += 1
+                stats.solved_uninstallable += 1
                 return False
-            musts.update(start)
-            never.update(ess_never)
-            choices.update(ess_choices)
-
-        # curry check_loop
-        check_loop = partial(self._check_loop, universe, suite_contents,
-                             stats, musts, never, cbroken)
+            # None of the learned nogoods can be part of a solution,
+            # so treat them as conflicts from the start.
+            never.update(nogoods)
+        musts.update(start)
+        never.update(ess_never)
+        choices.update(ess_choices)
+
+        solver_budget = self.solver_budget
+        steps = 0
+        max_depth = 0
+        failure = None
+
+        # Stack of restore points (see resolve_choices) and the trails
+        # of packages added to musts and never since the oldest one
+        # (plus the (added, choice) changes to choices).  Backtracking
+        # to a restore point undoes the trail entries after its marks
+        # rather than restoring copies of musts, never and choices.
+        restore_points = []
+        musts_trail = []
+        never_trail = []
+        choices_trail = []
+        # Packages removed from musts again when undoing a guess.  Their
+        # dependencies are part of the reason if t is uninstallable.
+        undone = set()
 
         # Useful things to remember:
         #
@@ -266,108 +819,263 @@ class InstallabilityTester(object):
         #
         # * A package is installable if never and musts are disjointed
         #   and both check and choices are empty.
-        #   - exception: resolve_choices may determine the installability
-        #     of t via recursion (calls _check_inst).  In this case
-        #     check and choices are not (always) empty.
-
-        def _prune_choices(rebuild, len=len):
-            """Picks a choice from choices and updates rebuild.
 
-            Prunes the choices and updates "rebuild" to reflect the
-            pruned choices.
+        def _prune_choices(trail, choices_trail, len=len):
+            """Prunes the choices (in place)
 
-            Returns True if t is installable (determined via recursion).
-            Returns False if a choice was picked and added to check.
-            Returns None if t is uninstallable (no choice can be picked).
+            Returns True if the choices were pruned.
+            Returns False if t is uninstallable (no choice can be picked).
 
-            NB: If this returns False, choices should be replaced by
-            rebuild.
+            If choices_trail is not None, the changes to choices are
+            appended to it as (added, choice) tuples.
             """
 
-            # We already satisfied/chosen at least one of the literals
-            # in the choice, so the choice is gone
-            for choice in filter(musts.isdisjoint, choices):
-                # cbroken is needed here because (in theory) it could
-                # have changed since the choice was discovered and it
-                # is smaller than suite_contents (so presumably faster)
-                remain = choice - never - cbroken
-
-                if len(remain) == 1:
-                    # the choice was reduced to one package we haven't checked - check that
-                    check.extend(remain)
-                    musts.update(remain)
-                    stats.choice_presolved += 1
-                    continue
-
-                if not remain:
-                    # all alternatives would violate the conflicts or are uninstallable
-                    # => package is not installable
-                    stats.choice_presolved += 1
-                    return False
+            for choice in list(choices):
+                if not musts.isdisjoint(choice):
+                    # We already satisfied/chosen at least one of the
+                    # literals in the choice, so the choice is gone
+                    remain = None
+                else:
+                    # cbroken is needed here because (in theory) it could
+                    # have changed since the choice was discovered and it
+                    # is smaller than suite_contents (so presumably faster)
+                    remain = choice - never - cbroken
+
+                    if len(remain) == 1:
+                        # the choice was reduced to one package we haven't checked - check that
+                        check.extend(remain)
+                        musts.update(remain)
+                        if trail is not None:
+                            trail.extend(remain)
+                        stats.choice_presolved += 1
+                        remain = None
+                    elif not remain:
+                        # all alternatives would violate the conflicts or are uninstallable
+                        # => package is not installable
+                        stats.choice_presolved += 1
+                        self._failure = ('unsatisfiable', None, choice)
+                        return False
+                    elif len(remain) == len(choice):
+                        # The choice is still deferred
+                        continue
+                    else:
+                        # The choice is still deferred (but smaller)
+                        remain = frozenset(remain)
 
-                # The choice is still deferred
-                rebuild.add(frozenset(remain))
+                choices.remove(choice)
+                if choices_trail is not None:
+                    choices_trail.append((False, choice))
+                if remain is not None and remain not in choices:
+                    choices.add(remain)
+                    if choices_trail is not None:
+                        choices_trail.append((True, remain))
 
             return True
 
         # END _prune_choices
 
-        while check:
-            if not check_loop(choices, check):
-                verdict = False
-                break
-
-            if choices:
-                rebuild = set()
-
-                if not _prune_choices(rebuild):
+        while True:
+            verdict = True
+            if restore_points:
+                trails = (musts_trail, never_trail, choices_trail)
+            else:
+                # Nothing to undo to, so there is no point in recording
+                # anything.
+                trails = (None, None, None)
+
+            while check:
+                if not self._check_loop(universe, suite_contents, stats,
+                                        musts, never, cbroken, choices,
+                                        check, *trails):
                     verdict = False
+                    failure = self._failure
                     break
 
-                if not check and rebuild:
-                    # We have to "guess" now, which is always fun, but not cheap. We
-                    # stop guessing:
-                    # - once we run out of choices to make (obviously), OR
-                    # - if one of the choices exhaust all but one option
-                    if self.resolve_choices(check, musts, never, rebuild):
-                        # The recursive call have already updated the
-                        # cache so there is not point in doing it again.
-                        return True
-                choices = rebuild
+                if choices:
+                    if not _prune_choices(trails[0], trails[2]):
+                        verdict = False
+                        failure = self._failure
+                        break
+
+                    if not check and choices:
+                        # We have to "guess" now, which is always fun, but not cheap. We
+                        # stop guessing:
+                        # - once we run out of choices to make (obviously), OR
+                        # - if one of the choices exhaust all but one option
+                        steps += self.resolve_choices(check, musts, never, choices,
+                                                      restore_points, musts_trail,
+                                                      never_trail, choices_trail, undone)
+                        if len(restore_points) > max_depth:
+                            max_depth = len(restore_points)
+                        if solver_budget is not None and steps > solver_budget:
+                            self._search_depth = max_depth
+                            return self._solver_budget_exhausted(t, steps)
+                        if restore_points:
+                            trails = (musts_trail, never_trail, choices_trail)
+
+            if verdict or not restore_points:
+                break
 
+            # The current guess failed, backtrack to the latest restore
+            # point.
+            stats.solved_uninstallable += 1
+            (musts_mark, never_mark, choices_mark, p, choice, last) = restore_points.pop()
+            undone.update(musts_trail[musts_mark:])
+            musts.difference_update(musts_trail[musts_mark:])
+            del musts_trail[musts_mark:]
+            never.difference_update(never_trail[never_mark:])
+            del never_trail[never_mark:]
+            for added, undo_choice in reversed(choices_trail[choices_mark:]):
+                if added:
+                    choices.remove(undo_choice)
+                else:
+                    choices.add(undo_choice)
+            del choices_trail[choices_mark:]
+
+            # If we get here, we failed to find something that
+            # would satisfy choice (without breaking the
+            # installability of t).  This means p cannot be used
+            # to satisfy the dependencies, so pretend to conflict
+            # with it - hopefully it will reduce future choices.
+            if p not in never:
+                never.add(p)
+                never_trail.append(p)
+            stats.backtrace_restore_point_used += 1
+            check = []
+            steps += self.resolve_choices(check, musts, never, choices,
+                                          restore_points, musts_trail,
+                                          never_trail, choices_trail, undone,
+                                          (choice, last))
+            if solver_budget is not None and steps > solver_budget:
+                self._search_depth = max_depth
+                return self._solver_budget_exhausted(t, steps)
+
+        self._search_depth = max_depth
         if verdict:
             # if t is installable, then so are all packages in musts
-            self._cache_inst.update(musts)
+            self._add_to_cache('_cache_inst', musts)
             stats.solved_installable += 1
         else:
             stats.solved_uninstallable += 1
+            self._cache_uninstallable(t, musts | undone, start)
+            if self.record_explanations:
+                self._set_cache_entry('_explanations', t, self._explain(failure, musts))
 
         return verdict
 
-    def resolve_choices(self, check, musts, never, choices):
+    def _explain(self, failure, musts):
+        """Turn a failure recorded by _check_loop into an explanation
+
+        :param failure: A (kind, pkg_id, relation) tuple from self._failure
+        :param musts: The packages that had to be installed at the time
+        of the failure
+        """
+        (kind, pkg_id, relation) = failure
+        if kind == 'conflict':
+            # pkg_id was excluded; find out what it conflicts with
+            partners = sorted(self._universe.negative_dependencies_of(pkg_id) & musts)
+            if partners:
+                return UninstallabilityExplanation('conflict', pkg_id, partners[0])
+            nogood_explanation = self._explanations.get(pkg_id)
+            if nogood_explanation is not None and pkg_id in self._learned_nogoods.get(pkg_id.architecture, ()):
+                return nogood_explanation
+            return UninstallabilityExplanation('uninstallable', pkg_id)
+        return UninstallabilityExplanation(kind, pkg_id, relation)
+
+    def _explanation_of(self, pkg_id):
+        universe = self._universe
+        if pkg_id in universe.broken_packages:
+            return UninstallabilityExplanation('broken', pkg_id)
+        if pkg_id not in self._suite_contents and pkg_id not in self._cache_broken:
+            return UninstallabilityExplanation('not-in-suite', pkg_id)
+        if pkg_id in self._cache_broken:
+            # These are cached without an explanation, so derive it now
+            ess = self._cache_ess.get(pkg_id.architecture)
+            if ess is not None and pkg_id in ess[1]:
+                partners = sorted(universe.negative_dependencies_of(pkg_id) & ess[0])
+                if partners:
+                    return UninstallabilityExplanation('conflict', pkg_id, partners[0])
+            for depgroup in universe.dependencies_of(pkg_id):
+                if self._suite_contents.isdisjoint(depgroup):
+                    return UninstallabilityExplanation('unsatisfiable', pkg_id, depgroup)
+        return self._explanations.get(pkg_id)
+
+    def _solver_budget_exhausted(self, pkg_id, steps):
+        self._stats.solver_budget_exhausted += 1
+        self.logger.warning("Installability of %s is undetermined; gave up after %d solver steps (budget: %d)",
+                            str(pkg_id), steps, self.solver_budget)
+        return None
+
+    def resolve_choices(self, check, musts, never, choices, restore_points,
+                        musts_trail, never_trail, choices_trail, undone,
+                        pending=None):
+        """Commits to a choice from choices, possibly via a restore point
+
+        Choices that can be resolved without consequences are resolved
+        directly.  Otherwise, an alternative is picked and a restore
+        point is pushed onto restore_points so the remaining
+        alternatives can be tried if the pick turns out to be a dead end.
+        Either way, the picked package is added to musts and check (and
+        choices is updated to reflect the pick).  The changes to choices
+        are appended to choices_trail as (added, choice) tuples.
+
+        :param undone: A set that packages are added to when they are
+        removed from musts again (i.e. when an alternative is rejected).
+        :param pending: A tuple of an iterator of the remaining
+        alternatives of a choice and the alternative to try last.  Used
+        to resume a choice after backtracking to its restore point.
+        :return: The number of alternatives tried (the number of
+        "steps" taken towards the solver budget)
+        """
         universe = self._universe
         suite_contents = self._suite_contents
         stats = self._stats
         cbroken = self._cache_broken
-
-        while choices:
-            choice_options = choices.pop()
-
-            choice = iter(choice_options)
-            last = next(choice)  # pick one to go last
+        choice_order = self._choice_order
+        smallest_first = 'smallest-first' in choice_order
+        alternative_key = self._alternative_sort_key() if choice_order else None
+        steps = 0
+
+        while choices or pending:
+            if pending is None:
+                if smallest_first:
+                    choice_options = min(choices, key=len)
+                    choices.remove(choice_options)
+                else:
+                    choice_options = choices.pop()
+                choices_trail.append((False, choice_options))
+                if alternative_key is not None:
+                    ordered_options = sorted(choice_options, key=alternative_key)
+                    last = ordered_options.pop()  # the least preferred goes last
+                    choice = iter(ordered_options)
+                else:
+                    choice = iter(choice_options)
+                    last = next(choice)  # pick one to go last
+            else:
+                (choice, last) = pending
+                pending = None
             solved = False
             for p in choice:
-                musts_copy = musts.copy()
+                steps += 1
+                musts_mark = len(musts_trail)
                 never_tmp = set()
                 choices_tmp = set()
                 check_tmp = [p]
                 # _check_loop assumes that "musts" is up to date
-                musts_copy.add(p)
+                if p not in musts:
+                    musts.add(p)
+                    musts_trail.append(p)
                 if not self._check_loop(universe, suite_contents,
-                                        stats, musts_copy, never_tmp,
+                                        stats, musts, never_tmp,
                                         cbroken, choices_tmp,
-                                        check_tmp):
+                                        check_tmp, musts_trail):
                     # p cannot be chosen/is broken (unlikely, but ...)
+                    # Remember if that is true regardless of what else
+                    # we have picked, so later searches can skip it.
+                    undone.update(musts_trail[musts_mark:])
+                    musts.difference_update(musts_trail[musts_mark:])
+                    del musts_trail[musts_mark:]
+                    self._learn_unit_nogood(p)
                     continue
 
                 # Test if we can pick p without any consequences.
@@ -376,53 +1084,63 @@ class InstallabilityTester(object):
                     # we can pick p without picking up new conflicts
                     # or unresolved choices.  Therefore we commit to
                     # using p.
-                    musts.update(musts_copy)
                     stats.choice_resolved_without_restore_point += 1
                     solved = True
                     break
 
                 if not musts.isdisjoint(never_tmp):
                     # If we pick p, we will definitely end up making
-                    # t uninstallable, so p is a no-go.
+                    # t uninstallable, so p is a no-go.  If it
+                    # clashes with the essential set, it is also a
+                    # no-go for every other package.
+                    undone.update(musts_trail[musts_mark:])
+                    musts.difference_update(musts_trail[musts_mark:])
+                    del musts_trail[musts_mark:]
+                    if not never_tmp.isdisjoint(self._get_min_pseudo_ess_set(p.architecture)[0]):
+                        self._learn_unit_nogood(p)
                     continue
 
                 stats.backtrace_restore_point_created += 1
                 # We are not sure that p is safe, setup a backtrack
-                # point and recurse.
-                never_tmp |= never
-                choices_tmp |= choices
-                if self._check_inst(p, musts_copy, never_tmp,
-                                    choices_tmp):
-                    # Success, p was a valid choice and made it all
-                    # installable
-                    return True
-
-                # If we get here, we failed to find something that
-                # would satisfy choice (without breaking the
-                # installability of t).  This means p cannot be used
-                # to satisfy the dependencies, so pretend to conflict
-                # with it - hopefully it will reduce future choices.
-                never.add(p)
-                stats.backtrace_restore_point_used += 1
+                # point and continue with p.
+                restore_points.append((musts_mark, len(never_trail), len(choices_trail),
+                                       p, choice, last))
+                never_tmp -= never
+                never |= never_tmp
+                never_trail.extend(never_tmp)
+                choices_tmp -= choices
+                choices |= choices_tmp
+                choices_trail.extend((True, x) for x in choices_tmp)
+                check.append(p)
+                return steps
 
             if not solved:
-                # Optimization for the last case; avoid the recursive call
+                # Optimization for the last case; avoid the restore point
                 # and just assume the last will lead to a solution.  If it
                 # doesn't there is no solution and if it does, we don't
                 # have to back-track anyway.
                 check.append(last)
-                musts.add(last)
+                if last not in musts:
+                    musts.add(last)
+                    musts_trail.append(last)
                 stats.backtrace_last_option += 1
-                return False
+                return steps + 1
+        return steps
 
     def _check_loop(self, universe, suite_contents, stats, musts, never,
-                    cbroken, choices, check, len=len,
+                    cbroken, choices, check, musts_trail=None,
+                    never_trail=None, choices_trail=None, len=len,
                     frozenset=frozenset):
         """Finds all guaranteed dependencies via "check".
 
         If it returns False, t is not installable.  If it returns True
         then "check" is exhausted.  If "choices" are empty and this
         returns True, then t is installable.
+
+        If musts_trail (or never_trail) is not None, every package
+        added to musts (or never) is also appended to it.  Likewise,
+        (True, choice) is appended to choices_trail for every choice
+        added to choices.
         """
         # Local variables for faster access...
         not_satisfied = partial(filter, musts.isdisjoint)
@@ -442,10 +1160,16 @@ class InstallabilityTester(object):
                     #   packages can be in check.  Example "A" depends
                     #   on "B" and "C".  If "B" conflicts with "C",
                     #   then both "B" and "C" could end in "check".
+                    self._failure = ('conflict', cur, None)
                     return False
                 # We must install cur for the package to be installable,
                 # so "obviously" we can never choose any of its conflicts
-                never.update(relations.negative_dependencies & suite_contents)
+                if never_trail is None:
+                    never.update(relations.negative_dependencies & suite_contents)
+                else:
+                    new_never = (relations.negative_dependencies & suite_contents) - never
+                    never |= new_never
+                    never_trail.extend(new_never)
 
             # depgroup can be satisfied by picking something that is
             # already in musts - lets pick that (again).  :)
@@ -465,14 +1189,17 @@ class InstallabilityTester(object):
                     if cur not in cbroken and depgroup.isdisjoint(never):
                         # cur's dependency cannot be satisfied even if never was empty.
                         # This means that cur itself is broken (as well).
-                        cbroken.add(cur)
+                        self._add_to_cache('_cache_broken', (cur,))
                         suite_contents.remove(cur)
+                    self._failure = ('unsatisfiable', cur, depgroup)
                     return False
                 if len(candidates) == 1:
                     # only one possible solution to this choice and we
                     # haven't seen it before
                     check.extend(candidates)
                     musts.update(candidates)
+                    if musts_trail is not None:
+                        musts_trail.extend(candidates)
                 else:
                     possible_eqv = set(x for x in candidates if x in universe.equivalent_packages)
                     if len(possible_eqv) > 1:
@@ -495,6 +1222,8 @@ class InstallabilityTester(object):
                         if len(new_cand) == 1:
                             check.extend(new_cand)
                             musts.update(new_cand)
+                            if musts_trail is not None:
+                                musts_trail.extend(new_cand)
                             stats.eqv_table_reduced_to_one += 1
                             continue
                         elif len(candidates) == len(new_cand):
@@ -505,9 +1234,135 @@ class InstallabilityTester(object):
                         # Candidates have to be a frozenset to be added to choices
                         candidates = frozenset(candidates)
                     # defer this choice till later
+                    if choices_trail is not None and candidates not in choices:
+                        choices_trail.append((True, candidates))
                     choices.add(candidates)
         return True
 
+    def _learn_unit_nogood(self, pkg_id):
+        """Record pkg_id as a nogood if it is uninstallable on its own
+
+        Propagates the guaranteed dependencies of pkg_id on top of the
+        "pseudo-essential" set (without resolving any choices).  If that
+        fails, pkg_id cannot be part of any solution and is recorded as
+        a nogood for its architecture.
+
+        The nogood remains valid until a package that appears in one of
+        the dependency clauses visited by the propagation is added to
+        the suite (its "support") or the "pseudo-essential" set changes.
+        Removals cannot invalidate it as they never make anything more
+        installable.
+
+        :param pkg_id: The id of the package
+        :return: True if pkg_id was recorded as a nogood
+        """
+        arch = pkg_id.architecture
+        universe = self._universe
+        (start, ess_never, _) = self._get_min_pseudo_ess_set(arch)
+        if pkg_id in ess_never:
+            # Conflicts with the essential set; the caller would have
+            # ruled it out already.
+            return False
+        musts = set(start)
+        musts.add(pkg_id)
+        # Deliberately ignore already learned nogoods here.  Otherwise
+        # this nogood would also depend on the support of those.
+        if self._check_loop(universe, self._suite_contents, self._stats,
+                            musts, set(ess_never), self._cache_broken,
+                            set(), [pkg_id]):
+            return False
+        if self.record_explanations:
+            self._set_cache_entry('_explanations', pkg_id, self._explain(self._failure, musts))
+
+        support = {pkg_id}
+        for must in musts - start:
+            for depgroup in universe.dependencies_of(must):
+                support.update(depgroup)
+        self._add_support('_nogood_support', '_nogood_support_keys', pkg_id, support)
+        self._add_nogood(pkg_id)
+        self._stats.nogoods_learned += 1
+        return True
+
+    def _invalidate_nogoods_supported_by(self, pkg_ids):
+        nogood_support = self._nogood_support
+        if not nogood_support:
+            return
+        learned_nogoods = self._learned_nogoods
+        stats = self._stats
+        for pkg_id in pkg_ids:
+            supported = nogood_support.pop(pkg_id, ())
+            self._record_support_pop('_nogood_support', pkg_id, supported)
+            for nogood in supported:
+                self._remove_support('_nogood_support', '_nogood_support_keys', nogood)
+                nogoods = learned_nogoods.get(nogood.architecture)
+                if nogoods and nogood in nogoods:
+                    nogoods.remove(nogood)
+                    self._journal(nogoods.add, nogood)
+                    stats.nogoods_invalidated += 1
+                    # Every search on the architecture used the nogood
+                    self._drop_uninst_cache(nogood.architecture)
+
+    def _cache_uninstallable(self, pkg_id, visited, start):
+        """Record pkg_id as uninstallable in the current suite
+
+        The verdict is based on the dependency clauses of the packages
+        visited by the search, so it remains valid until one of the
+        packages in these clauses is added to the suite.  Packages in
+        the "pseudo-essential" set are handled by dropping the cache for
+        the architecture when that set (or one of its clauses) changes.
+
+        :param pkg_id: The id of the package
+        :param visited: The packages visited by the search
+        :param start: The "pseudo-essential" set used by the search
+        """
+        universe = self._universe
+        support = {pkg_id}
+        for pkg in visited - start:
+            for depgroup in universe.dependencies_of(pkg):
+                support.update(depgroup)
+        self._add_support('_uninst_support', '_uninst_support_keys', pkg_id, support)
+        self._add_to_cache('_cache_uninst', (pkg_id,))
+
+    def _invalidate_uninst_supported_by(self, pkg_ids):
+        if not self._cache_uninst:
+            return
+        universe = self._universe
+        cache_ess = self._cache_ess
+        uninst_support = self._uninst_support
+        stats = self._stats
+        for pkg_id in pkg_ids:
+            ess = cache_ess.get(pkg_id.architecture)
+            if ess is not None and not universe.reverse_dependencies_of(pkg_id).isdisjoint(ess[0]):
+                # A new alternative for a dependency of the "pseudo-essential"
+                # set.  That could resolve any of its choices differently.
+                self._drop_uninst_cache(pkg_id.architecture)
+            supported = uninst_support.pop(pkg_id, ())
+            self._record_support_pop('_uninst_support', pkg_id, supported)
+            for uninst in supported:
+                self._remove_support('_uninst_support', '_uninst_support_keys', uninst)
+                if uninst in self._cache_uninst:
+                    self._remove_from_cache('_cache_uninst', (uninst,))
+                    stats.negative_cache_drops += 1
+
+    def _drop_uninst_cache(self, arch):
+        dropped = [x for x in self._cache_uninst if x.architecture == arch]
+        if dropped:
+            self._remove_from_cache('_cache_uninst', dropped)
+            self._stats.negative_cache_drops += len(dropped)
+            for uninst in dropped:
+                self._remove_support('_uninst_support', '_uninst_support_keys', uninst)
+
+    def _drop_pseudo_ess_set(self, arch):
+        self._pop_cache_entry('_cache_ess', arch)
+        self._drop_uninst_cache(arch)
+        # All nogoods were learned relative to the old "pseudo-essential"
+        # set
+        nogoods = self._pop_cache_entry('_learned_nogoods', arch)
+        if nogoods:
+            self._stats.nogoods_invalidated += len(nogoods)
+            for nogood in nogoods:
+                self._remove_support('_nogood_support', '_nogood_support_keys', nogood)
+
     def _get_min_pseudo_ess_set(self, arch):
         if arch not in self._cache_ess:
             # The minimal essential set cache is not present -
@@ -547,7 +1402,7 @@ class InstallabilityTester(object):
 
             for x in start:
                 ess_never.update(universe.negative_dependencies_of(x))
-            self._cache_ess[arch] = (frozenset(start), frozenset(ess_never), frozenset(ess_choices))
+            self._set_cache_entry('_cache_ess', arch, (frozenset(start), frozenset(ess_never), frozenset(ess_choices)))
 
         return self._cache_ess[arch]
 
@@ -595,19 +1450,178 @@ class InstallabilityStats(object):
         self.eqv_table_reduced_to_one = 0
         self.eqv_table_reduced_by_zero = 0
         self.eqv_table_total_number_of_alternatives_eliminated = 0
+        self.nogoods_learned = 0
+        self.nogoods_used = 0
+        self.nogoods_invalidated = 0
+        self.solver_budget_exhausted = 0
+        self.prepass_installable = 0
+        self.prepass_uninstallable = 0
+        self.negative_cache_hits = 0
+        self.negative_cache_drops = 0
 
     def stats(self):
         formats = [
             "Requests - is_installable: {is_installable_calls}",
             "Cache - hits: {cache_hits}, misses: {cache_misses}, drops: {cache_drops}",
+            "Negative cache - hits: {negative_cache_hits}, drops: {negative_cache_drops}",
             "Choices - pre-solved: {choice_presolved}, No RP: {choice_resolved_without_restore_point}",
             "Backtrace - RP created: {backtrace_restore_point_created}, RP used: {backtrace_restore_point_used}, reached last option: {backtrace_last_option}",
             "Solved - installable: {solved_installable}, uninstallable: {solved_uninstallable}, conflicts essential: {conflicts_essential}",
+            "Solver budget - undetermined: {solver_budget_exhausted}",
+            "Unit propagation pre-pass - installable: {prepass_installable}, uninstallable: {prepass_uninstallable}",
             "Eqv - times used: {eqv_table_times_used}, perfect reductions: {eqv_table_reduced_to_one}, failed reductions: {eqv_table_reduced_by_zero}, total no. of alternatives pruned: {eqv_table_total_number_of_alternatives_eliminated}",
+            "Nogoods - learned: {nogoods_learned}, used: {nogoods_used}, invalidated: {nogoods_invalidated}",
         ]
         return [x.format(**self.__dict__) for x in formats]
 
 
+def _pkg_id_str(pkg_id):
+    return "%s/%s" % (pkg_id.package_name, pkg_id.version)
+
+
+class UninstallabilityExplanation(object):
+    """A (compact) reason for why a package is uninstallable
+
+    kind is one of:
+     * "unsatisfiable": pkg_id has a dependency (relation; the set of
+       alternatives) that cannot be satisfied.  pkg_id can be None if
+       the dependency is the result of a choice.
+     * "conflict": pkg_id conflicts with relation (a package id), which
+       must also be installed.
+     * "uninstallable": pkg_id cannot be installed with the rest of
+       the packages (e.g. all options of a choice failed).
+     * "broken": pkg_id has a dependency that can never be satisfied.
+     * "not-in-suite": pkg_id is not in the suite.
+    """
+
+    __slots__ = ['kind', 'pkg_id', 'relation']
+
+    def __init__(self, kind, pkg_id, relation=None):
+        self.kind = kind
+        self.pkg_id = pkg_id
+        self.relation = relation
+
+    def __str__(self):
+        kind = self.kind
+        if kind == 'unsatisfiable':
+            alternatives = " | ".join(sorted(_pkg_id_str(x) for x in self.relation))
+            if self.pkg_id is None:
+                return "none of %s can be installed" % alternatives
+            return "%s depends on %s, which cannot be satisfied" % (_pkg_id_str(self.pkg_id), alternatives)
+        if kind == 'conflict':
+            return "%s conflicts with %s" % (_pkg_id_str(self.pkg_id), _pkg_id_str(self.relation))
+        if kind == 'broken':
+            return "%s has a dependency that can never be satisfied" % _pkg_id_str(self.pkg_id)
+        if kind == 'not-in-suite':
+            return "%s is not in the suite" % _pkg_id_str(self.pkg_id)
+        return "%s cannot be installed with the other packages" % _pkg_id_str(self.pkg_id)
+
+    def __repr__(self):
+        return "UninstallabilityExplanation(%r, %r, %r)" % (self.kind, self.pkg_id, self.relation)
+
+
+class TesterLayer(object):
+    """The changes recorded for a layer (see InstallabilityTester.begin_layer)"""
+
+    __slots__ = ['journal', 'replaced', 'suite_changes', 'support_pops', 'support_removals', 'supported']
+
+    def __init__(self):
+        # (undo, args) for each change to the caches (in order); calling
+        # undo(*args) reverts the change
+        self.journal = []
+        # The names of the caches replaced (see _replace) in the layer
+        self.replaced = set()
+        # (added, pkg_id) for each package added to or removed from the
+        # suite (in order)
+        self.suite_changes = []
+        # (attribute name, pkg_id, entries) for each support set that
+        # has been removed from _nogood_support or _uninst_support
+        self.support_pops = []
+        # (attribute name, keys attribute name, verdict, keys) for each
+        # verdict removed from the support index (see _remove_support)
+        self.support_removals = []
+        # (attribute name, keys attribute name, verdict) for each verdict
+        # added to the support index (see _add_support)
+        self.supported = []
+
+
+class PackageCost(object):
+    """Accumulated cost of the installability checks of a package"""
+
+    __slots__ = ['calls', 'time', 'restore_points', 'backtracks', 'max_depth']
+
+    def __init__(self):
+        self.calls = 0
+        self.time = 0.0
+        self.restore_points = 0
+        self.backtracks = 0
+        self.max_depth = 0
+
+
+class PackageCostAccounting(object):
+    """Per package accounting of the cost of installability checks
+
+    Only checks that reach the solver are accounted (i.e. cache hits
+    are free).  With a sample_rate of N, only every N-th check is
+    accounted.
+    """
+
+    def __init__(self, sample_rate=1):
+        if sample_rate < 1:
+            raise ValueError("sample_rate must be at least 1")
+        self.sample_rate = sample_rate
+        self.costs = {}
+        self._countdown = sample_rate
+
+    def reset(self):
+        self.costs = {}
+
+    def sample(self):
+        """Whether the next check should be accounted"""
+        self._countdown -= 1
+        if self._countdown:
+            return False
+        self._countdown = self.sample_rate
+        return True
+
+    def record(self, pkg_id, elapsed, restore_points, backtracks, depth):
+        cost = self.costs.get(pkg_id)
+        if cost is None:
+            cost = self.costs[pkg_id] = PackageCost()
+        cost.calls += 1
+        cost.time += elapsed
+        cost.restore_points += restore_points
+        cost.backtracks += backtracks
+        if depth > cost.max_depth:
+            cost.max_depth = depth
+
+    def merge(self, costs):
+        """Merge the costs from another PackageCostAccounting into this one"""
+        for pkg_id, other in costs.items():
+            cost = self.costs.get(pkg_id)
+            if cost is None:
+                self.costs[pkg_id] = cost = PackageCost()
+            cost.calls += other.calls
+            cost.time += other.time
+            cost.restore_points += other.restore_points
+            cost.backtracks += other.backtracks
+            cost.max_depth = max(cost.max_depth, other.max_depth)
+
+    def hottest(self, count):
+        """The count most expensive packages (by time spent) and their costs"""
+        return sorted(self.costs.items(), key=lambda x: (-x[1].time, x[0]))[:count]
+
+    def report(self, count):
+        lines = []
+        if self.sample_rate > 1:
+            lines.append("Sampled 1 in %d installability checks" % self.sample_rate)
+        for pkg_id, cost in self.hottest(count):
+            lines.append("%s/%s/%s - time: %.3fs, calls: %d, RP created: %d, RP used: %d, max depth: %d" % (
+                pkg_id.package_name, pkg_id.version, pkg_id.architecture, cost.time, cost.calls,
+                cost.restore_points, cost.backtracks, cost.max_depth))
+        return lines
+
+
 class ArchStats(object):
 
     def __init__(self):
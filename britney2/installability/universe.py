@@ -13,6 +13,11 @@
 # GNU General Public License for more details.
 
 
+# Maximum number of memoised closures in transitive_reverse_dependencies_of
+# (the least recently used ones are dropped first).
+COMPONENT_CLOSURE_CACHE_SIZE = 1024
+
+
 class BinaryPackageRelation(object):
     """All relations of a given binary package"""
 
@@ -51,11 +56,22 @@ class BinaryPackageUniverse(object):
     of a "minor" lie about the "broken" packages.
     """
 
-    def __init__(self, relations, essential_packages, broken_packages, equivalent_packages):
+    def __init__(self, relations, essential_packages, broken_packages, equivalent_packages,
+                 alternative_positions=None):
         self._relations = relations
         self._essential_packages = essential_packages
         self._broken_packages = broken_packages
         self._equivalent_packages = equivalent_packages
+        self._alternative_positions = alternative_positions if alternative_positions is not None else {}
+        # Lazily computed condensation of the reverse dependency graph
+        # (see transitive_reverse_dependencies_of).  Components are
+        # numbered in the order they are completed.
+        self._component_of = {}
+        self._component_members = []
+        self._component_roots = []
+        self._component_successors = []
+        # Memoised closures (in least recently used order)
+        self._component_closures = {}
 
     def dependencies_of(self, pkg_id):
         """Returns the set of dependencies of a given package
@@ -92,6 +108,124 @@ class BinaryPackageUniverse(object):
         """
         return self._relations[pkg_id].reverse_dependencies
 
+    def transitive_reverse_dependencies_of(self, pkg_id):
+        """Returns the transitive closure of the reverse dependencies
+
+        The closure is computed over the strongly connected components
+        of the reverse dependency graph and memoised per component (up
+        to COMPONENT_CLOSURE_CACHE_SIZE of them), so packages with a
+        huge number of (indirect) reverse dependencies (e.g. libc6) are
+        only expanded once.
+
+        :param pkg_id: The BinaryPackageId of a binary package.
+        :return: A frozenset containing the input package and the package
+        ids of all packages that depend on it directly or indirectly.
+        """
+        component = self._component_of.get(pkg_id)
+        if component is None:
+            self._compute_components(pkg_id)
+            component = self._component_of[pkg_id]
+        component_closures = self._component_closures
+        closure = component_closures.pop(component, None)
+        if closure is None:
+            if not self._component_successors[component]:
+                # Nothing to gain from memoising these
+                return self._component_members[component]
+            closure = self._compute_component_closure(component)
+            if len(component_closures) >= COMPONENT_CLOSURE_CACHE_SIZE:
+                del component_closures[next(iter(component_closures))]
+        # (Re-)insert it as the most recently used one
+        component_closures[component] = closure
+        return closure
+
+    def _compute_components(self, root):
+        # Iterative version of Tarjan's algorithm following reverse
+        # dependencies.  Packages that are already part of a component
+        # (from a previous call) are skipped, so only the part of the
+        # graph reachable from root is visited.
+        component_of = self._component_of
+        component_members = self._component_members
+        component_roots = self._component_roots
+        component_successors = self._component_successors
+        relations = self._relations
+        index = {root: 0}
+        lowlink = {root: 0}
+        stack = [root]
+        on_stack = {root}
+        work = [(root, iter(relations[root].reverse_dependencies))]
+        while work:
+            pkg_id, rdeps = work[-1]
+            for rdep in rdeps:
+                if rdep in component_of:
+                    continue
+                if rdep not in index:
+                    index[rdep] = lowlink[rdep] = len(index)
+                    stack.append(rdep)
+                    on_stack.add(rdep)
+                    work.append((rdep, iter(relations[rdep].reverse_dependencies)))
+                    break
+                if rdep in on_stack and index[rdep] < lowlink[pkg_id]:
+                    lowlink[pkg_id] = index[rdep]
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    if lowlink[pkg_id] < lowlink[parent]:
+                        lowlink[parent] = lowlink[pkg_id]
+                if lowlink[pkg_id] != index[pkg_id]:
+                    continue
+                component = len(component_members)
+                members = []
+                while True:
+                    member = stack.pop()
+                    on_stack.remove(member)
+                    component_of[member] = component
+                    members.append(member)
+                    if member == pkg_id:
+                        break
+                # All reverse dependencies outside the component have
+                # been completed already
+                successors = {component_of[rdep] for member in members
+                              for rdep in relations[member].reverse_dependencies}
+                successors.discard(component)
+                component_members.append(frozenset(members))
+                component_roots.append(pkg_id)
+                component_successors.append(successors)
+
+    def _compute_component_closure(self, component):
+        component_members = self._component_members
+        component_roots = self._component_roots
+        component_successors = self._component_successors
+        component_closures = self._component_closures
+        closure = set(component_members[component])
+        check = [component]
+        while check:
+            for successor in component_successors[check.pop()]:
+                if component_roots[successor] in closure:
+                    # Components are only added as a whole (either on
+                    # their own or as part of a memoised closure), so
+                    # it has already been covered.
+                    continue
+                memoised = component_closures.get(successor)
+                if memoised is not None:
+                    closure.update(memoised)
+                    continue
+                closure.update(component_members[successor])
+                check.append(successor)
+        return frozenset(closure)
+
+    def alternative_position_of(self, pkg_id):
+        """Returns how early a given package is listed as an alternative
+
+        :param pkg_id: The BinaryPackageId of a binary package.
+        :return: The lowest (0-based) position the package has among the
+        alternatives of any dependency relation with more than one
+        alternative (in the order they were declared).  Packages that are
+        never listed as such an alternative are considered to be at
+        position 0.
+        """
+        return self._alternative_positions.get(pkg_id, 0)
+
     def are_equivalent(self, pkg_id1, pkg_id2):
         """Test if pkg_id1 and pkg_id2 are equivalent
 
@@ -1,14 +1,75 @@
 import apt_pkg
 import contextlib
 import copy
+import hashlib
+import logging
+import multiprocessing
+from itertools import chain
 
 from britney2.transaction import MigrationTransactionState
 from britney2.utils import (
-    MigrationConstraintException, compute_reverse_tree, check_installability, clone_nuninst,
-    find_smooth_updateable_binaries,
+    MigrationConstraintException, compute_reverse_tree, check_installability, DeltaSet,
+    find_safe_reverse_dependencies, find_smooth_updateable_binaries, order_by_reverse_dependencies, overlay_nuninst,
 )
 
 
+# The (MigrationManager, components, nuninst, explain) tuple used by
+# _speculative_trial_worker.  It is set in the parent process right
+# before the workers are forked, so the workers see a (copy-on-write)
+# snapshot of the current state without having to pickle it.
+_speculation = None
+
+# Maximum number of memoised results of compute_groups (the least
+# recently used ones are dropped first).
+GROUPS_CACHE_SIZE = 4096
+
+
+def _speculative_trial_worker(idx):
+    # The workers must not write to the log files of the parent
+    logging.disable(logging.CRITICAL)
+    mm, comps, nuninst_now, explain = _speculation
+    # Nothing applied in the workers ends up in the parent
+    mm.record_history = False
+    return mm._speculative_trial(comps[idx], nuninst_now, explain)
+
+
+class SpeculativeTrial(object):
+    """The outcome of trying a migration in a forked worker (see MigrationManager.speculate)"""
+
+    __slots__ = ['footprint', 'accepted', 'failed_arch', 'nuninst_changes', 'explanations', 'exception']
+
+    def __init__(self, footprint):
+        # See MigrationManager.compute_footprint
+        self.footprint = footprint
+        self.accepted = False
+        self.failed_arch = None
+        # Maps a nuninst key to a (added, removed) tuple of package names
+        self.nuninst_changes = {}
+        # The explanations (as strings) for the packages broken on failed_arch
+        self.explanations = []
+        # The repr() of the MigrationConstraintException raised (if any)
+        self.exception = None
+
+    def is_valid_after(self, footprints):
+        """Whether the result still applies after migrating items with the given footprints"""
+        if not footprints:
+            return True
+        if self.footprint is None:
+            return False
+        return all(x is not None and x.isdisjoint(self.footprint) for x in footprints)
+
+    def nuninst_after(self, nuninst_now):
+        """Reconstruct the nuninst after the (rejected) migration from nuninst_now"""
+        nuninst_after = nuninst_now.copy()
+        for key, (added, removed) in self.nuninst_changes.items():
+            nuninst_after[key] = names = DeltaSet(nuninst_now[key])
+            for name in removed:
+                names.discard(name)
+            for name in added:
+                names.add(name)
+        return nuninst_after
+
+
 def compute_eqv_set(pkg_universe, updates, rms):
     eqv_set = set()
     # If we are removing *and* updating packages, then check for eqv. packages
@@ -46,6 +107,18 @@ class MigrationManager(object):
         self._transactions = []
         self._all_architectures = frozenset(self.options.architectures)
         self._migration_item_factory = migration_item_factory
+        # The items applied to the target suite (and not rolled back) in
+        # the order they were applied (see replay_migrations).  Only
+        # recorded if record_history is set (i.e. for checkpoints).
+        self.record_history = False
+        self.migration_history = []
+        # The packages known to be broken as of the last entry of the
+        # migration history (which only records the changes to them)
+        self._history_broken = frozenset()
+        # Memoised results of compute_groups (see _groups_dependencies)
+        self._groups_cache = {}
+        self.groups_cache_hits = 0
+        self.groups_cache_misses = 0
 
     @property
     def current_transaction(self):
@@ -90,7 +163,74 @@ class MigrationManager(object):
 
         Unlike migrate_items_to_target_suite, this will not modify
         any data structure.
+
+        The result is memoised until the parts of the target suite it
+        was computed from change, so the returned sets are frozen.
         """
+        key = (item.uvname, item.version, allow_smooth_updates, frozenset(removals))
+        groups_cache = self._groups_cache
+        cached = groups_cache.pop(key, None)
+        if cached is not None:
+            dependencies, stamp, result = cached
+            if self._groups_stamp(dependencies) == stamp:
+                self.groups_cache_hits += 1
+                # (Re-)insert it as the most recently used one
+                groups_cache[key] = cached
+                return result
+        self.groups_cache_misses += 1
+        source_name, adds, rms, smoothbins = self._compute_groups(item, allow_smooth_updates, removals)
+        result = (source_name, frozenset(adds), frozenset(rms), frozenset(smoothbins))
+        dependencies = self._groups_dependencies(item, source_name, allow_smooth_updates)
+        if len(groups_cache) >= GROUPS_CACHE_SIZE:
+            del groups_cache[next(iter(groups_cache))]
+        groups_cache[key] = (dependencies, self._groups_stamp(dependencies), result)
+        return result
+
+    def _groups_dependencies(self, item, source_name, allow_smooth_updates):
+        # The sources whose entries in the target suite compute_groups
+        # may look at: the source itself, those that (may) own one of
+        # its binaries in the target suite and (for smooth updates) the
+        # sources of the reverse dependencies of the binaries that are
+        # not rebuilt by the new version.  Note binaries can only be
+        # added to the target suite from a source suite, so the owners
+        # in the source suites cover binaries that are not there yet.
+        suite_info = self.suite_info
+        all_binaries = self.all_binaries
+        pkg_universe = self.pkg_universe
+        source_data_t = suite_info.target_suite.sources.get(source_name)
+        source_data_s = item.suite.sources.get(source_name)
+        binaries_s = item.suite.binaries
+        keys = set()
+        dependencies = {source_name}
+        if item.is_removal and item.architecture != 'source':
+            keys.add((item.package, item.architecture))
+        if source_data_t is not None:
+            for pkg_id in source_data_t.binaries:
+                name, _, arch = pkg_id
+                keys.add((name, arch))
+                if not allow_smooth_updates:
+                    continue
+                pkg_s = binaries_s[arch].get(name)
+                if source_data_s is None or pkg_s is None or pkg_s.source_version != source_data_s.version:
+                    dependencies.update(all_binaries[x].source for x in pkg_universe.reverse_dependencies_of(pkg_id))
+        if not item.is_removal:
+            keys.update((x.package_name, x.architecture) for x in source_data_s.binaries)
+        for suite in chain((suite_info.target_suite,), suite_info.source_suites):
+            binaries = suite.binaries
+            for name, arch in keys:
+                pkg = binaries[arch].get(name)
+                if pkg is not None:
+                    dependencies.add(pkg.source)
+        return tuple(dependencies)
+
+    def _groups_stamp(self, dependencies):
+        # Every change of a source or its binaries in the target suite
+        # (including a rollback) bumps its generation, so this is cheap
+        # to compare even for a source with many binaries.
+        source_generation = self.suite_info.target_suite.source_generation
+        return tuple(source_generation(source_name) for source_name in dependencies)
+
+    def _compute_groups(self, item, allow_smooth_updates, removals):
         # local copies for better performances
         source_name = item.package
         target_suite = self.suite_info.target_suite
@@ -257,14 +397,22 @@ class MigrationManager(object):
             # always create a copy of the SourcePackage object
             sources_t[source_name] = copy.copy(source_suite.sources[source_name])
             if old_source is not None:
-                # always create a new list of binaries
+                # always create a new set of binaries.  Copying it is
+                # cheap compared to updating it below (even for sources
+                # with hundreds of binaries), so it is not worth sharing.
                 sources_t[source_name].binaries = copy.copy(old_source.binaries)
             else:
                 sources_t[source_name].binaries = set()
+        target_suite.source_changed(source_name)
 
         undo['sources'][source_name] = old_source
 
         eqv_set = compute_eqv_set(pkg_universe, updates, rms)
+        replacements = {(x.package_name, x.architecture): x for x in updates}
+        # Updated binaries that safely replace the removed binary for
+        # (some of) its reverse dependencies
+        substituted = set()
+        affected_substituted = set()
 
         # remove all the binaries which aren't being smooth updated
         for rm_pkg_id in rms:
@@ -278,8 +426,16 @@ class MigrationManager(object):
             undo['binaries'][pkey] = rm_pkg_id
             if pkey not in eqv_set:
                 # all the reverse dependencies are affected by
-                # the change
-                affected_direct.update(pkg_universe.reverse_dependencies_of(rm_pkg_id))
+                # the change (except those that are provably fine
+                # with the new binary)
+                rdeps = pkg_universe.reverse_dependencies_of(rm_pkg_id)
+                new_pkg_id = replacements.get(pkey)
+                if new_pkg_id is not None:
+                    safe_rdeps = find_safe_reverse_dependencies(pkg_universe, rm_pkg_id, new_pkg_id, updates)
+                    if safe_rdeps:
+                        substituted.add(new_pkg_id)
+                        rdeps = rdeps - safe_rdeps
+                affected_direct.update(rdeps)
                 affected_direct.update(pkg_universe.negative_dependencies_of(rm_pkg_id))
 
             # remove the provided virtual packages
@@ -294,8 +450,8 @@ class MigrationManager(object):
             if source_name in sources_t:
                 sources_t[source_name].binaries.discard(rm_pkg_id)
             # finally, remove the binary package
-            del binaries_t_a[binary]
             target_suite.remove_binary(rm_pkg_id)
+            del binaries_t_a[binary]
 
         # Add/Update binary packages in testing
         if updates:
@@ -360,19 +516,38 @@ class MigrationManager(object):
                     affected_direct.update(pkg_universe.negative_dependencies_of(updated_pkg_id))
 
         # Also include the transitive rdeps of the packages found so far
-        affected_all = affected_direct.copy()
+        # - substituted binaries must be checked themselves, but their
+        #   rdeps cannot become uninstallable unless reached via another
+        #   change.
+        affected_all = affected_direct - substituted
         compute_reverse_tree(pkg_universe, affected_all)
+        affected_all.update(substituted)
+        if substituted:
+            affected_substituted.update(substituted)
+            compute_reverse_tree(pkg_universe, affected_substituted)
+            affected_substituted -= affected_all
         if transaction:
             transaction.add_undo_item(undo, updated_binaries)
-        # return the affected packages (direct and than all)
-        return (affected_direct, affected_all, smooth_updates)
+        # return the affected packages (direct, all and those only
+        # affected if they are uninstallable)
+        return (affected_direct, affected_all, affected_substituted, smooth_updates)
 
     def _apply_multiple_items_to_target_suite(self, items):
         is_source_migration = False
+        if self.record_history:
+            # The packages known to be broken are not considered to be in
+            # the target suite, which affects e.g. smooth updates.
+            applied = (list(items), self.suite_info.target_suite.inst_tester.known_broken_packages)
+            transaction = self.current_transaction
+            if transaction:
+                transaction.add_applied_items(applied)
+            else:
+                self._extend_migration_history([applied])
         if len(items) == 1:
             item = items[0]
             # apply the changes
-            affected_direct, affected_all, smooth_updates = self._apply_item_to_target_suite(item)
+            affected_direct, affected_all, affected_substituted, smooth_updates = \
+                self._apply_item_to_target_suite(item)
             if item.architecture == 'source':
                 affected_architectures = self._all_architectures
                 is_source_migration = True
@@ -383,6 +558,7 @@ class MigrationManager(object):
             removals = set()
             affected_direct = set()
             affected_all = set()
+            affected_substituted = set()
             smooth_updates = set()
             for item in items:
                 _, _, rms, _ = self.compute_groups(item, allow_smooth_updates=False)
@@ -394,13 +570,16 @@ class MigrationManager(object):
                 is_source_migration = True
 
             for item in items:
-                item_affected_direct, item_affected_all, item_smooth = self._apply_item_to_target_suite(item,
-                                                                                                        removals=removals)
+                item_affected_direct, item_affected_all, item_affected_substituted, item_smooth = \
+                    self._apply_item_to_target_suite(item, removals=removals)
                 affected_direct.update(item_affected_direct)
                 affected_all.update(item_affected_all)
+                affected_substituted.update(item_affected_substituted)
                 smooth_updates.update(item_smooth)
+            affected_substituted -= affected_all
 
-        return is_source_migration, affected_architectures, affected_direct, affected_all, smooth_updates
+        return (is_source_migration, affected_architectures, affected_direct, affected_all, affected_substituted,
+                smooth_updates)
 
     def migrate_items_to_target_suite(self, items, nuninst_now, stop_on_first_regression=True):
         is_accepted = True
@@ -412,8 +591,13 @@ class MigrationManager(object):
         break_arches = self.options.break_arches
         arch = None
 
-        is_source_migration, affected_architectures, affected_direct, affected_all, smooth_updates = \
-            self._apply_multiple_items_to_target_suite(items)
+        (is_source_migration, affected_architectures, affected_direct, affected_all, affected_substituted,
+         smooth_updates) = self._apply_multiple_items_to_target_suite(items)
+
+        # Packages only affected via a safe substitution cannot become
+        # uninstallable, so only the uninstallable ones need a check
+        affected_all.update(x for x in affected_substituted
+                            if x.package_name in nuninst_now[x.architecture + "+all"])
 
         # Optimise the test if we may revert directly.
         # - The automatic-revert is needed since some callers (notably via hints) may
@@ -423,38 +607,296 @@ class MigrationManager(object):
             affected_all -= affected_direct
         else:
             affected_direct = set()
+        affected_all = order_by_reverse_dependencies(self.pkg_universe, affected_all)
 
-        # Copy nuninst_comp - we have to deep clone affected
-        # architectures.
+        # Overlay nuninst_comp - the affected architectures must not be
+        # modified in place.
 
         # NB: We do this *after* updating testing as we have to filter out
         # removed binaries.  Otherwise, uninstallable binaries that were
         # removed by the item would still be counted.
-
-        nuninst_after = clone_nuninst(nuninst_now, packages_s=packages_t, architectures=affected_architectures)
+        # - Only binaries recorded in the undo log can have been removed.
+        removed_binaries = None
+        transaction = self.current_transaction
+        if transaction is not None:
+            removed_binaries = [key for undo, _ in transaction.undo_items for key in undo['binaries']]
+        nuninst_after = overlay_nuninst(nuninst_now, affected_architectures, packages_s=packages_t,
+                                        removed_binaries=removed_binaries)
         must_be_installable = self.constraints['keep-installable']
 
-        # check the affected packages on all the architectures
-        for arch in affected_architectures:
-            check_archall = arch in nobreakall_arches
-
-            check_installability(target_suite, packages_t, arch, affected_direct, affected_all,
-                                 check_archall, nuninst_after)
-
-            # if the uninstallability counter is worse than before, break the loop
-            if stop_on_first_regression:
-                worse = is_nuninst_worse(must_be_installable, nuninst_now[arch], nuninst_after[arch])
+        # Callers accepting the outcome regardless (i.e. hints) need an
+        # exact nuninst, so lift the solver budget for them.
+        inst_tester = target_suite.inst_tester
+        solver_budget = inst_tester.solver_budget
+        if not stop_on_first_regression:
+            inst_tester.solver_budget = None
 
-                # ... except for a few special cases
-                if worse and ((not is_source_migration and arch not in new_arches) or
-                              (arch not in break_arches)):
-                    is_accepted = False
-                    break
+        try:
+            # check the affected packages on all the architectures
+            for arch in affected_architectures:
+                check_archall = arch in nobreakall_arches
+
+                check_installability(target_suite, packages_t, arch, affected_direct, affected_all,
+                                     check_archall, nuninst_after)
+
+                # if the uninstallability counter is worse than before, break the loop
+                if stop_on_first_regression:
+                    worse = is_nuninst_worse(must_be_installable, nuninst_now[arch], nuninst_after[arch])
+
+                    # ... except for a few special cases
+                    if worse and ((not is_source_migration and arch not in new_arches) or
+                                  (arch not in break_arches)):
+                        is_accepted = False
+                        break
+        finally:
+            inst_tester.solver_budget = solver_budget
 
         new_cruft = {self._migration_item_factory.generate_removal_for_cruft_item(x) for x in smooth_updates}
 
         return (is_accepted, nuninst_after, arch, new_cruft)
 
+    def explain_uninstallable(self, arch, pkg_names):
+        """Explain why the named packages are uninstallable in the target suite
+
+        :param arch: The architecture of the packages
+        :param pkg_names: An iterable of binary package names
+        :return: A list of UninstallabilityExplanations (packages
+        without an explanation are skipped)
+        """
+        target_suite = self.suite_info.target_suite
+        packages_t_a = target_suite.binaries[arch]
+        explanations = []
+        for pkg_name in pkg_names:
+            if pkg_name not in packages_t_a:
+                continue
+            _, why = target_suite.is_installable(packages_t_a[pkg_name].pkg_id, explain=True)
+            if why is not None:
+                explanations.append(why)
+        return explanations
+
+    def compute_footprint(self, items):
+        """Compute what a migration of items could depend on or affect
+
+        Two migrations with disjoint footprints can be tried in either
+        order with the same outcome.  The footprint contains the
+        (name, architecture) of the binaries touched by the items and
+        of their transitive reverse dependencies (as well as those of
+        the binaries they conflict with) and (name, "source") of the
+        source packages involved.
+
+        :param items: A list of MigrationItems
+        :return: The footprint as a frozenset or None if it covers
+        everything (e.g. an essential package is affected).
+        """
+        target_suite = self.suite_info.target_suite
+        sources_t = target_suite.sources
+        pkg_universe = self.pkg_universe
+        footprint = set()
+        roots = set()
+        for item in items:
+            try:
+                source_name, updates, rms, _ = self.compute_groups(item)
+            except MigrationConstraintException:
+                return None
+            footprint.add((source_name, 'source'))
+            roots.update(updates, rms)
+            if source_name in sources_t:
+                roots.update(sources_t[source_name].binaries)
+            if source_name in item.suite.sources:
+                footprint.update((x.package_name, x.architecture) for x in item.suite.sources[source_name].binaries)
+        affected = self._close_footprint(roots)
+        if affected is None:
+            return None
+        footprint.update((x.package_name, x.architecture) for x in affected)
+        return frozenset(footprint)
+
+    def compute_fingerprint(self, item):
+        """Compute a fingerprint of what the outcome of migrating item depends on
+
+        The fingerprint covers the binaries that the item would add,
+        remove or smooth update and the packages in the target suite
+        that they directly depend on, conflict with or are depended on
+        by.  Changes further away can also change the outcome, but
+        including them would make the fingerprint change on almost any
+        migration.  While the fingerprint is unchanged, trying the item
+        again is likely to give the same result.
+
+        :param item: A MigrationItem
+        :return: The fingerprint as a hex string or None if the item
+        cannot be fingerprinted.
+        """
+        try:
+            source_name, updates, rms, smoothbins = self.compute_groups(item)
+        except MigrationConstraintException:
+            return None
+        target_suite = self.suite_info.target_suite
+        pkg_universe = self.pkg_universe
+
+        related = set()
+        for pkg_id in chain(updates, rms, smoothbins):
+            related.update(*pkg_universe.dependencies_of(pkg_id))
+            related.update(pkg_universe.negative_dependencies_of(pkg_id))
+            related.update(pkg_universe.reverse_dependencies_of(pkg_id))
+        region = set(target_suite.which_of_these_are_in_the_suite(related))
+
+        source_t = target_suite.sources.get(source_name)
+        h = hashlib.sha1()
+        h.update(("%s %s %s\n" % (item.uvname, item.version, source_t.version if source_t else '-')).encode('utf-8'))
+        for kind, pkg_ids in (('+', updates), ('-', rms), ('~', smoothbins), ('=', region)):
+            for pkg_id in sorted(pkg_ids):
+                h.update(("%s %s/%s/%s\n" % (kind, pkg_id.package_name, pkg_id.version, pkg_id.architecture)).encode('utf-8'))
+        return h.hexdigest()
+
+    def compute_footprint_roots(self, items):
+        """Compute the roots of the footprint of items (see compute_footprint)
+
+        The footprint itself can cover a large part of the archive, so
+        this is what items waiting for a change to their footprint keep:
+        the (name, "source") of the source packages involved, the (name,
+        architecture) of their binaries and the binaries touched by the
+        items (as well as those they conflict with).  The rest of the
+        footprint follows from the reverse dependencies of the latter
+        (see is_footprint_affected).
+
+        :param items: A list of MigrationItems
+        :return: A (names, binaries) tuple of frozensets or None if the
+        footprint covers everything (e.g. an essential package is
+        affected).
+        """
+        sources_t = self.suite_info.target_suite.sources
+        pkg_universe = self.pkg_universe
+        names = set()
+        roots = set()
+        for item in items:
+            try:
+                source_name, updates, rms, _ = self.compute_groups(item)
+            except MigrationConstraintException:
+                return None
+            names.add((source_name, 'source'))
+            roots.update(updates, rms)
+            if source_name in sources_t:
+                roots.update(sources_t[source_name].binaries)
+            if source_name in item.suite.sources:
+                roots.update(item.suite.sources[source_name].binaries)
+        names.update((x.package_name, x.architecture) for x in roots)
+        for pkg_id in list(roots):
+            roots.update(pkg_universe.negative_dependencies_of(pkg_id))
+        essential_packages = pkg_universe.essential_packages
+        for pkg_id in roots:
+            if not essential_packages.isdisjoint(pkg_universe.transitive_reverse_dependencies_of(pkg_id)):
+                # Changes to the essential set affect every package
+                return None
+        return frozenset(names), frozenset(roots)
+
+    def compute_changes(self, transaction):
+        """Compute the footprint of the changes done in a transaction
+
+        Like compute_footprint, but based on what the transaction
+        actually changed (so it can be used after the changes have been
+        applied or even committed).  See is_footprint_affected.
+
+        :param transaction: A MigrationTransactionState
+        :return: A (names, binaries) tuple of frozensets or None if the
+        footprint covers everything.  The names are the (name, "source")
+        of the changed source packages and the (name, architecture) of
+        the changed binaries.  The binaries are the changed binaries
+        and their transitive reverse dependencies (as well as those of
+        the binaries they conflict with).
+        """
+        names = set()
+        roots = set()
+        for undo, updated_binaries in transaction.undo_items:
+            names.update((x, 'source') for x in undo['sources'])
+            roots.update(updated_binaries)
+            roots.update(undo['binaries'].values())
+        names.update((x.package_name, x.architecture) for x in roots)
+        affected = self._close_footprint(roots)
+        if affected is None:
+            return None
+        return frozenset(names), frozenset(affected)
+
+    def is_footprint_affected(self, footprint_roots, changes):
+        """Whether changes intersect the footprint with the given roots
+
+        The footprint consists of the names in footprint_roots and the
+        transitive reverse dependencies of its binaries.  The latter are
+        memoised by the package universe, so they are not kept with the
+        roots.
+
+        :param footprint_roots: The roots of a footprint as returned by
+        compute_footprint_roots (must not be None)
+        :param changes: The footprint of changes as returned by
+        compute_changes (must not be None)
+        """
+        names, roots = footprint_roots
+        changed_names, affected = changes
+        if not names.isdisjoint(changed_names):
+            return True
+        pkg_universe = self.pkg_universe
+        return any(not affected.isdisjoint(pkg_universe.transitive_reverse_dependencies_of(pkg_id)) for pkg_id in roots)
+
+    def _close_footprint(self, roots):
+        # The transitive reverse dependencies of roots and of the
+        # packages they conflict with (or None if that includes an
+        # essential package).
+        pkg_universe = self.pkg_universe
+        for pkg_id in list(roots):
+            roots.update(pkg_universe.negative_dependencies_of(pkg_id))
+        affected = set()
+        for pkg_id in roots:
+            if pkg_id not in affected:
+                affected.update(pkg_universe.transitive_reverse_dependencies_of(pkg_id))
+        if not affected.isdisjoint(pkg_universe.essential_packages):
+            # Changes to the essential set affect every package
+            return None
+        return affected
+
+    def speculate(self, comps, nuninst_now, workers, explain=False):
+        """Try the migration of several components in parallel
+
+        Each component is tried in a forked worker on top of the current
+        state of the target suite (as if it was the next one to be
+        tried).  The target suite of this process is not modified.
+
+        :param comps: A list of lists of MigrationItems
+        :param nuninst_now: The current nuninst
+        :param workers: The maximum number of worker processes
+        :param explain: Whether to collect explanations for the packages
+        that a rejected migration would break
+        :return: A list with a SpeculativeTrial for each component (in
+        the same order) or None if the platform cannot fork.
+        """
+        global _speculation
+        if 'fork' not in multiprocessing.get_all_start_methods():  # pragma: no cover
+            return None
+        context = multiprocessing.get_context('fork')
+        _speculation = (self, comps, nuninst_now, explain)
+        try:
+            with context.Pool(min(workers, len(comps))) as pool:
+                return pool.map(_speculative_trial_worker, range(len(comps)), chunksize=1)
+        finally:
+            _speculation = None
+
+    def _speculative_trial(self, items, nuninst_now, explain):
+        trial = SpeculativeTrial(self.compute_footprint(items))
+        with self.start_transaction() as transaction:
+            try:
+                accepted, nuninst_after, failed_arch, _ = self.migrate_items_to_target_suite(items, nuninst_now)
+                trial.accepted = accepted
+                if not accepted:
+                    trial.failed_arch = failed_arch
+                    for key, names in nuninst_after.items():
+                        if names is not nuninst_now[key]:
+                            trial.nuninst_changes[key] = (frozenset(names - nuninst_now[key]),
+                                                          frozenset(nuninst_now[key] - names))
+                    if explain:
+                        broken = sorted(nuninst_after[failed_arch] - nuninst_now[failed_arch])
+                        trial.explanations = [str(x) for x in self.explain_uninstallable(failed_arch, broken)]
+            except MigrationConstraintException as e:
+                trial.exception = repr(e)
+            transaction.rollback()
+        return trial
+
     @contextlib.contextmanager
     def start_transaction(self):
         tmts = MigrationTransactionState(self.suite_info, self.all_binaries, self.current_transaction)
@@ -468,3 +910,34 @@ class MigrationManager(object):
         finally:
             self._transactions.pop()
         assert tmts.is_rolled_back or tmts.is_committed
+        if tmts.is_committed and tmts.parent_transaction is None:
+            self._extend_migration_history(tmts.applied_items)
+
+    def _extend_migration_history(self, applied_items):
+        # Only the changes to the packages known to be broken are kept,
+        # rather than a copy of all of them for every entry.
+        broken_before = self._history_broken
+        for items, broken in applied_items:
+            self.migration_history.append((items, broken - broken_before, broken_before - broken))
+            broken_before = broken
+        self._history_broken = broken_before
+
+    def replay_migrations(self, history):
+        """Apply the items of a migration history to the target suite
+
+        The items are applied in the same groups and order as they were
+        originally (see migration_history), but without any checks.
+        Used to restore the target suite from a checkpoint.
+
+        :param history: A list of (items, broken_added, broken_removed)
+        tuples, where items is a list of MigrationItems and broken_added
+        and broken_removed are the changes to the packages known to be
+        broken (since the previous entry) when they were applied.
+        """
+        inst_tester = self.suite_info.target_suite.inst_tester
+        broken = set()
+        for items, broken_added, broken_removed in history:
+            broken -= broken_removed
+            broken.update(broken_added)
+            inst_tester.mark_known_broken(broken)
+            self._apply_multiple_items_to_target_suite(items)
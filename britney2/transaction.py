@@ -7,11 +7,16 @@ class MigrationTransactionState(object):
         self._is_rolled_back = False
         self._is_committed = False
         self._undo_items = []
+        self._applied_items = []
         self._pending_child = False
         if self.parent_transaction:
             # Transactions can only support one child transaction at a time
             assert not self.parent_transaction._pending_child
             self.parent_transaction._pending_child = True
+        # Changes to the installability tester are recorded in a layer,
+        # so rolling back does not have to replay them (and invalidate
+        # its caches in the process).
+        suite_info.target_suite.inst_tester.begin_layer()
 
     def add_undo_item(self, undo, updated_binaries):
         # We do not accept any changes to this transaction while it has a child transaction
@@ -20,6 +25,11 @@ class MigrationTransactionState(object):
         self._assert_open_transaction()
         self._undo_items.append((undo, updated_binaries))
 
+    def add_applied_items(self, applied):
+        """Record that items were applied (together) in this transaction"""
+        self._assert_open_transaction()
+        self._applied_items.append(applied)
+
     def _assert_open_transaction(self):
         assert not self._is_rolled_back and not self._is_committed
         p = self.parent_transaction
@@ -31,6 +41,32 @@ class MigrationTransactionState(object):
         """Only needed by a _apply_item_to_target_suite for the "hint"-hint case"""
         yield from self._undo_items
 
+    @property
+    def applied_items(self):
+        """The items applied in this transaction (see MigrationManager.migration_history)"""
+        yield from self._applied_items
+
+    def changed_packages(self):
+        """The packages changed by this transaction (so far)
+
+        The changes are taken from the undo records, so this also works
+        after the transaction has been committed or rolled back.
+
+        :return: A tuple of the names of the source packages and the
+        binaries (as (name, architecture) tuples) that were changed.  The
+        source packages of the changed binaries (before and after the
+        change) are included.
+        """
+        all_binaries = self._all_binaries
+        source_names = set()
+        binary_pkg_ids = set()
+        for undo, updated_binaries in self._undo_items:
+            source_names.update(undo['sources'])
+            binary_pkg_ids.update(undo['binaries'].values())
+            binary_pkg_ids.update(updated_binaries)
+        source_names.update(all_binaries[x].source for x in binary_pkg_ids)
+        return source_names, {(x.package_name, x.architecture) for x in binary_pkg_ids}
+
     def commit(self):
         """Commit the transaction
 
@@ -40,10 +76,12 @@ class MigrationTransactionState(object):
         """
         self._assert_open_transaction()
         self._is_committed = True
+        self._suite_info.target_suite.inst_tester.commit_layer()
         if self.parent_transaction:
             self.parent_transaction._pending_child = False
             for undo_item in self._undo_items:
                 self.parent_transaction.add_undo_item(*undo_item)
+            self.parent_transaction._applied_items.extend(self._applied_items)
 
     def rollback(self):
         """Rollback all recorded changes by this transaction
@@ -81,6 +119,7 @@ class MigrationTransactionState(object):
                     del sources_t[k]
                 else:
                     sources_t[k] = v
+                target_suite.source_changed(k)
 
         # STEP 2
         # undo all new/updated binaries
@@ -90,11 +129,10 @@ class MigrationTransactionState(object):
             for pkg_id in updated_binaries:
                 pkg_name, _, pkg_arch = pkg_id
                 try:
-                    del binaries_t[pkg_arch][pkg_name]
+                    pkg_data = binaries_t[pkg_arch].pop(pkg_name)
                 except KeyError:
                     continue
-
-                target_suite.remove_binary(pkg_id)
+                target_suite.unindex_binary(pkg_data)
 
         # STEP 3
         # undo all other binary package changes (except virtual packages)
@@ -103,8 +141,14 @@ class MigrationTransactionState(object):
                 binary, arch = p
                 binaries_t_a = binaries_t[arch]
                 pkgdata = all_binary_packages[undo['binaries'][p]]
+                if binary in binaries_t_a:
+                    target_suite.unindex_binary(binaries_t_a[binary])
                 binaries_t_a[binary] = pkgdata
-                target_suite.add_binary(pkgdata.pkg_id)
+                target_suite.index_binary(pkgdata)
+
+        # The installability tester is restored by dropping the layer
+        # (rather than removing and re-adding the binaries above)
+        target_suite.inst_tester.rollback_layer()
 
         # STEP 4
         # undo all changes to virtual packages
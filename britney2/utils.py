@@ -28,9 +28,10 @@ import os
 import sys
 import time
 from collections import defaultdict
+from collections.abc import MutableSet
 from datetime import datetime
 from functools import partial
-from itertools import filterfalse
+from itertools import chain, filterfalse
 
 import yaml
 
@@ -112,6 +113,50 @@ def log_and_format_old_libraries(logger, libs):
         logger.info(" %s: %s", lib, " ".join(libraries[lib]))
 
 
+def find_safe_reverse_dependencies(pkg_universe, old_pkg_id, new_pkg_id, updates):
+    """Find reverse dependencies that cannot break when a binary is replaced
+
+    A package that is installable with old_pkg_id remains installable
+    when old_pkg_id is replaced by new_pkg_id provided that:
+     * every dependency clause of new_pkg_id is implied by a clause of
+       old_pkg_id (i.e. the new binary does not need anything the old
+       one did not),
+     * new_pkg_id only conflicts with packages that old_pkg_id also
+       conflicts with (and with none of the updated binaries), and
+     * every dependency clause of the package that is satisfied by
+       old_pkg_id is also satisfied by new_pkg_id.
+
+    The first two conditions are about the binaries and the last one
+    about the individual reverse dependencies.  Note that this only
+    covers one direction: the package may still become installable
+    due to the change.
+
+    :param pkg_universe: A BinaryPackageUniverse
+    :param old_pkg_id: The BinaryPackageId of the binary being replaced
+    :param new_pkg_id: The BinaryPackageId of the replacement
+    :param updates: The binaries being added by the migration
+    :return: The set of reverse dependencies of old_pkg_id that satisfy
+    the last condition or None if one of the former does not hold.
+    """
+    # Essential and broken packages are special cased by the tester
+    for pkg_id in (old_pkg_id, new_pkg_id):
+        if pkg_id in pkg_universe.essential_packages or pkg_id in pkg_universe.broken_packages:
+            return None
+    new_conflicts = pkg_universe.negative_dependencies_of(new_pkg_id)
+    if not new_conflicts <= pkg_universe.negative_dependencies_of(old_pkg_id) or \
+            not new_conflicts.isdisjoint(updates):
+        return None
+    old_dependencies = pkg_universe.dependencies_of(old_pkg_id)
+    for clause in pkg_universe.dependencies_of(new_pkg_id):
+        if clause not in old_dependencies and not any(x <= clause for x in old_dependencies):
+            return None
+    safe = set()
+    for rdep in pkg_universe.reverse_dependencies_of(old_pkg_id):
+        if all(new_pkg_id in clause for clause in pkg_universe.dependencies_of(rdep) if old_pkg_id in clause):
+            safe.add(rdep)
+    return safe
+
+
 def compute_reverse_tree(pkg_universe, affected):
     """Calculate the full dependency tree for a set of packages
 
@@ -122,15 +167,65 @@ def compute_reverse_tree(pkg_universe, affected):
     The set of affected packages will be updated in place and must
     therefore be mutable.
     """
-    remain = list(affected)
-    while remain:
-        pkg_id = remain.pop()
-        new_pkg_ids = pkg_universe.reverse_dependencies_of(pkg_id) - affected
-        affected.update(new_pkg_ids)
-        remain.extend(new_pkg_ids)
+    # The closure of a package covers the closures of all its reverse
+    # dependencies, so those do not have to be looked up.
+    covered = set()
+    for pkg_id in list(affected):
+        if pkg_id in covered:
+            continue
+        closure = pkg_universe.transitive_reverse_dependencies_of(pkg_id)
+        covered.update(closure)
+    affected.update(covered)
     return None
 
 
+def order_by_reverse_dependencies(pkg_universe, pkg_ids):
+    """Order packages so they come before their dependencies
+
+    A successful installability check of a package caches all the
+    packages it needs as installable.  Checking packages before their
+    dependencies therefore turns the checks of the dependencies into
+    cache hits.
+
+    Packages in a dependency cycle are ordered arbitrarily among each
+    other.  Only relations between the given packages are considered.
+    The search starts from the packages in the order they are given,
+    so the result is as deterministic as the input (without having to
+    sort it).
+
+    :param pkg_universe: A BinaryPackageUniverse
+    :param pkg_ids: An iterable of BinaryPackageId
+    :return: A list of the package ids
+    """
+    roots = list(pkg_ids)
+    pending = set(roots)
+    order = []
+
+    def _deps(pkg_id):
+        return chain.from_iterable(pkg_universe.dependencies_of(pkg_id))
+
+    # Iterative depth-first search; a package is finished after all its
+    # (pending) dependencies, so the reverse finishing order has every
+    # package before its dependencies.
+    for root in roots:
+        if root not in pending:
+            continue
+        pending.remove(root)
+        stack = [(root, _deps(root))]
+        while stack:
+            pkg_id, deps = stack[-1]
+            for dep in deps:
+                if dep in pending:
+                    pending.remove(dep)
+                    stack.append((dep, _deps(dep)))
+                    break
+            else:
+                stack.pop()
+                order.append(pkg_id)
+    order.reverse()
+    return order
+
+
 def write_nuninst(filename, nuninst):
     """Write the non-installable report
 
@@ -324,17 +419,19 @@ def old_libraries(mi_factory, suite_info, outofsync_arches=frozenset()):
     For "outofsync" architectures, outdated binaries are allowed to be in
     the target suite, so they are only added to the removal list if they
     are no longer in the (primary) source suite.
+
+    The removals are ordered by architecture (in the order of the
+    binaries table) and then by package.  Unlike the order of the
+    binaries table, this does not depend on the order in which the
+    packages were added to the target suite.
     """
-    sources_t = suite_info.target_suite.sources
-    binaries_t = suite_info.target_suite.binaries
+    target_suite = suite_info.target_suite
     binaries_s = suite_info.primary_source_suite.binaries
+    arch_order = {arch: idx for idx, arch in enumerate(target_suite.binaries)}
     removals = []
-    for arch in binaries_t:
-        for pkg_name in binaries_t[arch]:
-            pkg = binaries_t[arch][pkg_name]
-            if sources_t[pkg.source].version != pkg.source_version and \
-                    (arch not in outofsync_arches or pkg_name not in binaries_s[arch]):
-                removals.append(mi_factory.generate_removal_for_cruft_item(pkg.pkg_id))
+    for pkg_id in sorted(target_suite.cruft_binaries(), key=lambda x: (arch_order[x.architecture], x)):
+        if pkg_id.architecture not in outofsync_arches or pkg_id.package_name not in binaries_s[pkg_id.architecture]:
+            removals.append(mi_factory.generate_removal_for_cruft_item(pkg_id))
     return removals
 
 
@@ -397,6 +494,115 @@ def clone_nuninst(nuninst, *, packages_s=None, architectures=None):
     return clone
 
 
+class DeltaSet(MutableSet):
+    """A set stored as the changes to a base set
+
+    The base set is never modified, so creating a DeltaSet is O(1)
+    and discarding it is a rollback.  Creating a DeltaSet from another
+    DeltaSet shares its base and copies its (usually small) changes,
+    so repeatedly building on the last accepted result is cheap.  When
+    the changes grow too large, they are folded into a new base.
+    """
+
+    __slots__ = ['_base', '_added', '_removed']
+
+    # Fold the changes of a DeltaSet into a new base before building
+    # on it, once there are more than this many changes.
+    FOLD_THRESHOLD = 64
+
+    def __init__(self, base=frozenset()):
+        if isinstance(base, DeltaSet):
+            if len(base._added) + len(base._removed) > self.FOLD_THRESHOLD:
+                base._fold()
+            self._base = base._base
+            self._added = set(base._added)
+            self._removed = set(base._removed)
+        else:
+            self._base = base
+            # Invariants: _added is disjoint from _base and _removed
+            # is a subset of _base.
+            self._added = set()
+            self._removed = set()
+
+    @classmethod
+    def _from_iterable(cls, it):
+        return set(it)
+
+    def _fold(self):
+        # Does not change the value of this set, so it is safe even if
+        # other DeltaSets were created from it.
+        self._base = set(self)
+        self._added = set()
+        self._removed = set()
+
+    def __contains__(self, x):
+        return x in self._added or (x in self._base and x not in self._removed)
+
+    def __iter__(self):
+        # Iterating the base (and changes) directly is a lot faster
+        # than filtering it in a generator
+        removed = self._removed
+        if removed:
+            return chain(filterfalse(removed.__contains__, self._base), self._added)
+        if self._added:
+            return chain(self._base, self._added)
+        return iter(self._base)
+
+    def __len__(self):
+        return len(self._base) + len(self._added) - len(self._removed)
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, set(self))
+
+    def add(self, x):
+        if x in self._removed:
+            self._removed.discard(x)
+        elif x not in self._base:
+            self._added.add(x)
+
+    def discard(self, x):
+        if x in self._added:
+            self._added.discard(x)
+        elif x in self._base:
+            self._removed.add(x)
+
+    def __sub__(self, other):
+        if isinstance(other, DeltaSet) and other._base is self._base:
+            return (other._removed - self._removed) | (self._added - other._added)
+        if other is self._base:
+            return set(self._added)
+        return super().__sub__(other)
+
+    def __rsub__(self, other):
+        if other is self._base:
+            return set(self._removed)
+        return super().__rsub__(other)
+
+
+def overlay_nuninst(nuninst, architectures, *, packages_s=None, removed_binaries=None):
+    """Create a modifiable view of nuninst for the given architectures
+
+    Like clone_nuninst, except that the listed architectures are
+    wrapped in a DeltaSet rather than copied.  When packages_s is
+    given, packages not in it are pruned from the view.  If the caller
+    knows which binaries may have been removed, it can pass them as
+    (name, architecture) tuples in removed_binaries, so only those are
+    checked rather than every uninstallable package.
+    """
+    overlay = nuninst.copy()
+    for arch in architectures:
+        overlay[arch] = DeltaSet(nuninst[arch])
+        overlay[arch + "+all"] = DeltaSet(nuninst[arch + "+all"])
+    if packages_s is not None:
+        if removed_binaries is None:
+            removed_binaries = [(x, arch) for arch in architectures for x in nuninst[arch + "+all"]]
+        for name, arch in removed_binaries:
+            if arch in architectures and name not in packages_s[arch]:
+                overlay[arch].discard(name)
+                overlay[arch + "+all"].discard(name)
+    return overlay
+
+
 def test_installability(target_suite, pkg_name, pkg_id, broken, nuninst_arch):
     """Test for installability of a package on an architecture
 
@@ -408,9 +614,15 @@ def test_installability(target_suite, pkg_name, pkg_id, broken, nuninst_arch):
 
     If nuninst_arch is not None then it also updated in the same
     way as broken is.
+
+    Raises a MigrationConstraintException if the installability of
+    the package could not be determined within the solver budget.
     """
     c = 0
     r = target_suite.is_installable(pkg_id)
+    if r is None:
+        raise MigrationConstraintException("installability of %s is undetermined (solver budget exhausted)" %
+                                           str(pkg_id))
     if not r:
         # not installable
         if pkg_name not in broken:
@@ -735,7 +947,8 @@ def compile_nuninst(target_suite, architectures, nobreakall_arches):
         nuninst[arch] = set()
         packages_t_a = binaries_t[arch]
         for pkg_name, pkg_data in packages_t_a.items():
-            r = target_suite.is_installable(pkg_data.pkg_id)
+            # nuninst has to be exact, so the solver budget does not apply
+            r = target_suite.is_installable_without_budget(pkg_data.pkg_id)
             if not r:
                 nuninst[arch].add(pkg_name)
 
@@ -758,8 +971,12 @@ def find_smooth_updateable_binaries(binaries_to_check,
                                     binaries_s,
                                     removals,
                                     smooth_updates):
-    check = set()
+    check = []
     smoothbins = set()
+    # We ignore all binaries listed in "removals" as we assume they
+    # will leave at the same time as the given package.
+    ignored_rdeps = set(removals)
+    ignored_rdeps.update(binaries_to_check)
 
     for pkg_id in binaries_to_check:
         binary, _, parch = pkg_id
@@ -781,43 +998,43 @@ def find_smooth_updateable_binaries(binaries_to_check,
             # a smooth update.  if not, it may still be a valid
             # candidate if one if its r-deps is itself a candidate,
             # so note it for checking later
-            rdeps = set(pkg_universe.reverse_dependencies_of(pkg_id))
-            # We ignore all binaries listed in "removals" as we
-            # assume they will leave at the same time as the
-            # given package.
-            rdeps.difference_update(removals, binaries_to_check)
+            rdeps = pkg_universe.reverse_dependencies_of(pkg_id) - ignored_rdeps
 
             smooth_update_it = False
             if target_suite.any_of_these_are_in_the_suite(rdeps):
-                combined = set(smoothbins)
-                combined.add(pkg_id)
                 for rdep in rdeps:
                     for dep_clause in pkg_universe.dependencies_of(rdep):
                         # filter out cruft binaries from unstable, because
                         # they will not be added to the set of packages that
                         # will be migrated
-                        if dep_clause - cruftbins <= combined:
+                        if all(x == pkg_id or x in smoothbins for x in dep_clause if x not in cruftbins):
                             smooth_update_it = True
                             break
+                    if smooth_update_it:
+                        break
 
             if smooth_update_it:
-                smoothbins = combined
+                smoothbins.add(pkg_id)
             else:
-                check.add(pkg_id)
+                check.append(pkg_id)
 
     # check whether we should perform a smooth update for
     # packages which are candidates but do not have r-deps
-    # outside of the current source
-    while 1:
-        found_any = False
+    # outside of the current source.  They are smooth updated if
+    # any of their r-deps are, so index them by their r-deps (that
+    # can be smooth updated at all) and propagate from smoothbins.
+    if check and smoothbins:
+        candidates = set(binaries_to_check)
+        unlocks = defaultdict(list)
         for pkg_id in check:
-            rdeps = pkg_universe.reverse_dependencies_of(pkg_id)
-            if not rdeps.isdisjoint(smoothbins):
-                smoothbins.add(pkg_id)
-                found_any = True
-        if not found_any:
-            break
-        check = [x for x in check if x not in smoothbins]
+            for rdep in candidates.intersection(pkg_universe.reverse_dependencies_of(pkg_id)):
+                unlocks[rdep].append(pkg_id)
+        worklist = list(smoothbins)
+        while worklist:
+            for pkg_id in unlocks.pop(worklist.pop(), ()):
+                if pkg_id not in smoothbins:
+                    smoothbins.add(pkg_id)
+                    worklist.append(pkg_id)
 
     return smoothbins
 
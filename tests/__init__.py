@@ -69,6 +69,11 @@ class PkgUniversePackageBuilder(object):
         self._dependencies.add(frozenset(self._uni_builder._fetch_pkg_id(x) for x in pkgs))
         return self
 
+    def depends_on_any_of_in_order(self, *pkgs):
+        # Like depends_on_any_of, but the alternatives are in the declared order
+        self._dependencies.add(tuple(self._uni_builder._fetch_pkg_id(x) for x in pkgs))
+        return self
+
     def conflicts_with(self, *pkgs):
         self._conflicts.update(self._uni_builder._fetch_pkg_id(x) for x in pkgs)
         return self
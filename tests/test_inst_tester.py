@@ -1,10 +1,15 @@
+import random
 import sys
 import unittest
 
 from collections import OrderedDict
+from unittest.mock import patch
 
-from . import new_pkg_universe_builder
+from . import MockObject, new_pkg_universe_builder
+from britney2.installability import propagation, universe as universe_module
 from britney2.installability.solver import compute_scc, InstallabilitySolver, OrderNode
+from britney2.utils import (compute_reverse_tree, find_safe_reverse_dependencies, find_smooth_updateable_binaries,
+                            order_by_reverse_dependencies)
 
 
 class TestInstTester(unittest.TestCase):
@@ -418,6 +423,774 @@ class TestInstTester(unittest.TestCase):
         assert inst_tester.stats.eqv_table_reduced_to_one == 0
         assert inst_tester.stats.eqv_table_reduced_by_zero == 1
 
+    def test_compute_installability_with_workers(self):
+        builder = new_pkg_universe_builder()
+        for arch in ['amd64', 'i386']:
+            def _pkg(name):
+                return builder.new_package((name, '1.0-1', arch))
+            ess = _pkg('ess').is_essential()
+            missing = _pkg('missing').not_in_testing()
+            broken = _pkg('broken').depends_on(missing)
+            _pkg('needs-broken').depends_on(broken)
+            _pkg('conflicts-ess').conflicts_with(ess)
+            ok1 = _pkg('ok1')
+            ok2 = _pkg('ok2').conflicts_with(ok1)
+            _pkg('choice').depends_on_any_of(ok1, ok2)
+            _pkg('needs-both').depends_on(ok1).depends_on(ok2)
+            # "no-way" is uninstallable, but only the solver can tell (by
+            # trying all the alternatives).  At least one of the
+            # "needs-both-N" alternatives is learned as a nogood on the way.
+            a, b, c, d = _pkg('a'), _pkg('b'), _pkg('c'), _pkg('d')
+            a.conflicts_with(c, d)
+            b.conflicts_with(c, d)
+            no_way = _pkg('no-way').depends_on_any_of(a, b).depends_on_any_of(c, d)
+            needs_both1 = _pkg('needs-both1').depends_on(ok1).depends_on(ok2)
+            # (not equivalent to needs-both1)
+            needs_both2 = _pkg('needs-both2').depends_on(ok1).depends_on(ok2).depends_on(ess)
+            _pkg('root').depends_on_any_of(needs_both1, needs_both2, no_way)
+
+        _, serial_tester = builder.build()
+        _, forked_tester = builder.build()
+        serial_tester.record_explanations = True
+        forked_tester.record_explanations = True
+        serial_tester.compute_installability()
+        forked_tester.compute_installability(workers=2)
+
+        assert forked_tester._cache_inst == serial_tester._cache_inst
+        assert forked_tester._cache_broken == serial_tester._cache_broken
+        assert forked_tester._suite_contents == serial_tester._suite_contents
+        assert serial_tester._cache_uninst
+        assert forked_tester._cache_uninst == serial_tester._cache_uninst
+        assert forked_tester._uninst_support == serial_tester._uninst_support
+        assert serial_tester._learned_nogoods
+        assert forked_tester._learned_nogoods == serial_tester._learned_nogoods
+        assert forked_tester._nogood_support == serial_tester._nogood_support
+        assert serial_tester._explanations
+        assert ({k: repr(v) for k, v in forked_tester._explanations.items()} ==
+                {k: repr(v) for k, v in serial_tester._explanations.items()})
+        assert forked_tester.stats.solved_installable == serial_tester.stats.solved_installable
+        for pkg_id in list(serial_tester._suite_contents):
+            assert forked_tester.is_installable(pkg_id) == serial_tester.is_installable(pkg_id)
+            assert repr(forked_tester.is_installable(pkg_id, explain=True)) == \
+                repr(serial_tester.is_installable(pkg_id, explain=True))
+
+    def test_unit_propagation_prepass(self):
+        builder = new_pkg_universe_builder()
+        ess = builder.new_package('ess').is_essential()
+        libc = builder.new_package('libc').depends_on(ess)
+        ok = builder.new_package('ok').depends_on(libc)
+        conflicts_ess = builder.new_package('conflicts-ess').conflicts_with(ess)
+        needs_conflict = builder.new_package('needs-conflict').depends_on(ok).depends_on(conflicts_ess)
+        a = builder.new_package('a').depends_on(libc)
+        b = builder.new_package('b').conflicts_with(a)
+        needs_ab = builder.new_package('needs-ab').depends_on(a).depends_on(b)
+        choice = builder.new_package('choice').depends_on_any_of(a, b)
+        satisfied_choice = builder.new_package('satisfied-choice').depends_on(a).depends_on_any_of(a, b)
+
+        _, inst_tester = builder.build()
+        inst_tester.compute_installability()
+
+        for line in inst_tester.stats.stats():
+            print(line)
+
+        for pkg in [ess, libc, ok, a, b, choice, satisfied_choice]:
+            assert inst_tester.is_installable(pkg.pkg_id)
+        for pkg in [conflicts_ess, needs_conflict, needs_ab]:
+            assert not inst_tester.is_installable(pkg.pkg_id)
+        # Only "choice" needs a full check
+        assert inst_tester.stats.prepass_installable == 6
+        assert inst_tester.stats.prepass_uninstallable == 3
+        assert inst_tester.stats.solved_installable == 1
+        # As with the full check, only the package conflicting with
+        # the essential set is removed as broken.
+        assert not inst_tester.is_pkg_in_the_suite(conflicts_ess.pkg_id)
+        assert inst_tester.is_pkg_in_the_suite(needs_conflict.pkg_id)
+        # The other verdicts went into the negative cache (with the
+        # dependencies of the packages they pull in as support)
+        assert inst_tester.stats.negative_cache_hits == 2
+        assert inst_tester.stats.solved_uninstallable == 0
+        assert {a.pkg_id, b.pkg_id} <= inst_tester._uninst_support_keys[needs_ab.pkg_id]
+
+        # They are explained on demand
+        inst_tester.record_explanations = True
+        verdict, why = inst_tester.is_installable(needs_ab.pkg_id, explain=True)
+        assert verdict is False
+        assert why is not None and why.kind == 'conflict'
+
+    @unittest.skipIf(propagation.numpy is None, "numpy is not available")
+    def test_unit_propagation_numpy_matches_python(self):
+        builder = new_pkg_universe_builder()
+        pkg_count = 60
+        pkgs = [builder.new_package('pkg-%d' % i) for i in range(pkg_count)]
+        rnd = random.Random(42)
+        for i, pkg in enumerate(pkgs[:-2]):
+            if rnd.random() < 0.1:
+                pkg.not_in_testing()
+            if rnd.random() < 0.6:
+                pkg.depends_on(rnd.choice(pkgs[i + 1:]))
+            if rnd.random() < 0.3:
+                pkg.depends_on_any_of(*rnd.sample(pkgs[i + 1:], 2))
+            if rnd.random() < 0.2:
+                pkg.conflicts_with(rnd.choice(pkgs[i + 1:]))
+
+        universe, inst_tester = builder.build()
+        suite_contents = inst_tester._suite_contents
+        problem = propagation.UnitPropagationProblem(universe, suite_contents, suite_contents,
+                                                     frozenset(), frozenset())
+        roots = list(range(len(problem)))
+        python_verdicts = propagation.propagate(problem, roots, use_numpy=False)
+        assert propagation.propagate(problem, roots, use_numpy=True) == python_verdicts
+        assert {True, False, None} <= set(python_verdicts)
+
+    def test_negative_cache(self):
+        builder = new_pkg_universe_builder()
+        conflicting = builder.new_package('conflicting')
+        provider = builder.new_package('provider').not_in_testing()
+        unrelated = builder.new_package('unrelated').not_in_testing()
+        dep = builder.new_package('dep').conflicts_with(conflicting)
+        root_pkg = builder.new_package('root').depends_on(conflicting).depends_on_any_of(dep, provider)
+
+        _, inst_tester = builder.build()
+
+        assert not inst_tester.is_installable(root_pkg.pkg_id)
+        assert inst_tester.stats.negative_cache_hits == 0
+        assert not inst_tester.is_installable(root_pkg.pkg_id)
+        assert inst_tester.stats.negative_cache_hits == 1
+
+        # Adding a package that is not in any of the relations of root
+        # (or its dependencies) cannot make it installable.
+        inst_tester.add_binary(unrelated.pkg_id)
+        assert not inst_tester.is_installable(root_pkg.pkg_id)
+        assert inst_tester.stats.negative_cache_hits == 2
+        assert inst_tester.stats.negative_cache_drops == 0
+
+        # Removals cannot make it installable either
+        inst_tester.remove_binary(unrelated.pkg_id)
+        assert not inst_tester.is_installable(root_pkg.pkg_id)
+        assert inst_tester.stats.negative_cache_hits == 3
+
+        # ... but an alternative for one of its dependencies can.
+        inst_tester.add_binary(provider.pkg_id)
+        assert inst_tester.stats.negative_cache_drops == 1
+        assert inst_tester.is_installable(root_pkg.pkg_id)
+        assert inst_tester.stats.negative_cache_hits == 3
+
+        # The dropped verdict is gone from the support index too
+        assert not any(root_pkg.pkg_id in x for x in inst_tester._uninst_support.values())
+        assert root_pkg.pkg_id not in inst_tester._uninst_support_keys
+
+    def test_negative_cache_support_index_layers(self):
+        builder = new_pkg_universe_builder()
+        conflicting = builder.new_package('conflicting')
+        provider = builder.new_package('provider').not_in_testing()
+        dep = builder.new_package('dep').conflicts_with(conflicting)
+        root_pkg = builder.new_package('root').depends_on(conflicting).depends_on_any_of(dep, provider)
+
+        _, inst_tester = builder.build()
+
+        # A verdict found in a layer that is rolled back leaves no trace
+        inst_tester.begin_layer()
+        assert not inst_tester.is_installable(root_pkg.pkg_id)
+        assert inst_tester._uninst_support_keys
+        inst_tester.rollback_layer()
+        assert not inst_tester._cache_uninst
+        assert not inst_tester._uninst_support
+        assert not inst_tester._uninst_support_keys
+
+        # A rolled back invalidation restores the verdict with its index
+        assert not inst_tester.is_installable(root_pkg.pkg_id)
+        support = {k: set(v) for k, v in inst_tester._uninst_support.items()}
+        inst_tester.begin_layer()
+        inst_tester.add_binary(provider.pkg_id)
+        assert not inst_tester._uninst_support_keys
+        inst_tester.rollback_layer()
+        assert inst_tester._uninst_support == support
+        hits = inst_tester.stats.negative_cache_hits
+        assert not inst_tester.is_installable(root_pkg.pkg_id)
+        assert inst_tester.stats.negative_cache_hits == hits + 1
+
+    def test_order_by_reverse_dependencies(self):
+        builder = new_pkg_universe_builder()
+        libc = builder.new_package('libc')
+        libfoo = builder.new_package('libfoo').depends_on(libc)
+        libbar = builder.new_package('libbar').depends_on(libc).depends_on('libbar-cycle')
+        builder.new_package('libbar-cycle').depends_on(libbar)
+        app = builder.new_package('app').depends_on(libfoo).depends_on(libbar)
+        pkg_ids = [builder.pkg_id(x) for x in ('libc', 'libfoo', 'libbar', 'libbar-cycle', 'app')]
+
+        universe, inst_tester = builder.build()
+        order = order_by_reverse_dependencies(universe, pkg_ids)
+
+        assert sorted(order) == sorted(pkg_ids)
+        position = {pkg_id: i for i, pkg_id in enumerate(order)}
+        assert position[app.pkg_id] < position[libfoo.pkg_id] < position[libc.pkg_id]
+        assert position[app.pkg_id] < position[libbar.pkg_id] < position[libc.pkg_id]
+
+        # Everything but "app" is a cache hit when checked in this order
+        for pkg_id in order:
+            assert inst_tester.is_installable(pkg_id)
+        assert inst_tester.stats.cache_misses == 1
+
+    def test_transitive_reverse_dependencies(self):
+        builder = new_pkg_universe_builder()
+        libc = builder.new_package('libc')
+        libfoo = builder.new_package('libfoo').depends_on(libc)
+        # A cycle above libfoo
+        cycle_a = builder.new_package('cycle-a').depends_on(libfoo).depends_on('cycle-b')
+        cycle_b = builder.new_package('cycle-b').depends_on(cycle_a)
+        app = builder.new_package('app').depends_on(cycle_b)
+        other = builder.new_package('other').depends_on_any_of(libc, 'unrelated')
+        builder.new_package('unrelated')
+
+        universe, _ = builder.build()
+
+        assert universe.transitive_reverse_dependencies_of(app.pkg_id) == {app.pkg_id}
+        assert universe.transitive_reverse_dependencies_of(cycle_a.pkg_id) == \
+            {cycle_a.pkg_id, cycle_b.pkg_id, app.pkg_id}
+        assert universe.transitive_reverse_dependencies_of(libc.pkg_id) == \
+            {libc.pkg_id, libfoo.pkg_id, cycle_a.pkg_id, cycle_b.pkg_id, app.pkg_id, other.pkg_id}
+
+        # Compare with a plain walk of the reverse dependencies
+        def walk(pkg_id):
+            expected = {pkg_id}
+            check = [pkg_id]
+            while check:
+                new = universe.reverse_dependencies_of(check.pop()) - expected
+                expected.update(new)
+                check.extend(new)
+            return expected
+
+        rnd = random.Random(42)
+        builder = new_pkg_universe_builder()
+        pkgs = [builder.new_package('pkg-%d' % i) for i in range(80)]
+        for pkg in pkgs:
+            for _ in range(rnd.randint(0, 3)):
+                pkg.depends_on(rnd.choice(pkgs))
+        universe, _ = builder.build()
+        for pkg in rnd.sample(pkgs, 20):
+            expected = walk(pkg.pkg_id)
+            assert universe.transitive_reverse_dependencies_of(pkg.pkg_id) == expected
+            affected = {pkg.pkg_id}
+            compute_reverse_tree(universe, affected)
+            assert affected == expected
+
+        # The memoised closures are bounded (and are not needed for
+        # correctness)
+        universe, _ = builder.build()
+        with patch.object(universe_module, 'COMPONENT_CLOSURE_CACHE_SIZE', 3):
+            for pkg in rnd.sample(pkgs, 40):
+                assert universe.transitive_reverse_dependencies_of(pkg.pkg_id) == walk(pkg.pkg_id)
+                assert len(universe._component_closures) <= 3
+
+    def test_find_safe_reverse_dependencies(self):
+        builder = new_pkg_universe_builder()
+        libc = builder.new_package('libc')
+        other = builder.new_package('other')
+        old = builder.new_package('libfoo', version='1').depends_on(libc).conflicts_with(other)
+        new = builder.new_package('libfoo', version='2').depends_on_any_of(libc, other).not_in_testing()
+        stricter = builder.new_package('libfoo', version='3').depends_on(libc).depends_on(other).not_in_testing()
+        safe = builder.new_package('safe').depends_on_any_of(old, new)
+        unsafe = builder.new_package('unsafe').depends_on(old)
+
+        universe, _ = builder.build()
+
+        assert find_safe_reverse_dependencies(universe, old.pkg_id, new.pkg_id, {new.pkg_id}) == {safe.pkg_id}
+        # The new binary has a dependency the old one did not have
+        assert find_safe_reverse_dependencies(universe, old.pkg_id, stricter.pkg_id, {stricter.pkg_id}) is None
+        # The old binary does not have all the conflicts of the new one
+        assert find_safe_reverse_dependencies(universe, new.pkg_id, old.pkg_id, {old.pkg_id}) is None
+        assert unsafe.pkg_id in universe.reverse_dependencies_of(old.pkg_id)
+
+    def test_find_smooth_updateable_binaries(self):
+        # The algorithm before the worklist was introduced
+        def old_find_smooth_updateable_binaries(binaries_to_check, source_data, pkg_universe, target_suite,
+                                                binaries_t, binaries_s, removals, smooth_updates):
+            check = set()
+            smoothbins = set()
+            for pkg_id in binaries_to_check:
+                binary, _, parch = pkg_id
+                cruft = False
+                cruftbins = set()
+                if binary in binaries_s[parch]:
+                    if binaries_s[parch][binary].source_version == source_data.version:
+                        continue
+                    cruftbins.add(binaries_s[parch][binary].pkg_id)
+                    cruft = True
+                if cruft or 'ALL' in smooth_updates or binaries_t[parch][binary].section in smooth_updates:
+                    rdeps = set(pkg_universe.reverse_dependencies_of(pkg_id))
+                    rdeps.difference_update(removals, binaries_to_check)
+                    smooth_update_it = False
+                    if target_suite.any_of_these_are_in_the_suite(rdeps):
+                        combined = set(smoothbins)
+                        combined.add(pkg_id)
+                        for rdep in rdeps:
+                            for dep_clause in pkg_universe.dependencies_of(rdep):
+                                if dep_clause - cruftbins <= combined:
+                                    smooth_update_it = True
+                                    break
+                    if smooth_update_it:
+                        smoothbins = combined
+                    else:
+                        check.add(pkg_id)
+            while 1:
+                found_any = False
+                for pkg_id in check:
+                    rdeps = pkg_universe.reverse_dependencies_of(pkg_id)
+                    if not rdeps.isdisjoint(smoothbins):
+                        smoothbins.add(pkg_id)
+                        found_any = True
+                if not found_any:
+                    break
+                check = [x for x in check if x not in smoothbins]
+            return smoothbins
+
+        def both(universe, inst_tester, binaries_to_check, binaries_t, binaries_s, removals=frozenset()):
+            args = (MockObject(version='2'), universe, inst_tester, {'amd64': binaries_t}, {'amd64': binaries_s},
+                    removals, ['libs'])
+            return (find_smooth_updateable_binaries(binaries_to_check, *args),
+                    old_find_smooth_updateable_binaries(binaries_to_check, *args))
+
+        # A chain of libraries where only the last one is used by
+        # another source.  The others are smooth updated because the
+        # library depending on them is.
+        builder = new_pkg_universe_builder()
+        chain = [builder.new_package('lib%d' % i) for i in range(10)]
+        for lib, dep in zip(chain[1:], chain):
+            lib.depends_on(dep)
+        builder.new_package('app').depends_on(chain[-1])
+        universe, inst_tester = builder.build()
+        binaries_t = {lib.pkg_id.package_name: MockObject(section='libs') for lib in chain}
+        expected = {lib.pkg_id for lib in chain}
+        for order in (chain, chain[::-1]):
+            new, old = both(universe, inst_tester, [lib.pkg_id for lib in order], binaries_t, {})
+            assert new == old == expected
+        # Without app nothing is smooth updated
+        new, old = both(universe, inst_tester, [lib.pkg_id for lib in chain], binaries_t, {},
+                        removals={builder.pkg_id('app')})
+        assert new == old == set()
+
+        # Random archives with binaries that are cruft, still built by
+        # the new version or in other sections
+        rnd = random.Random(7)
+        for _ in range(30):
+            builder = new_pkg_universe_builder()
+            libs = [builder.new_package('lib%d' % i) for i in range(20)]
+            others = [builder.new_package('other%d' % i) for i in range(10)]
+            for pkg in libs + others:
+                for _ in range(rnd.randint(0, 2)):
+                    if rnd.random() < 0.3:
+                        pkg.depends_on_any_of(rnd.choice(libs), rnd.choice(libs))
+                    else:
+                        pkg.depends_on(rnd.choice(libs))
+            removals = {x.pkg_id for x in rnd.sample(others, 2)}
+            binaries_t = {}
+            binaries_s = {}
+            for lib in libs:
+                name = lib.pkg_id.package_name
+                binaries_t[name] = MockObject(section=rnd.choice(['libs', 'devel']))
+                if rnd.random() < 0.3:
+                    source_version = rnd.choice(['1', '2'])
+                    pkg_id = builder.new_package(name, version=source_version).not_in_testing().pkg_id
+                    binaries_s[name] = MockObject(source_version=source_version, pkg_id=pkg_id)
+            universe, inst_tester = builder.build()
+            binaries_to_check = [lib.pkg_id for lib in libs]
+            rnd.shuffle(binaries_to_check)
+            new, old = both(universe, inst_tester, binaries_to_check, binaries_t, binaries_s, removals)
+            assert new == old
+
+    def test_uninstallability_explanations(self):
+        builder = new_pkg_universe_builder()
+        libc = builder.new_package('libc')
+        missing = builder.new_package('missing').not_in_testing()
+        conflicting = builder.new_package('conflicting').conflicts_with(libc)
+        unsat = builder.new_package('unsat').depends_on(missing)
+        conflicts = builder.new_package('conflicts').depends_on(libc).depends_on(conflicting)
+        installable = builder.new_package('installable').depends_on(libc)
+
+        _, inst_tester = builder.build()
+        inst_tester.record_explanations = True
+
+        assert inst_tester.is_installable(installable.pkg_id, explain=True) == (True, None)
+
+        result, why = inst_tester.is_installable(conflicts.pkg_id, explain=True)
+        assert result is False
+        assert why.kind == 'conflict'
+        assert {why.pkg_id, why.relation} == {libc.pkg_id, conflicting.pkg_id}
+        # The cached verdict is explained without solving again
+        cache_misses = inst_tester.stats.cache_misses
+        result, why_again = inst_tester.is_installable(conflicts.pkg_id, explain=True)
+        assert why_again is why
+        assert inst_tester.stats.cache_misses == cache_misses
+
+        result, why = inst_tester.is_installable(unsat.pkg_id, explain=True)
+        assert result is False
+        assert why.kind == 'unsatisfiable'
+        assert why.pkg_id == unsat.pkg_id
+        assert why.relation == frozenset([missing.pkg_id])
+        assert str(why) == 'unsat/1.0-1 depends on missing/1.0-1, which cannot be satisfied'
+
+        result, why = inst_tester.is_installable(missing.pkg_id, explain=True)
+        assert result is False
+        assert why.kind == 'not-in-suite'
+
+    def test_layers(self):
+        builder = new_pkg_universe_builder()
+        libc = builder.new_package('libc')
+        libfoo = builder.new_package('libfoo').depends_on(libc)
+        app = builder.new_package('app').depends_on(libfoo)
+        conflicting = builder.new_package('conflicting').conflicts_with(libc).not_in_testing()
+        new_libfoo = builder.new_package('libfoo', version='2').depends_on(conflicting).not_in_testing()
+
+        _, inst_tester = builder.build()
+        inst_tester.compute_installability()
+        suite_contents = set(inst_tester._suite_contents)
+        cache_drops = inst_tester.stats.cache_drops
+
+        inst_tester.begin_layer()
+        inst_tester.remove_binary(libfoo.pkg_id)
+        inst_tester.add_binary(new_libfoo.pkg_id)
+        inst_tester.add_binary(conflicting.pkg_id)
+        assert not inst_tester.is_installable(app.pkg_id)
+        assert inst_tester.is_installable(new_libfoo.pkg_id)
+        inst_tester.rollback_layer()
+
+        # Everything is back as it was (including the caches)
+        assert inst_tester._suite_contents == suite_contents
+        cache_misses = inst_tester.stats.cache_misses
+        assert inst_tester.is_installable(app.pkg_id)
+        assert inst_tester.is_installable(libfoo.pkg_id)
+        assert inst_tester.stats.cache_misses == cache_misses
+
+        # Nested layers; the committed inner layer is rolled back with the outer one
+        inst_tester.begin_layer()
+        inst_tester.remove_binary(libc.pkg_id)
+        inst_tester.begin_layer()
+        inst_tester.remove_binary(libfoo.pkg_id)
+        inst_tester.commit_layer()
+        assert not inst_tester.is_installable(app.pkg_id)
+        inst_tester.rollback_layer()
+        assert inst_tester._suite_contents == suite_contents
+        assert inst_tester.is_installable(app.pkg_id)
+        assert inst_tester.stats.cache_drops > cache_drops
+
+        # Committed changes stay
+        inst_tester.begin_layer()
+        inst_tester.remove_binary(app.pkg_id)
+        inst_tester.commit_layer()
+        assert not inst_tester.is_pkg_in_the_suite(app.pkg_id)
+        assert inst_tester.is_installable(libfoo.pkg_id)
+
+    def test_layers_restore_caches(self):
+        rnd = random.Random(7)
+        builder = new_pkg_universe_builder()
+        ess = builder.new_package('ess').is_essential()
+        pkgs = [builder.new_package('pkg-%d' % i) for i in range(40)]
+        for pkg in pkgs:
+            for _ in range(rnd.randint(0, 2)):
+                pkg.depends_on_any_of(*rnd.sample(pkgs, rnd.randint(1, 3)))
+            if rnd.random() < 0.2:
+                pkg.conflicts_with(rnd.choice(pkgs))
+            if rnd.random() < 0.1:
+                # Learned as nogoods when they are tried as an alternative
+                pkg.conflicts_with(ess)
+            if rnd.random() < 0.2:
+                pkg.not_in_testing()
+
+        _, inst_tester = builder.build()
+        inst_tester.record_explanations = True
+        inst_tester.compute_installability()
+
+        def snapshot():
+            return (set(inst_tester._suite_contents), set(inst_tester._cache_inst),
+                    set(inst_tester._cache_broken), set(inst_tester._cache_uninst),
+                    dict(inst_tester._cache_ess),
+                    {arch: set(nogoods) for arch, nogoods in inst_tester._learned_nogoods.items()},
+                    dict(inst_tester._explanations))
+
+        for _ in range(30):
+            before = snapshot()
+            inst_tester.begin_layer()
+            for _ in range(rnd.randint(1, 3)):
+                inst_tester.begin_layer()
+                for pkg in rnd.sample(pkgs, 5):
+                    if rnd.random() < 0.5:
+                        inst_tester.add_binary(pkg.pkg_id)
+                    else:
+                        inst_tester.remove_binary(pkg.pkg_id)
+                for pkg in rnd.sample(pkgs, 10):
+                    inst_tester.is_installable(pkg.pkg_id)
+                if rnd.random() < 0.5:
+                    inst_tester.commit_layer()
+                else:
+                    inst_tester.rollback_layer()
+            inst_tester.rollback_layer()
+            assert snapshot() == before
+            # Keep some of the changes for the next round
+            pkg = rnd.choice(pkgs)
+            inst_tester.add_binary(pkg.pkg_id)
+            inst_tester.is_installable(pkg.pkg_id)
+
+    def test_layers_keep_one_replaced_cache(self):
+        builder = new_pkg_universe_builder()
+        libc = builder.new_package('libc')
+        pkgs = [builder.new_package('pkg-%d' % i).depends_on(libc).not_in_testing() for i in range(10)]
+        _, inst_tester = builder.build()
+        inst_tester.compute_installability()
+        cache_inst = inst_tester._cache_inst
+
+        def replaced_caches(layer):
+            return [args[2] for undo, args in layer.journal if undo is setattr]
+
+        inst_tester.begin_layer()
+        for pkg in pkgs[:5]:
+            # Each addition drops (replaces) the cache of installable packages
+            inst_tester.add_binary(pkg.pkg_id)
+            assert inst_tester.is_installable(pkg.pkg_id)
+        outer = inst_tester._layers[-1]
+        assert replaced_caches(outer) == [cache_inst]
+
+        inst_tester.begin_layer()
+        for pkg in pkgs[5:]:
+            inst_tester.add_binary(pkg.pkg_id)
+            assert inst_tester.is_installable(pkg.pkg_id)
+        assert len(replaced_caches(inst_tester._layers[-1])) == 1
+        inst_tester.commit_layer()
+        # The outer layer already restores the cache on its own
+        assert replaced_caches(outer) == [cache_inst]
+
+        inst_tester.rollback_layer()
+        assert inst_tester._cache_inst is cache_inst
+        assert all(not inst_tester.is_pkg_in_the_suite(pkg.pkg_id) for pkg in pkgs)
+        assert inst_tester.is_installable(libc.pkg_id)
+
+    def test_known_broken_packages(self):
+        builder = new_pkg_universe_builder()
+        libc = builder.new_package('libc')
+        missing = builder.new_package('missing').not_in_testing()
+        broken = builder.new_package('broken').depends_on(missing)
+        app = builder.new_package('app').depends_on_any_of(broken, libc)
+
+        _, inst_tester = builder.build()
+        inst_tester.compute_installability()
+        assert inst_tester.known_broken_packages == {broken.pkg_id}
+        assert not inst_tester.is_pkg_in_the_suite(broken.pkg_id)
+
+        # Adding a package makes the broken packages part of the suite again
+        inst_tester.remove_binary(app.pkg_id)
+        inst_tester.add_binary(app.pkg_id)
+        assert not inst_tester.known_broken_packages
+        assert inst_tester.is_pkg_in_the_suite(broken.pkg_id)
+
+        # Packages not in the suite are ignored
+        inst_tester.mark_known_broken([broken.pkg_id, missing.pkg_id])
+        assert inst_tester.known_broken_packages == {broken.pkg_id}
+        assert not inst_tester.is_pkg_in_the_suite(broken.pkg_id)
+        assert inst_tester.is_installable(app.pkg_id)
+
+    def test_learned_nogoods(self):
+        builder = new_pkg_universe_builder()
+        essential = builder.new_package('essential').is_essential()
+        conflicts_ess = builder.new_package('conflicts-ess').conflicts_with(essential)
+        alternative = builder.new_package('alternative').not_in_testing()
+        nogood = builder.new_package('nogood').depends_on_any_of(conflicts_ess, alternative)
+        good = builder.new_package('good').conflicts_with('other')
+        root1 = builder.new_package('root1').depends_on_any_of(nogood, good)
+        root2 = builder.new_package('root2').depends_on(nogood)
+        builder.new_package('other')
+
+        universe, inst_tester = builder.build()
+
+        # Learned on its own (i.e. regardless of what else has been picked)
+        assert inst_tester._learn_unit_nogood(nogood.pkg_id)
+        assert not inst_tester._learn_unit_nogood(good.pkg_id)
+        assert inst_tester.is_installable(root1.pkg_id)
+        assert not inst_tester.is_installable(nogood.pkg_id)
+        assert not inst_tester.is_installable(root2.pkg_id)
+        for line in inst_tester.stats.stats():
+            print(line)
+        assert inst_tester.stats.nogoods_learned == 1
+        assert inst_tester.stats.nogoods_used == 1
+        # "root2" could only be solved with "nogood", which was ruled out from the start
+        assert inst_tester.stats.backtrace_restore_point_created == 0
+
+        # Removals never make a nogood installable
+        inst_tester.remove_binary(good.pkg_id)
+        assert inst_tester.stats.nogoods_invalidated == 0
+        assert not inst_tester.is_installable(root1.pkg_id)
+
+        # Adding "alternative" provides "nogood" with a way out, which
+        # invalidates the nogood even though "nogood" itself did not change.
+        inst_tester.add_binary(alternative.pkg_id)
+        assert inst_tester.stats.nogoods_invalidated == 1
+        assert inst_tester.is_installable(nogood.pkg_id)
+        assert inst_tester.is_installable(root2.pkg_id)
+
+    def test_nogood_support_index(self):
+        builder = new_pkg_universe_builder()
+        essential = builder.new_package('essential').is_essential()
+        conflicts_ess = builder.new_package('conflicts-ess').conflicts_with(essential)
+        alternative = builder.new_package('alternative').not_in_testing()
+        nogood = builder.new_package('nogood').depends_on_any_of(conflicts_ess, alternative)
+
+        _, inst_tester = builder.build()
+
+        def indexed():
+            return {x for supported in inst_tester._nogood_support.values() for x in supported}
+
+        # A nogood learned in a layer that is rolled back leaves no trace
+        inst_tester.begin_layer()
+        assert inst_tester._learn_unit_nogood(nogood.pkg_id)
+        assert indexed() == {nogood.pkg_id}
+        inst_tester.rollback_layer()
+        assert not inst_tester._nogood_support
+        assert not inst_tester._nogood_support_keys
+
+        # A rolled back invalidation restores the index with the nogood
+        assert inst_tester._learn_unit_nogood(nogood.pkg_id)
+        support = {k: set(v) for k, v in inst_tester._nogood_support.items()}
+        inst_tester.begin_layer()
+        inst_tester.add_binary(alternative.pkg_id)
+        assert not indexed()
+        inst_tester.rollback_layer()
+        assert inst_tester._nogood_support == support
+        assert not inst_tester.is_installable(nogood.pkg_id)
+
+        # Dropping the nogood removes all of its index entries
+        inst_tester.add_binary(alternative.pkg_id)
+        assert inst_tester.stats.nogoods_invalidated == 2
+        assert not indexed()
+        assert not inst_tester._nogood_support_keys
+
+    def test_choice_order_declared_order(self):
+        builder = new_pkg_universe_builder()
+        root_pkg = builder.new_package('root')
+        choice_count = 20
+
+        # The first alternative can always be picked without a restore point
+        # while the second one always requires one.
+        for i in range(choice_count):
+            pkg_good = builder.new_package('good-%d' % i)
+            pkg_bad = builder.new_package('bad-%d' % i).conflicts_with('other-%d' % i)
+            builder.new_package('other-%d' % i)
+            root_pkg.depends_on_any_of_in_order(pkg_good, pkg_bad)
+
+        _, unordered_tester = builder.build()
+        _, ordered_tester = builder.build()
+        ordered_tester.set_choice_order(['smallest-first', 'cached-first', 'declared-order'])
+
+        assert unordered_tester.is_installable(root_pkg.pkg_id)
+        assert ordered_tester.is_installable(root_pkg.pkg_id)
+        for line in ordered_tester.stats.stats():
+            print(line)
+        assert ordered_tester.stats.backtrace_restore_point_created == 0
+        assert ordered_tester.stats.choice_resolved_without_restore_point == choice_count
+        # Without heuristics, the order is arbitrary and "bad-X" is tried first
+        # about half of the time.
+        assert unordered_tester.stats.backtrace_restore_point_created > 0
+
+        with self.assertRaises(ValueError):
+            ordered_tester.set_choice_order(['no-such-heuristic'])
+
+    def test_deep_restore_points_recursion_limit(self):
+        builder = new_pkg_universe_builder()
+        recursion_limit = 200
+        choice_count = recursion_limit + 20
+        orig_limit = sys.getrecursionlimit()
+        root_pkg = builder.new_package('root')
+
+        # Every choice needs a restore point (both options pick up a new
+        # conflict) and all of them stay active until the solution is found.
+        for i in range(choice_count):
+            pkg_a = builder.new_package('a-%d' % i).conflicts_with('x-%d' % i)
+            pkg_b = builder.new_package('b-%d' % i).conflicts_with('y-%d' % i)
+            builder.new_package('x-%d' % i)
+            builder.new_package('y-%d' % i)
+            root_pkg.depends_on_any_of(pkg_a, pkg_b)
+
+        universe, inst_tester = builder.build()
+        try:
+            sys.setrecursionlimit(recursion_limit)
+            assert inst_tester.is_installable(root_pkg.pkg_id)
+        finally:
+            sys.setrecursionlimit(orig_limit)
+
+        for line in inst_tester.stats.stats():
+            print(line)
+        assert inst_tester.stats.backtrace_restore_point_created == choice_count
+        assert inst_tester.stats.backtrace_restore_point_used == 0
+
+    def test_solver_budget(self):
+        builder = new_pkg_universe_builder()
+        choice_count = 20
+        root_pkg = builder.new_package('root')
+
+        for i in range(choice_count):
+            pkg_a = builder.new_package('a-%d' % i).conflicts_with('x-%d' % i)
+            pkg_b = builder.new_package('b-%d' % i).conflicts_with('y-%d' % i)
+            builder.new_package('x-%d' % i)
+            builder.new_package('y-%d' % i)
+            root_pkg.depends_on_any_of(pkg_a, pkg_b)
+
+        universe, inst_tester = builder.build()
+        inst_tester.solver_budget = choice_count // 2
+
+        # The verdict is undetermined and nothing is cached
+        assert inst_tester.is_installable(root_pkg.pkg_id) is None
+        assert inst_tester.stats.solver_budget_exhausted == 1
+        assert inst_tester.is_installable(root_pkg.pkg_id) is None
+        assert inst_tester.stats.solver_budget_exhausted == 2
+
+        # ... unless the budget is explicitly ignored
+        assert inst_tester.is_installable_without_budget(root_pkg.pkg_id)
+        assert inst_tester.stats.solver_budget_exhausted == 2
+        assert inst_tester.solver_budget == choice_count // 2
+        inst_tester._cache_inst.clear()
+
+        # compute_installability defers the package and then checks it
+        # without the budget
+        inst_tester.compute_installability()
+        assert inst_tester.solver_budget == choice_count // 2
+        assert inst_tester.is_installable(root_pkg.pkg_id)
+
+        for line in inst_tester.stats.stats():
+            print(line)
+
+    def test_cost_accounting(self):
+        builder = new_pkg_universe_builder()
+        choice_count = 5
+        root_pkg = builder.new_package('root')
+        simple_pkg = builder.new_package('simple')
+
+        for i in range(choice_count):
+            pkg_a = builder.new_package('a-%d' % i).conflicts_with('x-%d' % i)
+            pkg_b = builder.new_package('b-%d' % i).conflicts_with('y-%d' % i)
+            builder.new_package('x-%d' % i)
+            builder.new_package('y-%d' % i)
+            root_pkg.depends_on_any_of(pkg_a, pkg_b)
+
+        _, inst_tester = builder.build()
+        inst_tester.enable_cost_accounting()
+        assert inst_tester.is_installable(root_pkg.pkg_id)
+        assert inst_tester.is_installable(simple_pkg.pkg_id)
+        # Cache hits are not accounted
+        assert inst_tester.is_installable(root_pkg.pkg_id)
+
+        costs = inst_tester.cost_accounting.costs
+        assert costs[root_pkg.pkg_id].calls == 1
+        assert costs[root_pkg.pkg_id].restore_points == choice_count
+        assert costs[root_pkg.pkg_id].max_depth == choice_count
+        assert costs[simple_pkg.pkg_id].restore_points == 0
+        assert len(inst_tester.cost_accounting.report(1)) == 1
+
+        # With sampling, only every N-th check is accounted
+        _, inst_tester = builder.build()
+        inst_tester.enable_cost_accounting(sample_rate=2)
+        for _ in range(4):
+            assert inst_tester._check_inst(simple_pkg.pkg_id)
+        assert inst_tester.cost_accounting.costs[simple_pkg.pkg_id].calls == 2
+        for line in inst_tester.cost_accounting.report(5):
+            print(line)
+
     def test_solver_recursion_limit(self):
         builder = new_pkg_universe_builder()
         recursion_limit = 200
@@ -0,0 +1,411 @@
+#!/usr/bin/python3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+import fileinput
+import os
+import random
+import subprocess
+import sys
+import unittest
+from unittest.mock import patch
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_DIR)
+
+from tests import TestBase
+
+
+def add_random_packages(data, seed, count=30):
+    '''Add a random (but reproducible) set of packages to data
+
+    Most packages get a new version in unstable, some are removed from
+    unstable or are new in it.  Their relations are random, so some of
+    the migrations are accepted and others are rejected.
+    '''
+    rnd = random.Random(seed)
+    names = ['p%d' % i for i in range(count)]
+    for unstable in (False, True):
+        version = '2' if unstable else '1'
+        for i, name in enumerate(names):
+            if unstable and rnd.random() < 0.15:
+                continue
+            if not unstable and rnd.random() < 0.1:
+                continue
+            depends = []
+            for _ in range(rnd.randint(0, 3)):
+                j = rnd.randrange(count)
+                if j == i:
+                    continue
+                if rnd.random() < 0.3:
+                    depends.append('%s (>= 2) | %s' % (names[j], rnd.choice(names)))
+                elif rnd.random() < 0.4:
+                    depends.append('%s (%s 2)' % (names[j], rnd.choice(['>=', '<<'])))
+                else:
+                    depends.append(names[j])
+            fields = {'Version': version,
+                      'Section': rnd.choice(['devel', 'libs']),
+                      'Source': 's%d' % (i // 2) if rnd.random() < 0.5 else 's' + name}
+            if depends:
+                fields['Depends'] = ', '.join(depends)
+            if rnd.random() < 0.15:
+                fields['Conflicts'] = rnd.choice(names)
+            if rnd.random() < 0.1:
+                fields['Breaks'] = '%s (<< 2)' % rnd.choice(names)
+            if rnd.random() < 0.2:
+                fields['Architecture'] = 'all'
+            data.add(name, unstable, fields)
+
+
+class MigrationTest(TestBase):
+    '''The migration of items (without autopkgtest)'''
+
+    def setUp(self):
+        super().setUp()
+        self.configure(ADT_ENABLE='no', SMOOTH_UPDATES='libs')
+
+    def configure(self, **options):
+        '''Set (or add) options in the britney configuration'''
+        for line in fileinput.input(self.britney_conf, inplace=True):
+            name = line.split('=', 1)[0].strip()
+            if name in options:
+                print('%s = %s' % (name, options.pop(name)))
+            else:
+                sys.stdout.write(line)
+        with open(self.britney_conf, 'a') as f:
+            for name, value in options.items():
+                f.write('%s = %s\n' % (name, value))
+
+    def run_migrations(self, **options):
+        '''Run britney and return (upgrade output, HeidiResult)
+
+        The first line of the upgrade output (with the time of the run)
+        is left out.  The hash seed is fixed, so runs with the same
+        configuration are comparable.
+        '''
+        self.configure(**options)
+        with patch.dict(os.environ, PYTHONHASHSEED='0'):
+            self.run_britney()
+        with open(os.path.join(self.data.path, 'output', 'output.txt')) as f:
+            upgrade_output = f.read().split('\n', 1)[1]
+        with open(os.path.join(self.data.path, 'output', 'HeidiResult')) as f:
+            heidi = f.read()
+        return upgrade_output, heidi
+
+    @staticmethod
+    def summarise(upgrade_output):
+        '''Extract the accepted and rejected items and the final nuninst'''
+        accepted = set()
+        rejected = set()
+        nuninst = []
+        for line in upgrade_output.splitlines():
+            if line.startswith('accepted: '):
+                accepted.add(line.split(': ', 1)[1])
+            elif line.startswith('skipped: '):
+                rejected.add(line.split(': ', 1)[1].rsplit(' (', 1)[0])
+            elif line.startswith(('endloop: ', '    now: ')):
+                nuninst.append(line)
+        return accepted, rejected, nuninst
+
+    @staticmethod
+    def trials(upgrade_output):
+        '''The items tried by the main run (in order)'''
+        main_run = upgrade_output.split(' finish: ', 1)[0]
+        return [line.split(': ', 1)[1] for line in main_run.splitlines() if line.startswith('trying: ')]
+
+    def load_britney(self):
+        '''Load the data (but do not run the migrations) in this process'''
+        import britney
+        cwd = os.getcwd()
+        os.chdir(self.data.path)
+        try:
+            with patch.object(sys, 'argv', ['britney.py', '-c', self.britney_conf]):
+                return britney.Britney()
+        finally:
+            os.chdir(cwd)
+
+    def test_compute_groups_memo(self):
+        # libgreen1 is only kept (smooth updated) as long as there is
+        # something in testing that depends on it
+        for unstable in (False, True):
+            version = '2' if unstable else '1'
+            lib = 'libgreen2' if unstable else 'libgreen1'
+            self.data.add(lib, unstable, {'Version': version, 'Source': 'green', 'Section': 'libs'})
+            self.data.add('app', unstable, {'Version': version, 'Depends': lib})
+            self.data.add('other', unstable, {'Version': version})
+        b = self.load_britney()
+        mm = b._migration_manager
+        mi_factory = b._migration_item_factory
+        green = mi_factory.parse_item('green/2', auto_correct=False)
+        app = mi_factory.parse_item('app/2', auto_correct=False)
+        other = mi_factory.parse_item('other/2', auto_correct=False)
+
+        def uncached_groups(item):
+            source_name, adds, rms, smoothbins = mm._compute_groups(item, True, frozenset())
+            return (source_name, frozenset(adds), frozenset(rms), frozenset(smoothbins))
+
+        before = mm.compute_groups(green)
+        self.assertEqual(before, uncached_groups(green))
+        self.assertTrue(before[3])
+        self.assertIs(mm.compute_groups(green), before)
+        self.assertEqual(mm.groups_cache_hits, 1)
+
+        # Migrating an unrelated source keeps the memoised groups
+        with mm.start_transaction() as transaction:
+            mm.migrate_items_to_target_suite([other], b.nuninst_orig, stop_on_first_regression=False)
+            transaction.commit()
+        self.assertIs(mm.compute_groups(green), before)
+        self.assertEqual(mm.groups_cache_hits, 2)
+
+        # Migrating app (but not green) changes the groups of green
+        with mm.start_transaction() as transaction:
+            mm.migrate_items_to_target_suite([app], b.nuninst_orig, stop_on_first_regression=False)
+            transaction.commit()
+        after = mm.compute_groups(green)
+        self.assertEqual(after, uncached_groups(green))
+        self.assertNotEqual(after, before)
+        self.assertFalse(after[3])
+
+    def test_compute_groups_memo_size(self):
+        from britney2 import migration
+        for unstable in (False, True):
+            for name in ('a', 'b', 'c'):
+                self.data.add(name, unstable, {'Version': '2' if unstable else '1'})
+        b = self.load_britney()
+        mm = b._migration_manager
+        items = {x: b._migration_item_factory.parse_item(x + '/2', auto_correct=False) for x in ('a', 'b', 'c')}
+        with patch.object(migration, 'GROUPS_CACHE_SIZE', 2):
+            mm.compute_groups(items['a'])
+            mm.compute_groups(items['b'])
+            # Using a makes b the least recently used one
+            mm.compute_groups(items['a'])
+            mm.compute_groups(items['c'])
+            self.assertEqual(len(mm._groups_cache), 2)
+            self.assertEqual(mm.groups_cache_hits, 1)
+            mm.compute_groups(items['a'])
+            self.assertEqual(mm.groups_cache_hits, 2)
+            mm.compute_groups(items['b'])
+        self.assertEqual(mm.groups_cache_hits, 2)
+        self.assertEqual(mm.groups_cache_misses, 4)
+
+    def test_check_consistency_levels(self):
+        for unstable in (False, True):
+            version = '2' if unstable else '1'
+            self.data.add('libgreen1', unstable, {'Version': version, 'Source': 'green', 'Section': 'libs'})
+            self.data.add('app', unstable, {'Version': version, 'Depends': 'libgreen1'})
+        b = self.load_britney()
+        mm = b._migration_manager
+        target_suite = b.suite_info.target_suite
+        app = b._migration_item_factory.parse_item('app/2', auto_correct=False)
+        with mm.start_transaction() as transaction:
+            mm.migrate_items_to_target_suite([app], b.nuninst_orig, stop_on_first_regression=False)
+            transaction.commit()
+        index = target_suite._source_index()
+        bogus = next(iter(index['app']['2']))._replace(package_name='bogus')
+
+        # A broken entry for a source changed by the transaction is
+        # found by checking the changes only
+        b.options.check_consistency_level = 3
+        b._check_transaction_consistency(transaction, 'test')
+        index['app']['2'].add(bogus)
+        with self.assertRaises(AssertionError):
+            b._check_transaction_consistency(transaction, 'test')
+        index['app']['2'].discard(bogus)
+
+        # One for another source is only found by the full check
+        index['green']['1'].add(bogus)
+        b._check_transaction_consistency(transaction, 'test')
+        b.options.check_consistency_level = 4
+        with self.assertRaises(AssertionError):
+            b._check_transaction_consistency(transaction, 'test')
+
+    def test_reschedule_on_footprint_change(self):
+        # a/2 needs e/2 (it conflicts with f), but that is not obvious
+        # enough for a to be ordered after e.  b is unrelated to both.
+        for unstable in (False, True):
+            self.data.add('a', unstable, {'Version': '2', 'Depends': 'e (>= 2) | f', 'Conflicts': 'f'} if unstable else {})
+            self.data.add('b', unstable, {'Version': '2'} if unstable else {})
+            self.data.add('f', unstable, {})
+        self.data.add('e', False, {})
+        self.data.add('e', True, {})
+
+        upgrade_output, _ = self.run_migrations()
+        # Accepting b does not change whether a can migrate, so a is
+        # not retried
+        self.assertEqual(self.trials(upgrade_output), ['a', 'b'])
+        self.assertIn('skipped: a ', upgrade_output)
+        self.assertIn('accepted: b\n', upgrade_output)
+        self.assertIn('  avoid: 1 retries of skipped items\n', upgrade_output)
+
+        # Accepting e/2 makes a/2 installable, so a is retried
+        self.data.remove_all(True)
+        self.data.add('a', True, {'Version': '2', 'Depends': 'e (>= 2) | f', 'Conflicts': 'f'})
+        self.data.add('b', True, {'Version': '2'})
+        self.data.add('e', True, {'Version': '2'})
+        self.data.add('f', True, {})
+
+        upgrade_output, _ = self.run_migrations()
+        self.assertEqual(self.trials(upgrade_output), ['a', 'b', 'e', 'a'])
+        self.assertIn('accepted: e\n', upgrade_output)
+        self.assertIn('accepted: a\n', upgrade_output)
+        self.assertNotIn('avoid:', upgrade_output)
+
+    def test_failed_migration_memo(self):
+        # a/2 cannot migrate: it needs e/2, which does not exist
+        for unstable in (False, True):
+            self.data.add('a', unstable, {'Version': '2', 'Depends': 'e (>= 2) | f', 'Conflicts': 'f'} if unstable else {})
+            self.data.add('e', unstable, {})
+            self.data.add('f', unstable, {})
+        self.data.add('b', True, {'Version': '2'})
+
+        upgrade_output, _ = self.run_migrations(FAILED_MIGRATION_MEMO='yes')
+        self.assertIn('skipped: a ', upgrade_output)
+        self.assertNotIn('deferred run', upgrade_output)
+
+        # Nothing near a changed, so the previous verdict is reused
+        self.data.add('c', True, {'Version': '2'})
+        upgrade_output, _ = self.run_migrations()
+        self.assertIn('info: deferred run for 1 item(s) that failed in a previous run\n', upgrade_output)
+        self.assertIn('skipped: a ', upgrade_output)
+        self.assertIn('accepted: c\n', upgrade_output)
+
+        # A new reverse dependency of a in testing invalidates it
+        self.data.add('g', False, {'Depends': 'a'})
+        self.data.add('g', True, {'Depends': 'a'})
+        upgrade_output, _ = self.run_migrations()
+        self.assertNotIn('deferred run', upgrade_output)
+        self.assertIn('skipped: a ', upgrade_output)
+
+    def interrupt_migrations(self, phase, in_progress=False):
+        '''Run britney, but kill it right after the (first) checkpoint for phase
+
+        If in_progress is set, it is killed after the first checkpoint
+        written during the phase rather than the one for its start.
+        '''
+        code = '''
+import os, sys
+sys.path.insert(0, %r)
+import britney
+
+def write_checkpoint(self, phase, run_state, in_progress=None, orig=britney.Britney._write_checkpoint):
+    orig(self, phase, run_state, in_progress=in_progress)
+    if (phase, in_progress is not None) == (%r, %r):
+        os._exit(1)
+
+britney.Britney._write_checkpoint = write_checkpoint
+sys.argv = ['britney.py', '-v', '-c', %r]
+britney.Britney().main()
+''' % (PROJECT_DIR, phase, in_progress, self.britney_conf)
+        # Use the same interpreter as run_britney: the iteration order of
+        # some sets (e.g. of items without a version) depends on it.
+        with open(self.britney) as f:
+            interpreter = f.readline()[2:].split()
+        with patch.dict(os.environ, PYTHONHASHSEED='0'):
+            britney = subprocess.run(interpreter + ['-c', code], cwd=self.data.path,
+                                     stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        self.assertEqual(britney.returncode, 1, britney.stdout)
+        self.assertTrue(os.path.exists(os.path.join(self.data.path, 'data', 'testing', 'state', 'upgrade-checkpoint')))
+
+    def test_checkpoints_are_opt_in(self):
+        add_random_packages(self.data, 0)
+        b = self.load_britney()
+        self.assertIsNone(b._checkpoint_filename)
+        self.assertFalse(b._migration_manager.record_history)
+        self.configure(CHECKPOINTS='yes')
+        b = self.load_britney()
+        self.assertIsNotNone(b._checkpoint_filename)
+        self.assertTrue(b._migration_manager.record_history)
+
+    def test_migration_history(self):
+        # app/2 breaks old-app, so old-app is known to be broken when
+        # other/2 migrates
+        for unstable in (False, True):
+            self.data.add('app', unstable, {'Version': '2' if unstable else '1'})
+            self.data.add('other', unstable, {'Version': '2' if unstable else '1'})
+        self.data.add('old-app', False, {'Depends': 'app (<< 2)'})
+        self.configure(CHECKPOINTS='yes')
+        b = self.load_britney()
+        mm = b._migration_manager
+        app, other = (b._migration_item_factory.parse_item(x, auto_correct=False) for x in ('app/2', 'other/2'))
+
+        # Rolled back migrations are not recorded
+        with mm.start_transaction() as transaction:
+            mm.migrate_items_to_target_suite([app], b.nuninst_orig, stop_on_first_regression=False)
+            transaction.rollback()
+        self.assertEqual(mm.migration_history, [])
+
+        for item in (app, other):
+            with mm.start_transaction() as transaction:
+                mm.migrate_items_to_target_suite([item], b.nuninst_orig, stop_on_first_regression=False)
+                transaction.commit()
+        old_app = {pkg.pkg_id for binaries_a in b.suite_info.target_suite.binaries.values()
+                   for pkg in binaries_a.values() if pkg.source == 'old-app'}
+        # Only the changes to the known broken packages are recorded
+        self.assertEqual(mm.migration_history, [
+            ([app], frozenset(), frozenset()),
+            ([other], frozenset(old_app), frozenset()),
+        ])
+
+    def test_resume_from_checkpoint(self):
+        add_random_packages(self.data, 0)
+        upgrade_output, heidi = self.run_migrations(CHECKPOINTS='yes')
+        accepted, rejected, _ = self.summarise(upgrade_output)
+        self.assertTrue(accepted)
+        self.assertTrue(rejected)
+
+        for phase in ('main-run', 'break-arch-runs', 'hint-hints', 'cleanup'):
+            with self.subTest(phase=phase):
+                self.interrupt_migrations(phase)
+                self.data.compute_migrations = '--resume'
+                try:
+                    resumed_output, resumed_heidi = self.run_migrations()
+                finally:
+                    self.data.compute_migrations = ''
+                self.assertEqual(resumed_output, upgrade_output)
+                self.assertEqual(resumed_heidi, heidi)
+
+    def test_resume_main_run_from_checkpoint(self):
+        add_random_packages(self.data, 0)
+        upgrade_output, heidi = self.run_migrations(CHECKPOINTS='yes', CHECKPOINT_INTERVAL=1)
+        accepted, _, _ = self.summarise(upgrade_output)
+        main_run = upgrade_output.split(' finish: ', 1)[0]
+        first_accepted = main_run.split('accepted: ', 1)[1].split('\n', 1)[0]
+
+        self.interrupt_migrations('main-run', in_progress=True)
+        self.data.compute_migrations = '--resume'
+        try:
+            resumed_output, resumed_heidi = self.run_migrations()
+        finally:
+            self.data.compute_migrations = ''
+        # The item accepted before the checkpoint is not tried again
+        resumed_main_run = resumed_output.split('info: main run (resumed)\n', 1)[1].split(' finish: ', 1)[0]
+        self.assertNotIn(first_accepted, {x for comp in self.trials(resumed_main_run) for x in comp.split()})
+        # (The components may be grouped differently)
+        resumed_accepted = self.summarise(resumed_output)[0]
+        self.assertEqual({x for comp in resumed_accepted for x in comp.split()},
+                         {x for comp in accepted for x in comp.split()})
+        self.assertEqual(resumed_heidi, heidi)
+
+    def test_speculative_trials(self):
+        for seed in (0, 1):
+            with self.subTest(seed=seed):
+                self.data.remove_all(False)
+                self.data.remove_all(True)
+                add_random_packages(self.data, seed)
+
+                serial_output, serial_heidi = self.run_migrations(SPECULATIVE_TRIAL_WORKERS=0)
+                accepted, rejected, nuninst = self.summarise(serial_output)
+                # The fixture has to exercise both outcomes
+                self.assertTrue(accepted)
+                self.assertTrue(rejected)
+
+                speculative_output, speculative_heidi = self.run_migrations(SPECULATIVE_TRIAL_WORKERS=2)
+                self.assertEqual(self.summarise(speculative_output), (accepted, rejected, nuninst))
+                self.assertEqual(speculative_heidi, serial_heidi)
+
+
+if __name__ == '__main__':
+    unittest.main()
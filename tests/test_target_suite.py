@@ -0,0 +1,177 @@
+import unittest
+
+from unittest.mock import Mock
+
+from britney2 import BinaryPackage, BinaryPackageId, SourcePackage, Suite, SuiteClass, Suites, TargetSuite
+from britney2.migrationitem import MigrationItemFactory
+from britney2.transaction import MigrationTransactionState
+from britney2.utils import old_libraries
+
+ARCHITECTURES = ['i386', 'amd64']
+
+
+def new_source(version):
+    return SourcePackage(version, 'devel', set(), 'Joe <joe@example.com>', False, None, None, None, [])
+
+
+def new_binary(name, version, arch, source, source_version=None):
+    pkg_id = BinaryPackageId(name, version, arch)
+    return BinaryPackage(version, 'devel', source, source_version or version, arch, None, None, None, [], False,
+                         pkg_id, None)
+
+
+class TestTargetSuiteSourceIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.suite = TargetSuite(SuiteClass.TARGET_SUITE, 'testing', '/somewhere/target', '')
+        self.suite.inst_tester = Mock()
+        self.suite.binaries = {arch: {} for arch in ARCHITECTURES}
+        self.all_binaries = {}
+        # src1 builds bin1 and bin2, src2 builds nothing (yet)
+        self.add_source('src1', '1')
+        self.add_source('src2', '1')
+        for arch in ARCHITECTURES:
+            self.put_binary(new_binary('bin1', '1', arch, 'src1'))
+            self.put_binary(new_binary('bin2', '1', arch, 'src1'))
+
+    def add_source(self, name, version):
+        self.suite.sources[name] = new_source(version)
+
+    def put_binary(self, pkg):
+        '''Add pkg to the binaries table (and its source)'''
+        self.all_binaries[pkg.pkg_id] = pkg
+        self.suite.binaries[pkg.architecture][pkg.pkg_id.package_name] = pkg
+        if pkg.source in self.suite.sources:
+            self.suite.sources[pkg.source].binaries.add(pkg.pkg_id)
+
+    def add_binary(self, pkg):
+        '''Add pkg to the suite the way the MigrationManager does'''
+        self.put_binary(pkg)
+        self.suite.add_binary(pkg.pkg_id)
+
+    def remove_binary(self, pkg_id):
+        '''Remove pkg_id from the suite the way the MigrationManager does'''
+        pkg = self.suite.binaries[pkg_id.architecture][pkg_id.package_name]
+        if pkg.source in self.suite.sources:
+            self.suite.sources[pkg.source].binaries.discard(pkg_id)
+        self.suite.remove_binary(pkg_id)
+        del self.suite.binaries[pkg_id.architecture][pkg_id.package_name]
+
+    def update_source(self, name, version):
+        self.suite.sources[name] = new_source(version)
+        self.suite.source_changed(name)
+
+    def assert_index_is_consistent(self):
+        # Rebuilds the index and compares it to the current one
+        self.suite.check_suite_source_pkg_consistency('test')
+
+    def test_initial_index(self):
+        assert not set(self.suite.cruft_binaries())
+        assert self.suite.sources_without_binaries() == {'src2'}
+        assert not self.suite._dirty_sources
+        self.assert_index_is_consistent()
+
+    def test_add_and_remove(self):
+        assert self.suite.sources_without_binaries() == {'src2'}
+
+        self.add_binary(new_binary('bin3', '1', 'amd64', 'src2'))
+        assert self.suite._dirty_sources == {'src2'}
+        assert not self.suite.sources_without_binaries()
+        assert not self.suite._dirty_sources
+
+        # src1/2 only builds bin1 and only on i386 (so far)
+        self.update_source('src1', '2')
+        assert self.suite._dirty_sources == {'src1'}
+        assert set(self.suite.cruft_binaries()) == {pkg.pkg_id for binaries_a in self.suite.binaries.values()
+                                                    for pkg in binaries_a.values() if pkg.source == 'src1'}
+        self.remove_binary(BinaryPackageId('bin1', '1', 'i386'))
+        self.add_binary(new_binary('bin1', '2', 'i386', 'src1'))
+        assert set(self.suite.cruft_binaries()) == {
+            BinaryPackageId('bin2', '1', 'i386'),
+            BinaryPackageId('bin1', '1', 'amd64'),
+            BinaryPackageId('bin2', '1', 'amd64'),
+        }
+        self.assert_index_is_consistent()
+
+        # Removing the cruft also removes it from the index
+        for pkg_id in list(self.suite.cruft_binaries()):
+            self.remove_binary(pkg_id)
+        assert not set(self.suite.cruft_binaries())
+        assert not self.suite.sources_without_binaries()
+        self.remove_binary(BinaryPackageId('bin3', '1', 'amd64'))
+        assert self.suite.sources_without_binaries() == {'src2'}
+        self.assert_index_is_consistent()
+
+    def test_remove_source(self):
+        del self.suite.sources['src2']
+        self.suite.source_changed('src2')
+        assert not self.suite.sources_without_binaries()
+        # All binaries of a removed source are cruft
+        del self.suite.sources['src1']
+        self.suite.source_changed('src1')
+        assert len(set(self.suite.cruft_binaries())) == 4
+
+    def test_undo(self):
+        suite_info = Suites(self.suite, [])
+        expected_cruft = set(self.suite.cruft_binaries())
+        expected_without_binaries = self.suite.sources_without_binaries()
+
+        transaction = MigrationTransactionState(suite_info, self.all_binaries)
+        undo = {'binaries': {}, 'sources': {}, 'virtual': {}}
+        # Update src1 to 2 (replacing bin1 and dropping bin2 on i386)
+        # and give src2 a binary
+        undo['sources']['src1'] = self.suite.sources['src1']
+        undo['sources']['src2'] = self.suite.sources['src2']
+        self.update_source('src1', '2')
+        self.update_source('src2', '1')
+        for name in ('bin1', 'bin2'):
+            pkg_id = BinaryPackageId(name, '1', 'i386')
+            undo['binaries'][(name, 'i386')] = pkg_id
+            self.remove_binary(pkg_id)
+        self.add_binary(new_binary('bin1', '2', 'i386', 'src1'))
+        self.add_binary(new_binary('bin3', '1', 'amd64', 'src2'))
+        updated_binaries = {BinaryPackageId('bin1', '2', 'i386'), BinaryPackageId('bin3', '1', 'amd64')}
+        transaction.add_undo_item(undo, updated_binaries)
+
+        assert set(self.suite.cruft_binaries()) == {BinaryPackageId('bin1', '1', 'amd64'),
+                                                    BinaryPackageId('bin2', '1', 'amd64')}
+        assert not self.suite.sources_without_binaries()
+
+        transaction.rollback()
+        assert self.suite._dirty_sources >= {'src1', 'src2'}
+        assert set(self.suite.cruft_binaries()) == expected_cruft
+        assert self.suite.sources_without_binaries() == expected_without_binaries
+        self.assert_index_is_consistent()
+
+    def test_source_generation(self):
+        suite_info = Suites(self.suite, [])
+        assert self.suite.source_generation('src2') == 0
+        self.add_binary(new_binary('bin3', '1', 'amd64', 'src2'))
+        assert self.suite.source_generation('src2') == 1
+        generation = self.suite.source_generation('src1')
+
+        transaction = MigrationTransactionState(suite_info, self.all_binaries)
+        undo = {'binaries': {}, 'sources': {'src1': self.suite.sources['src1']}, 'virtual': {}}
+        self.update_source('src1', '2')
+        transaction.add_undo_item(undo, set())
+        assert self.suite.source_generation('src1') == generation + 1
+        # Rolling back is a change as well
+        transaction.rollback()
+        assert self.suite.source_generation('src1') == generation + 2
+        assert self.suite.source_generation('src2') == 1
+
+    def test_old_libraries_order(self):
+        source_suite = Suite(SuiteClass.PRIMARY_SOURCE_SUITE, 'unstable', '/somewhere/source', '')
+        source_suite.binaries = {arch: {} for arch in ARCHITECTURES}
+        suite_info = Suites(self.suite, [source_suite])
+        self.update_source('src1', '2')
+        # The order of the binaries table does not matter
+        for arch in ARCHITECTURES:
+            binaries_a = self.suite.binaries[arch]
+            self.suite.binaries[arch] = dict(reversed(list(binaries_a.items())))
+        removals = old_libraries(MigrationItemFactory(suite_info), suite_info)
+        assert [x.uvname for x in removals] == ['-bin1/i386', '-bin2/i386', '-bin1/amd64', '-bin2/amd64']
+
+
+if __name__ == '__main__':
+    unittest.main()
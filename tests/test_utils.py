@@ -0,0 +1,112 @@
+import unittest
+
+from britney2.utils import DeltaSet
+
+
+class TestDeltaSet(unittest.TestCase):
+
+    def test_membership_and_equality(self):
+        base = {'a', 'b', 'c'}
+        delta = DeltaSet(base)
+        assert delta == base
+        delta.discard('b')
+        delta.discard('missing')
+        delta.add('d')
+        delta.add('a')
+        assert 'a' in delta
+        assert 'b' not in delta
+        assert 'd' in delta
+        assert 'missing' not in delta
+        assert delta == {'a', 'c', 'd'}
+        assert {'a', 'c', 'd'} == delta
+        assert delta != base
+        assert len(delta) == 3
+        # Undoing a change restores the original value
+        delta.add('b')
+        delta.discard('d')
+        assert delta == base
+        assert len(delta) == 3
+        # The base set is never modified
+        assert base == {'a', 'b', 'c'}
+
+    def test_iteration(self):
+        delta = DeltaSet(frozenset(range(10)))
+        assert sorted(delta) == list(range(10))
+        delta.add(10)
+        assert sorted(delta) == list(range(11))
+        delta.discard(0)
+        delta.discard(5)
+        assert sorted(delta) == [1, 2, 3, 4, 6, 7, 8, 9, 10]
+        assert set(delta) == delta
+
+    def test_copy_of_changed_base(self):
+        base = {'a', 'b', 'c'}
+        first = DeltaSet(base)
+        first.discard('a')
+        second = DeltaSet(first)
+        assert second == {'b', 'c'}
+        # Changing either set does not affect the other one
+        first.add('x')
+        first.discard('b')
+        second.add('y')
+        second.add('a')
+        assert first == {'c', 'x'}
+        assert second == {'a', 'b', 'c', 'y'}
+        assert base == {'a', 'b', 'c'}
+
+    def test_fold(self):
+        threshold = DeltaSet.FOLD_THRESHOLD
+        base = frozenset(range(threshold))
+        first = DeltaSet(base)
+        for i in range(threshold // 2):
+            first.discard(i)
+            first.add(threshold + i)
+        expected = set(range(threshold // 2, threshold + threshold // 2))
+        # Still below the threshold, so the base is shared
+        second = DeltaSet(first)
+        assert second._base is base
+        assert second == expected
+
+        first.add(-1)
+        expected.add(-1)
+        # Above the threshold, so the changes are folded into a new base
+        third = DeltaSet(first)
+        assert third._base is not base
+        assert first._base is third._base
+        assert not third._added and not third._removed
+        assert first == third == expected
+        assert sorted(first) == sorted(third) == sorted(expected)
+        assert second == expected - {-1}
+        assert base == frozenset(range(threshold))
+
+        # Sets sharing the folded base remain independent
+        first.discard(-1)
+        first.add(-2)
+        third.discard(threshold)
+        assert first == (expected - {-1}) | {-2}
+        assert third == expected - {threshold}
+        assert -1 in third
+        assert threshold not in third
+        assert sorted(third) == sorted(expected - {threshold})
+
+    def test_difference(self):
+        base = {'a', 'b', 'c'}
+        first = DeltaSet(base)
+        first.discard('a')
+        first.add('d')
+        second = DeltaSet(first)
+        second.discard('b')
+        second.add('e')
+        second.add('a')
+        # Sets sharing a base (or being compared to it)
+        assert second - first == {'a', 'e'}
+        assert first - second == {'b'}
+        assert first - base == {'d'}
+        assert base - first == {'a'}
+        # The generic implementation
+        assert second - {'a', 'x'} == {'c', 'd', 'e'}
+        assert {'a', 'b', 'x'} - second == {'b', 'x'}
+
+
+if __name__ == '__main__':
+    unittest.main()